@@ -48,13 +48,18 @@ except ImportError:
 table = [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10)
           for x in range(1000)]
 
-genshi_tmpl = MarkupTemplate("""
+genshi_source = """
 <table xmlns:py="http://genshi.edgewall.org/">
 <tr py:for="row in table">
 <td py:for="c in row.values()" py:content="c"/>
 </tr>
 </table>
-""")
+"""
+
+genshi_tmpl = MarkupTemplate(genshi_source)
+
+genshi_compiled_tmpl = MarkupTemplate(genshi_source)
+genshi_compiled_tmpl.compiled = True
 
 genshi_tmpl2 = MarkupTemplate("""
 <table xmlns:py="http://genshi.edgewall.org/">$table</table>
@@ -103,6 +108,11 @@ def test_genshi():
     stream = genshi_tmpl.generate(table=table)
     stream.render('html', strip_whitespace=False)
 
+def test_genshi_compiled():
+    """Genshi template, compiled"""
+    stream = genshi_compiled_tmpl.generate(table=table)
+    stream.render('html', strip_whitespace=False)
+
 def test_genshi_text():
     """Genshi text template"""
     stream = genshi_text_tmpl.generate(table=table)
@@ -196,7 +206,8 @@ if neo_cgi:
 
 
 def run(which=None, number=10):
-    tests = ['test_builder', 'test_genshi', 'test_genshi_text',
+    tests = ['test_builder', 'test_genshi', 'test_genshi_compiled',
+             'test_genshi_text',
              'test_genshi_builder', 'test_mako', 'test_kid', 'test_kid_et',
              'test_et', 'test_cet', 'test_clearsilver', 'test_django']
 
@@ -29,6 +29,8 @@
 
 static PyObject *amp1, *amp2, *lt1, *lt2, *gt1, *gt2, *qt1, *qt2;
 static PyObject *stripentities, *striptags;
+static PyObject *empty, *space, *eqquot, *slashgt, *spaceslashgt, *ltslash;
+static PyObject *gtltslash, *colon, *lang, *xml_lang, *xml_space, *xmlns;
 
 static void
 init_constants(void)
@@ -46,6 +48,19 @@ init_constants(void)
     gt2 = PyUnicode_DecodeASCII("&gt;", 4, NULL);
     qt1 = PyUnicode_DecodeASCII("\"", 1, NULL);
     qt2 = PyUnicode_DecodeASCII("&#34;", 5, NULL);
+
+    empty = PyUnicode_DecodeASCII("", 0, NULL);
+    space = PyUnicode_DecodeASCII(" ", 1, NULL);
+    eqquot = PyUnicode_DecodeASCII("=\"", 2, NULL);
+    slashgt = PyUnicode_DecodeASCII("/>", 2, NULL);
+    spaceslashgt = PyUnicode_DecodeASCII(" />", 3, NULL);
+    ltslash = PyUnicode_DecodeASCII("</", 2, NULL);
+    gtltslash = PyUnicode_DecodeASCII("></", 3, NULL);
+    colon = PyUnicode_DecodeASCII(":", 1, NULL);
+    lang = PyUnicode_DecodeASCII("lang", 4, NULL);
+    xml_lang = PyUnicode_DecodeASCII("xml:lang", 8, NULL);
+    xml_space = PyUnicode_DecodeASCII("xml:space", 9, NULL);
+    xmlns = PyUnicode_DecodeASCII("xmlns", 5, NULL);
 }
 
 /* Markup class */
@@ -649,13 +664,624 @@ PyTypeObject MarkupType = {
     0           /*tp_weaklist*/
 };
 
+/* Serialization loops */
+
+#ifdef IS_PY3K
+#   define PyInt_FromLong PyLong_FromLong
+#   define PyInt_AsLong PyLong_AsLong
+#endif
+
+#define MODE_XML 0
+#define MODE_XHTML 1
+#define MODE_HTML 2
+
+#define VERBATIM 1
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *stream;           /* the iterator over the events */
+    int mode;                   /* one of the MODE_* constants */
+    long state;                 /* combination of the state flags */
+    PyObject *cache;            /* the output cache, or None */
+    PyObject *other;            /* the function serializing other events */
+    PyObject *emit;             /* the function storing output in the cache */
+    PyObject *boolean_attrs, *empty_elems, *noescape_elems;
+    PyObject *start, *end, *text, *empty;
+} SerializerObject;
+
+PyTypeObject SerializerType; /* declared later */
+
+static PyObject *
+markup_from(PyObject *text)
+{
+    /* Create a Markup instance from the given string, stealing the
+       reference */
+    PyObject *args, *ret;
+
+    if (text == NULL) {
+        return NULL;
+    }
+    args = PyTuple_New(1);
+    if (args == NULL) {
+        Py_DECREF(text);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(args, 0, text);
+    ret = MarkupType.tp_new(&MarkupType, args, NULL);
+    Py_DECREF(args);
+    return ret;
+}
+
+static PyObject *
+escape_value(PyObject *text, int quotes)
+{
+    /* Same as Markup.escape() */
+    int false_ = PyObject_Not(text);
+
+    if (false_ < 0) {
+        return NULL;
+    }
+    if (false_) {
+        Py_INCREF(empty);
+        return markup_from(empty);
+    }
+    return escape(text, quotes);
+}
+
+static PyObject *
+unpack(PyObject *obj, Py_ssize_t size)
+{
+    /* Return the given sequence as a tuple of the given size */
+    PyObject *tuple;
+
+    if (PyTuple_CheckExact(obj)) {
+        Py_INCREF(obj);
+        tuple = obj;
+    } else {
+        tuple = PySequence_Tuple(obj);
+        if (tuple == NULL) {
+            return NULL;
+        }
+    }
+    if (PyTuple_GET_SIZE(tuple) != size) {
+        PyErr_Format(PyExc_ValueError, "expected a sequence of %d items",
+                     (int) size);
+        Py_DECREF(tuple);
+        return NULL;
+    }
+    return tuple;
+}
+
+static int
+append_attr(PyObject *buf, PyObject *attr, PyObject *value)
+{
+    PyObject *escaped;
+
+    if (PyList_Append(buf, space) < 0 || PyList_Append(buf, attr) < 0 ||
+            PyList_Append(buf, eqquot) < 0) {
+        return -1;
+    }
+    escaped = escape_value(value, 1);
+    if (escaped == NULL) {
+        return -1;
+    }
+    if (PyList_Append(buf, escaped) < 0) {
+        Py_DECREF(escaped);
+        return -1;
+    }
+    Py_DECREF(escaped);
+    return PyList_Append(buf, qt1);
+}
+
+static int
+append_lang(PyObject *buf, PyObject *attr, PyObject *value, PyObject *attrib)
+{
+    /* Add a lang attribute for an xml:lang attribute, unless the element
+       already has one */
+    int ret = PyObject_RichCompareBool(attr, xml_lang, Py_EQ);
+
+    if (ret <= 0) {
+        return ret;
+    }
+    ret = PySequence_Contains(attrib, lang);
+    if (ret != 0) {
+        return ret < 0 ? -1 : 1;
+    }
+    return append_attr(buf, lang, value) < 0 ? -1 : 1;
+}
+
+static int
+append_attrs(SerializerObject *self, PyObject *buf, PyObject *attrib)
+{
+    PyObject *iter, *item, *pair, *attr, *value;
+    int ret;
+
+    iter = PyObject_GetIter(attrib);
+    if (iter == NULL) {
+        return -1;
+    }
+    while ((item = PyIter_Next(iter)) != NULL) {
+        pair = unpack(item, 2);
+        Py_DECREF(item);
+        if (pair == NULL) {
+            goto error;
+        }
+        attr = PyTuple_GET_ITEM(pair, 0);
+        value = PyTuple_GET_ITEM(pair, 1);
+
+        if (self->mode == MODE_XML) {
+            ret = append_attr(buf, attr, value);
+
+        } else if (self->mode == MODE_XHTML) {
+            ret = PySequence_Contains(self->boolean_attrs, attr);
+            if (ret > 0) {
+                ret = append_attr(buf, attr, attr);
+            } else if (ret == 0) {
+                ret = append_lang(buf, attr, value, attrib);
+                if (ret == 0) {
+                    /* xml:space attributes are dropped */
+                    ret = PyObject_RichCompareBool(attr, xml_space, Py_EQ);
+                    if (ret == 0) {
+                        ret = append_attr(buf, attr, value);
+                    }
+                } else if (ret > 0) {
+                    ret = append_attr(buf, attr, value);
+                }
+            }
+
+        } else {
+            ret = PySequence_Contains(self->boolean_attrs, attr);
+            if (ret > 0) {
+                ret = PyObject_IsTrue(value);
+                if (ret > 0) {
+                    if (PyList_Append(buf, space) < 0 ||
+                            PyList_Append(buf, attr) < 0) {
+                        ret = -1;
+                    }
+                }
+            } else if (ret == 0) {
+                ret = PySequence_Contains(attr, colon);
+                if (ret > 0) {
+                    ret = append_lang(buf, attr, value, attrib);
+                } else if (ret == 0) {
+                    ret = PyObject_RichCompareBool(attr, xmlns, Py_EQ);
+                    if (ret == 0) {
+                        ret = append_attr(buf, attr, value);
+                    }
+                }
+            }
+        }
+
+        Py_DECREF(pair);
+        if (ret < 0) {
+            goto error;
+        }
+    }
+    Py_DECREF(iter);
+    return PyErr_Occurred() ? -1 : 0;
+
+error:
+    Py_DECREF(iter);
+    return -1;
+}
+
+static PyObject *
+serialize_tag(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    PyObject *tuple, *tag, *buf, *ret = NULL;
+    int is_empty = kind == self->empty, contained;
+
+    tuple = unpack(data, 2);
+    if (tuple == NULL) {
+        return NULL;
+    }
+    tag = PyTuple_GET_ITEM(tuple, 0);
+    buf = PyList_New(0);
+    if (buf == NULL) {
+        goto done;
+    }
+    if (PyList_Append(buf, lt1) < 0 || PyList_Append(buf, tag) < 0 ||
+            append_attrs(self, buf, PyTuple_GET_ITEM(tuple, 1)) < 0) {
+        goto done;
+    }
+
+    if (self->mode == MODE_XML) {
+        if (PyList_Append(buf, is_empty ? slashgt : gt1) < 0) {
+            goto done;
+        }
+    } else if (self->mode == MODE_XHTML) {
+        if (is_empty) {
+            contained = PySequence_Contains(self->empty_elems, tag);
+            if (contained < 0) {
+                goto done;
+            } else if (contained) {
+                if (PyList_Append(buf, spaceslashgt) < 0) {
+                    goto done;
+                }
+            } else if (PyList_Append(buf, gtltslash) < 0 ||
+                       PyList_Append(buf, tag) < 0 ||
+                       PyList_Append(buf, gt1) < 0) {
+                goto done;
+            }
+        } else if (PyList_Append(buf, gt1) < 0) {
+            goto done;
+        }
+    } else {
+        if (PyList_Append(buf, gt1) < 0) {
+            goto done;
+        }
+        if (is_empty) {
+            contained = PySequence_Contains(self->empty_elems, tag);
+            if (contained < 0) {
+                goto done;
+            } else if (!contained && (PyList_Append(buf, ltslash) < 0 ||
+                                      PyList_Append(buf, tag) < 0 ||
+                                      PyList_Append(buf, gt1) < 0)) {
+                goto done;
+            }
+        }
+        contained = PySequence_Contains(self->noescape_elems, tag);
+        if (contained < 0) {
+            goto done;
+        } else if (contained) {
+            self->state |= VERBATIM;
+        }
+    }
+
+    ret = markup_from(PyUnicode_Join(empty, buf));
+
+done:
+    Py_XDECREF(buf);
+    Py_DECREF(tuple);
+    return ret;
+}
+
+static PyObject *
+serialize_end(PyObject *data)
+{
+    PyObject *tag, *buf, *ret;
+
+    tag = PyObject_Str(data);
+    if (tag == NULL) {
+        return NULL;
+    }
+    buf = PyTuple_Pack(3, ltslash, tag, gt1);
+    Py_DECREF(tag);
+    if (buf == NULL) {
+        return NULL;
+    }
+    ret = markup_from(PyUnicode_Join(empty, buf));
+    Py_DECREF(buf);
+    return ret;
+}
+
+static PyObject *
+cache_get(SerializerObject *self, PyObject *key)
+{
+    /* Return the cached output for the given key, or NULL if there is none
+       (or an error occurred) */
+    PyObject *output;
+
+    if (self->cache == Py_None) {
+        return NULL;
+    }
+    if (PyDict_CheckExact(self->cache)) {
+        output = PyDict_GetItem(self->cache, key);
+        Py_XINCREF(output);
+        return output;
+    }
+    /* Something like a _SharedCache, which may look up missing keys */
+    output = PyObject_GetItem(self->cache, key);
+    if (output == Py_None) {
+        Py_DECREF(output);
+        return NULL;
+    }
+    return output;
+}
+
+static PyObject *
+cache_put(SerializerObject *self, PyObject *kind, PyObject *data,
+          PyObject *key, PyObject *output)
+{
+    /* Store the given output in the cache, stealing the reference */
+    PyObject *ret;
+
+    if (output == NULL || self->cache == Py_None) {
+        return output;
+    }
+    if (PyDict_CheckExact(self->cache)) {
+        if (PyDict_SetItem(self->cache, key, output) < 0) {
+            Py_DECREF(output);
+            return NULL;
+        }
+        return output;
+    }
+    ret = PyObject_CallFunctionObjArgs(self->emit, kind, data, output, NULL);
+    Py_DECREF(output);
+    return ret;
+}
+
+static PyObject *
+serialize_other(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    PyObject *state, *result, *tuple, *output = NULL;
+    long new_state;
+
+    state = PyInt_FromLong(self->state);
+    if (state == NULL) {
+        return NULL;
+    }
+    result = PyObject_CallFunctionObjArgs(self->other, kind, data, state,
+                                          self->emit, NULL);
+    Py_DECREF(state);
+    if (result == NULL) {
+        return NULL;
+    }
+    tuple = unpack(result, 2);
+    Py_DECREF(result);
+    if (tuple == NULL) {
+        return NULL;
+    }
+    new_state = PyInt_AsLong(PyTuple_GET_ITEM(tuple, 1));
+    if (new_state != -1 || !PyErr_Occurred()) {
+        self->state = new_state;
+        output = PyTuple_GET_ITEM(tuple, 0);
+        Py_INCREF(output);
+    }
+    Py_DECREF(tuple);
+    return output;
+}
+
+static int
+update_noescape(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    /* Update the state after cached output has been found for an event */
+    PyObject *tag;
+    int contained;
+
+    if (kind == self->start || kind == self->empty) {
+        tag = PySequence_GetItem(data, 0);
+        if (tag == NULL) {
+            return -1;
+        }
+        contained = PySequence_Contains(self->noescape_elems, tag);
+        Py_DECREF(tag);
+        if (contained < 0) {
+            return -1;
+        } else if (contained) {
+            self->state |= VERBATIM;
+        }
+    } else if (kind == self->end) {
+        self->state &= ~VERBATIM;
+    }
+    return 0;
+}
+
+static PyObject *
+Serializer_next(SerializerObject *self)
+{
+    PyObject *item, *event, *kind, *data, *key, *output;
+
+    while ((item = PyIter_Next(self->stream)) != NULL) {
+        event = unpack(item, 3);
+        Py_DECREF(item);
+        if (event == NULL) {
+            return NULL;
+        }
+        kind = PyTuple_GET_ITEM(event, 0);
+        data = PyTuple_GET_ITEM(event, 1);
+
+        if (kind == self->text && PyObject_TypeCheck(data, &MarkupType)) {
+            Py_INCREF(data);
+            Py_DECREF(event);
+            return data;
+        }
+
+        key = PyTuple_Pack(2, kind, data);
+        if (key == NULL) {
+            Py_DECREF(event);
+            return NULL;
+        }
+        output = cache_get(self, key);
+
+        if (output != NULL) {
+            if (self->mode == MODE_HTML &&
+                    update_noescape(self, kind, data) < 0) {
+                Py_CLEAR(output);
+            }
+
+        } else if (PyErr_Occurred()) {
+            /* fall through */
+
+        } else if (kind == self->start || kind == self->empty) {
+            output = cache_put(self, kind, data, key,
+                               serialize_tag(self, kind, data));
+
+        } else if (kind == self->end) {
+            output = cache_put(self, kind, data, key, serialize_end(data));
+            if (self->mode == MODE_HTML) {
+                self->state &= ~VERBATIM;
+            }
+
+        } else if (kind == self->text) {
+            if (self->state & VERBATIM) {
+                Py_INCREF(data);
+                output = data;
+            } else {
+                output = escape_value(data, 0);
+            }
+            output = cache_put(self, kind, data, key, output);
+
+        } else {
+            output = serialize_other(self, kind, data);
+            if (output == Py_None) {
+                Py_DECREF(output);
+                Py_DECREF(key);
+                Py_DECREF(event);
+                continue;
+            }
+        }
+
+        Py_DECREF(key);
+        Py_DECREF(event);
+        return output;
+    }
+    return NULL;
+}
+
+static int
+Serializer_traverse(SerializerObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->stream);
+    Py_VISIT(self->cache);
+    Py_VISIT(self->other);
+    Py_VISIT(self->emit);
+    Py_VISIT(self->boolean_attrs);
+    Py_VISIT(self->empty_elems);
+    Py_VISIT(self->noescape_elems);
+    Py_VISIT(self->start);
+    Py_VISIT(self->end);
+    Py_VISIT(self->text);
+    Py_VISIT(self->empty);
+    return 0;
+}
+
+static int
+Serializer_clear(SerializerObject *self)
+{
+    Py_CLEAR(self->stream);
+    Py_CLEAR(self->cache);
+    Py_CLEAR(self->other);
+    Py_CLEAR(self->emit);
+    Py_CLEAR(self->boolean_attrs);
+    Py_CLEAR(self->empty_elems);
+    Py_CLEAR(self->noescape_elems);
+    Py_CLEAR(self->start);
+    Py_CLEAR(self->end);
+    Py_CLEAR(self->text);
+    Py_CLEAR(self->empty);
+    return 0;
+}
+
+static void
+Serializer_dealloc(SerializerObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Serializer_clear(self);
+    PyObject_GC_Del(self);
+}
+
+PyTypeObject SerializerType = {
+#ifdef IS_PY3K
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "genshi._speedups.Serializer",
+    sizeof(SerializerObject),
+    0,                                  /*tp_itemsize*/
+    (destructor) Serializer_dealloc,    /*tp_dealloc*/
+    0,                                  /*tp_print*/
+    0,                                  /*tp_getattr*/
+    0,                                  /*tp_setattr*/
+    0,                                  /*tp_compare*/
+    0,                                  /*tp_repr*/
+    0,                                  /*tp_as_number*/
+    0,                                  /*tp_as_sequence*/
+    0,                                  /*tp_as_mapping*/
+    0,                                  /*tp_hash */
+    0,                                  /*tp_call*/
+    0,                                  /*tp_str*/
+    0,                                  /*tp_getattro*/
+    0,                                  /*tp_setattro*/
+    0,                                  /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /*tp_flags*/
+    0,                                  /*tp_doc*/
+    (traverseproc) Serializer_traverse, /*tp_traverse*/
+    (inquiry) Serializer_clear,         /*tp_clear*/
+    0,                                  /*tp_richcompare*/
+    0,                                  /*tp_weaklistoffset*/
+    PyObject_SelfIter,                  /*tp_iter*/
+    (iternextfunc) Serializer_next,     /*tp_iternext*/
+};
+
+PyDoc_STRVAR(serialize__doc__,
+"serialize(stream, mode, state, cache, other, emit, boolean_attrs,\n\
+          empty_elems, noescape_elems, START, END, TEXT, EMPTY)\n\
+\n\
+Return an iterator over the output of serializing the given stream, like\n\
+the `_serialize()` method of the `XMLSerializer` (mode 0),\n\
+`XHTMLSerializer` (mode 1) or `HTMLSerializer` (mode 2) classes, starting\n\
+in the given state.\n\
+\n\
+The `cache` is a dictionary of the output by ``(kind, data)`` tuples, or\n\
+`None` if output should not be cached. If it is not exactly a `dict`,\n\
+output is stored in it by calling ``emit(kind, data, output)``. Events of\n\
+kinds other than `START`, `END`, `TEXT` and `EMPTY` are serialized by\n\
+calling ``other(kind, data, state, emit)``, which returns the output (or\n\
+`None`) and the new state.\n\
+");
+
+static PyObject *
+serialize(PyObject *module, PyObject *args)
+{
+    SerializerObject *self;
+    PyObject *stream, *cache, *other, *emit, *boolean_attrs, *empty_elems;
+    PyObject *noescape_elems, *start, *end, *text, *empty_;
+    int mode, state;
+
+    if (!PyArg_ParseTuple(args, "OiiOOOOOOOOOO:serialize", &stream, &mode,
+                          &state, &cache, &other, &emit, &boolean_attrs,
+                          &empty_elems, &noescape_elems, &start, &end, &text,
+                          &empty_)) {
+        return NULL;
+    }
+    if (mode < MODE_XML || mode > MODE_HTML) {
+        PyErr_SetString(PyExc_ValueError, "invalid serialization mode");
+        return NULL;
+    }
+    stream = PyObject_GetIter(stream);
+    if (stream == NULL) {
+        return NULL;
+    }
+    self = PyObject_GC_New(SerializerObject, &SerializerType);
+    if (self == NULL) {
+        Py_DECREF(stream);
+        return NULL;
+    }
+    self->stream = stream;
+    self->mode = mode;
+    self->state = state;
+#define SET_MEMBER(name) Py_INCREF(name); self->name = name
+    SET_MEMBER(cache);
+    SET_MEMBER(other);
+    SET_MEMBER(emit);
+    SET_MEMBER(boolean_attrs);
+    SET_MEMBER(empty_elems);
+    SET_MEMBER(noescape_elems);
+    SET_MEMBER(start);
+    SET_MEMBER(end);
+    SET_MEMBER(text);
+#undef SET_MEMBER
+    Py_INCREF(empty_);
+    self->empty = empty_;
+    PyObject_GC_Track(self);
+    return (PyObject *) self;
+}
+
+static PyMethodDef module_methods[] = {
+    {"serialize", (PyCFunction) serialize, METH_VARARGS, serialize__doc__},
+    {NULL, NULL, 0, NULL}
+};
+
 #ifdef IS_PY3K
 struct PyModuleDef module_def = {
     PyModuleDef_HEAD_INIT, /*m_base*/
     "_speedups",           /*m_name*/
     NULL,                  /*m_doc*/
     -1,                    /*m_size*/
-    NULL,                  /*m_methods*/
+    module_methods,        /*m_methods*/
     NULL,                  /*m_reload*/
     NULL,                  /*m_traverse*/
     NULL,                  /*m_clear*/
@@ -675,7 +1301,7 @@ init_speedups(void)
         <http://www.python.it/faq/faq-3.html#3.24> */
     MarkupType.tp_base = &PyUnicode_Type;
 
-    if (PyType_Ready(&MarkupType) < 0)
+    if (PyType_Ready(&MarkupType) < 0 || PyType_Ready(&SerializerType) < 0)
 #ifdef IS_PY3K
         return NULL;
 #else
@@ -687,7 +1313,7 @@ init_speedups(void)
 #ifdef IS_PY3K
     module = PyModule_Create(&module_def);
 #else
-    module = Py_InitModule("_speedups", NULL);
+    module = Py_InitModule("_speedups", module_methods);
 #endif
     Py_INCREF(&MarkupType);
     PyModule_AddObject(module, "Markup", (PyObject *) &MarkupType);
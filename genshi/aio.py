@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Support for rendering streams in applications based on `asyncio`.
+
+Stream processing in Genshi is synchronous, so streams are rendered
+asynchronously by serializing them in a thread of an executor, while the
+encoded output is delivered to the event loop as an asynchronous iterator over
+chunks. Templates generated with `Template.generate_async` can use awaitable
+objects (such as coroutines or futures) in expressions, and asynchronous
+iterables in ``py:for`` loops: the rendering thread waits for them to be
+completed by the event loop, so that the loop itself is never blocked.
+
+This module requires Python 3.5 or later.
+"""
+
+from __future__ import absolute_import
+
+try:
+    import asyncio
+    import concurrent.futures
+    from inspect import isawaitable
+except ImportError:
+    asyncio = None
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from genshi.template.base import Context
+
+__all__ = ['AsyncContext', 'render_async']
+__docformat__ = 'restructuredtext en'
+
+_local = threading.local()
+
+
+def render_async(stream, method=None, encoding='utf-8', chunk_size=8192,
+                 executor=None, **kwargs):
+    """Return an asynchronous iterator over chunks of the serialized stream.
+    
+    The stream is serialized in a thread of the given `executor`, one chunk
+    at a time as the iterator is consumed, for example:
+    
+      async for chunk in render_async(stream, 'html'):
+          await response.write(chunk)
+    
+    Any additional keyword arguments are passed to the serializer, and thus
+    depend on the `method` parameter value.
+    
+    :param stream: the `Stream` to render
+    :param method: determines how the stream is serialized; can be either
+                   "xml", "xhtml", "html", "text", or a custom serializer
+                   class; if `None`, the default serialization method of
+                   the stream is used
+    :param encoding: how the output should be encoded; if set to `None`, the
+                     chunks are `unicode` objects
+    :param chunk_size: the minimum number of characters in a chunk; only the
+                       last chunk may be shorter
+    :param executor: the `concurrent.futures.Executor` used to serialize the
+                     stream, or `None` to use the default executor of the
+                     event loop
+    :return: an asynchronous iterator over `bytes` or `str` objects
+             (depending on the `encoding` parameter)
+    """
+    _check()
+    return _AsyncIterator(stream.render_iter(method, encoding=encoding,
+                                             chunk_size=chunk_size, **kwargs),
+                          executor)
+
+
+def resolve(value):
+    """Resolve an awaitable or asynchronously iterable value produced by a
+    template expression.
+    
+    Awaitable objects are scheduled on the event loop the stream is being
+    rendered for, and replaced by their result, while asynchronous iterables
+    are replaced by an iterator over the same items. Other values are returned
+    unchanged.
+    
+    :param value: the result of evaluating an expression
+    :return: the resolved value
+    """
+    if isawaitable(value):
+        return _wait(lambda: value)
+    elif hasattr(value, '__aiter__') and not hasattr(value, '__iter__'):
+        return _iterate(value)
+    return value
+
+
+class AsyncContext(Context):
+    """Template context that resolves awaitable objects and asynchronous
+    iterables in the data and in the results of expressions.
+    
+    Values in the data are resolved when they are first looked up, and
+    replaced by the result, so that for example a coroutine is only awaited
+    once even if it is used in several expressions.
+    
+    :see: `resolve`
+    """
+
+    def get(self, key, default=None):
+        value, frame = self._find(key)
+        if frame is None:
+            return default
+        resolved = resolve(value)
+        if resolved is not value:
+            frame[key] = resolved
+        return resolved
+
+    def _resolve(self, value):
+        return resolve(value)
+
+
+def _check():
+    if asyncio is None:
+        raise NotImplementedError('asynchronous rendering requires Python 3.5 '
+                                  'or later')
+
+
+def _loop():
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        raise RuntimeError('awaitable values in templates are only supported '
+                           'when the stream is rendered with render_async()')
+    return loop
+
+
+def _wait(function):
+    """Wait in the rendering thread for the event loop to complete the
+    awaitable returned by the given function, which is also called in the
+    event loop, and return its result.
+    """
+    loop = _loop()
+    done = concurrent.futures.Future()
+    def _copy(future):
+        if future.cancelled():
+            done.cancel()
+        elif future.exception() is not None:
+            done.set_exception(future.exception())
+        else:
+            done.set_result(future.result())
+    def _schedule():
+        try:
+            future = asyncio.ensure_future(function(), loop=loop)
+        except Exception, e:
+            done.set_exception(e)
+        else:
+            future.add_done_callback(_copy)
+    loop.call_soon_threadsafe(_schedule)
+    return done.result()
+
+
+def _iterate(aiterable):
+    iterator = aiterable.__aiter__()
+    while 1:
+        try:
+            item = _wait(iterator.__anext__)
+        except StopAsyncIteration:
+            break
+        yield item
+
+
+class _AsyncIterator(object):
+    """Asynchronous iterator that produces the items of a regular iterator in
+    a thread of an executor.
+    """
+
+    def __init__(self, iterator, executor=None):
+        self.iterator = iterator
+        self.executor = executor
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, self._next, loop)
+
+    def _next(self, loop):
+        _local.loop = loop
+        try:
+            try:
+                return next(self.iterator)
+            except StopIteration:
+                # StopIteration can not be passed through a future
+                raise StopAsyncIteration
+        finally:
+            _local.loop = None
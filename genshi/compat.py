@@ -72,22 +72,31 @@ else:
 
 if IS_PYTHON2:
     def get_code_params(code):
-        return (code.co_nlocals, code.co_stacksize, code.co_flags,
-                code.co_code, code.co_consts, code.co_names, code.co_varnames,
-                code.co_filename, code.co_name, code.co_firstlineno,
-                code.co_lnotab, (), ())
+        return (code.co_argcount, code.co_nlocals, code.co_stacksize,
+                code.co_flags, code.co_code, code.co_consts, code.co_names,
+                code.co_varnames, code.co_filename, code.co_name,
+                code.co_firstlineno, code.co_lnotab, code.co_freevars,
+                code.co_cellvars)
 
     def build_code_chunk(code, filename, name, lineno):
         return CodeType(0, code.co_nlocals, code.co_stacksize,
                         code.co_flags | 0x0040, code.co_code, code.co_consts,
                         code.co_names, code.co_varnames, filename, name,
                         lineno, code.co_lnotab, (), ())
+
+    def build_function_code(code, filename, name, lineno):
+        return CodeType(code.co_argcount, code.co_nlocals, code.co_stacksize,
+                        code.co_flags, code.co_code, code.co_consts,
+                        code.co_names, code.co_varnames, filename, name,
+                        lineno, code.co_lnotab, code.co_freevars,
+                        code.co_cellvars)
 else:
     def get_code_params(code):
-        return (code.co_nlocals, code.co_kwonlyargcount, code.co_stacksize,
-                code.co_flags, code.co_code, code.co_consts, code.co_names,
-                code.co_varnames, code.co_filename, code.co_name,
-                code.co_firstlineno, code.co_lnotab, (), ())
+        return (code.co_argcount, code.co_kwonlyargcount, code.co_nlocals,
+                code.co_stacksize, code.co_flags, code.co_code,
+                code.co_consts, code.co_names, code.co_varnames,
+                code.co_filename, code.co_name, code.co_firstlineno,
+                code.co_lnotab, code.co_freevars, code.co_cellvars)
 
     def build_code_chunk(code, filename, name, lineno):
         return CodeType(0, code.co_nlocals, code.co_kwonlyargcount,
@@ -96,6 +105,13 @@ else:
                         code.co_varnames, filename, name, lineno,
                         code.co_lnotab, (), ())
 
+    def build_function_code(code, filename, name, lineno):
+        return CodeType(code.co_argcount, code.co_kwonlyargcount,
+                        code.co_nlocals, code.co_stacksize, code.co_flags,
+                        code.co_code, code.co_consts, code.co_names,
+                        code.co_varnames, filename, name, lineno,
+                        code.co_lnotab, code.co_freevars, code.co_cellvars)
+
 # Compatibility fallback implementations for Python < 2.6
 
 try:
@@ -154,7 +154,8 @@ class Stream(object):
         """
         return reduce(operator.or_, (self,) + filters)
 
-    def render(self, method=None, encoding=None, out=None, **kwargs):
+    def render(self, method=None, encoding=None, out=None, buffer_size=None,
+               compress=None, compresslevel=6, **kwargs):
         """Return a string representation of the stream.
         
         Any additional keyword arguments are passed to the serializer, and thus
@@ -167,21 +168,117 @@ class Stream(object):
         :param encoding: how the output string should be encoded; if set to
                          `None`, this method returns a `unicode` object
         :param out: a file-like object that the output should be written to
-                    instead of being returned as one big string; note that if
-                    this is a file or socket (or similar), the `encoding` must
-                    not be `None` (that is, the output must be encoded)
+                    instead of being returned as one big string, or a
+                    `bytearray` that the encoded output is appended to; note
+                    that if this is a file or socket (or similar), the
+                    `encoding` must not be `None` (that is, the output must be
+                    encoded)
+        :param buffer_size: if given, the output is written to `out` in chunks
+                            of at least this many characters, instead of
+                            writing every piece of output separately
+        :param compress: if given, the encoded output is compressed in this
+                         format, which is either "gzip" or "deflate"
+        :param compresslevel: the compression level, from 1 (fastest) to 9
+                              (best compression)
         :return: a `str` or `unicode` object (depending on the `encoding`
                  parameter), or `None` if the `out` parameter is provided
         :rtype: `basestring`
         
         :see: XMLSerializer, XHTMLSerializer, HTMLSerializer, TextSerializer
         :note: Changed in 0.5: added the `out` parameter
+        :note: Changed in 0.8: added the `buffer_size`, `compress` and
+               `compresslevel` parameters, and `out` can be a `bytearray`
         """
         from genshi.output import encode
         if method is None:
             method = self.serializer or 'xml'
         generator = self.serialize(method=method, **kwargs)
-        return encode(generator, method=method, encoding=encoding, out=out)
+        return encode(generator, method=method, encoding=encoding, out=out,
+                      buffer_size=buffer_size, compress=compress,
+                      compresslevel=compresslevel)
+
+    def render_iter(self, method=None, encoding='utf-8', chunk_size=8192,
+                    compress=None, compresslevel=6, **kwargs):
+        """Return an iterator over the string representation of the stream,
+        split into chunks.
+        
+        The stream is serialized lazily as the iterator is consumed, so the
+        result can be used to stream large documents, for example as the
+        response body of a WSGI application.
+        
+        >>> from genshi.input import XML
+        >>> stream = XML('<doc><elem>foo</elem><elem>bar</elem></doc>')
+        >>> for chunk in stream.render_iter(encoding=None, chunk_size=16):
+        ...     print(chunk)
+        <doc><elem>foo</elem>
+        <elem>bar</elem>
+        </doc>
+        
+        Any additional keyword arguments are passed to the serializer, and thus
+        depend on the `method` parameter value.
+        
+        :param method: determines how the stream is serialized; can be either
+                       "xml", "xhtml", "html", "text", or a custom serializer
+                       class; if `None`, the default serialization method of
+                       the stream is used
+        :param encoding: how the output should be encoded; if set to `None`,
+                         the chunks are `unicode` objects
+        :param chunk_size: the minimum number of characters in a chunk; only
+                           the last chunk may be shorter
+        :param compress: if given, the encoded output is compressed in this
+                         format, which is either "gzip" or "deflate"; chunks
+                         of compressed output are produced whenever the
+                         compressor has enough data
+        :param compresslevel: the compression level, from 1 (fastest) to 9
+                              (best compression)
+        :return: an iterator over `str` or `unicode` objects (depending on the
+                 `encoding` parameter)
+        
+        :see: XMLSerializer, XHTMLSerializer, HTMLSerializer, TextSerializer
+        :since: version 0.8
+        """
+        from genshi.output import iterencode
+        if method is None:
+            method = self.serializer or 'xml'
+        generator = self.serialize(method=method, **kwargs)
+        return iterencode(generator, method=method, encoding=encoding,
+                          chunk_size=chunk_size, compress=compress,
+                          compresslevel=compresslevel)
+
+    def render_async(self, method=None, encoding='utf-8', chunk_size=8192,
+                     executor=None, **kwargs):
+        """Return an asynchronous iterator over the string representation of
+        the stream, split into chunks.
+        
+        The stream is serialized in a thread of the given executor as the
+        iterator is consumed, so that the event loop is not blocked:
+        
+          async for chunk in stream.render_async('html'):
+              await response.write(chunk)
+        
+        This method requires Python 3.5 or later. Any additional keyword
+        arguments are passed to the serializer, and thus depend on the `method`
+        parameter value.
+        
+        :param method: determines how the stream is serialized; can be either
+                       "xml", "xhtml", "html", "text", or a custom serializer
+                       class; if `None`, the default serialization method of
+                       the stream is used
+        :param encoding: how the output should be encoded; if set to `None`,
+                         the chunks are `unicode` objects
+        :param chunk_size: the minimum number of characters in a chunk; only
+                           the last chunk may be shorter
+        :param executor: the `concurrent.futures.Executor` to serialize the
+                         stream in, or `None` to use the default executor of
+                         the event loop
+        :return: an asynchronous iterator over encoded chunks
+        
+        :see: `genshi.aio`, `Template.generate_async`
+        :since: version 0.8
+        """
+        from genshi.aio import render_async
+        return render_async(self, method=method, encoding=encoding,
+                            chunk_size=chunk_size, executor=executor, **kwargs)
 
     def select(self, path, namespaces=None, variables=None):
         """Return a new stream that contains the events matching the given
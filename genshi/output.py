@@ -17,17 +17,29 @@ streams.
 
 from itertools import chain
 import re
+import zlib
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
 from genshi.core import escape, Attrs, Markup, Namespace, QName, StreamEventKind
 from genshi.core import START, END, TEXT, XML_DECL, DOCTYPE, START_NS, END_NS, \
                         START_CDATA, END_CDATA, PI, COMMENT, XML_NAMESPACE
-
-__all__ = ['encode', 'get_serializer', 'DocType', 'XMLSerializer',
-           'XHTMLSerializer', 'HTMLSerializer', 'TextSerializer']
+from genshi.util import LRUCache
+try:
+    from genshi._speedups import serialize as _speedups_serialize
+except ImportError:
+    _speedups_serialize = None # just use the Python implementation
+
+__all__ = ['encode', 'iterencode', 'get_serializer', 'DocType',
+           'XMLSerializer', 'XHTMLSerializer', 'HTMLSerializer',
+           'TextSerializer', 'StaticRun', 'TagCache']
 __docformat__ = 'restructuredtext en'
 
 
-def encode(iterator, method='xml', encoding=None, out=None):
+def encode(iterator, method='xml', encoding=None, out=None,
+           buffer_size=None, compress=None, compresslevel=6):
     """Encode serializer output into a string.
     
     :param iterator: the iterator returned from serializing a stream (basically
@@ -37,26 +49,163 @@ def encode(iterator, method='xml', encoding=None, out=None):
     :param encoding: how the output string should be encoded; if set to `None`,
                      this method returns a `unicode` object
     :param out: a file-like object that the output should be written to
-                instead of being returned as one big string; note that if
-                this is a file or socket (or similar), the `encoding` must
+                instead of being returned as one big string, or a
+                `bytearray` that the encoded output is appended to; note that
+                if this is a file or socket (or similar), the `encoding` must
                 not be `None` (that is, the output must be encoded)
+    :param buffer_size: if given, the serializer output is collected into
+                        chunks of at least this many characters, each of which
+                        is encoded and written to `out` at once, instead of
+                        writing every piece of output separately
+    :param compress: if given, the encoded output is compressed in this
+                     format, which is either "gzip" or "deflate" (the zlib
+                     format, as used by the HTTP "deflate" content coding)
+    :param compresslevel: the compression level, from 1 (fastest) to 9 (best
+                          compression)
     :return: a `str` or `unicode` object (depending on the `encoding`
              parameter), or `None` if the `out` parameter is provided
     
+    To avoid copying the encoded output into a string, pass a `bytearray` as
+    the `out` parameter instead.
+    
     :since: version 0.4.1
     :note: Changed in 0.5: added the `out` parameter
+    :note: Changed in 0.8: added the `buffer_size`, `compress` and
+           `compresslevel` parameters, and `out` can be a `bytearray`
+    """
+    _encode = _encoder(method, encoding, compress, compresslevel)
+    if out is None:
+        if encoding is None:
+            return ''.join(list(iterator))
+        # Encode the output chunk by chunk, so that it is never held in memory
+        # as one unicode string; joining the encoded chunks into the returned
+        # string still copies them once
+        chunks = []
+        write = chunks.append
+        buffer_size = buffer_size or _CHUNK_SIZE
+    elif isinstance(out, bytearray):
+        write = out.extend
+        buffer_size = buffer_size or _CHUNK_SIZE
+    else:
+        write = out.write
+    if compress:
+        buffer_size = buffer_size or _CHUNK_SIZE
+    if buffer_size:
+        iterator = _buffer(iterator, buffer_size)
+    for chunk in iterator:
+        chunk = _encode(chunk)
+        if chunk or not compress:
+            write(chunk)
+    if compress:
+        write(_encode.flush())
+    if out is None:
+        return bytes().join(chunks)
+
+
+# The number of characters encoded at once when the output is not written to a
+# file-like object
+_CHUNK_SIZE = 8192
+
+
+def iterencode(iterator, method='xml', encoding='utf-8', chunk_size=8192,
+               compress=None, compresslevel=6):
+    """Encode serializer output into an iterator over chunks of encoded
+    output.
+    
+    The serializer output is collected into chunks of at least `chunk_size`
+    characters, which are encoded as a whole. The result can be returned
+    directly from a WSGI application, for example.
+    
+    >>> from genshi.input import XML
+    >>> stream = XML('<doc><elem>Foo</elem><elem>Bar</elem></doc>')
+    >>> for chunk in iterencode(stream.serialize(), encoding=None,
+    ...                         chunk_size=10):
+    ...     print(chunk)
+    <doc><elem>
+    Foo</elem>
+    <elem>Bar</elem>
+    </doc>
+    
+    :param iterator: the iterator returned from serializing a stream (basically
+                     any iterator that yields unicode objects)
+    :param method: the serialization method; determines how characters not
+                   representable in the specified encoding are treated
+    :param encoding: how the output should be encoded; if set to `None`, the
+                     chunks are `unicode` objects
+    :param chunk_size: the minimum number of characters in a chunk; only the
+                       last chunk may be shorter
+    :param compress: if given, the encoded output is compressed in this
+                     format, which is either "gzip" or "deflate"; the
+                     compressed output is produced whenever the compressor
+                     has enough data, so chunks do not correspond to
+                     `chunk_size` characters of output
+    :param compresslevel: the compression level, from 1 (fastest) to 9 (best
+                          compression)
+    :return: an iterator over `str` or `unicode` objects (depending on the
+             `encoding` parameter)
+    
+    :since: version 0.8
+    """
+    _encode = _encoder(method, encoding, compress, compresslevel)
+    for chunk in _buffer(iterator, chunk_size):
+        chunk = _encode(chunk)
+        if chunk or not compress:
+            yield chunk
+    if compress:
+        yield _encode.flush()
+
+
+def _encoder(method, encoding, compress=None, compresslevel=6):
+    """Return a function that encodes serializer output using the given
+    encoding.
+    
+    If the output is compressed, the function has a `flush` attribute, which
+    is a function returning the remaining compressed output.
     """
     if encoding is not None:
         errors = 'replace'
         if method != 'text' and not isinstance(method, TextSerializer):
             errors = 'xmlcharrefreplace'
-        _encode = lambda string: string.encode(encoding, errors)
-    else:
-        _encode = lambda string: string
-    if out is None:
-        return _encode(''.join(list(iterator)))
-    for chunk in iterator:
-        out.write(_encode(chunk))
+        if compress:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                          _compress_wbits(compress))
+            def _encode(string):
+                return compressor.compress(string.encode(encoding, errors))
+            _encode.flush = compressor.flush
+            return _encode
+        return lambda string: string.encode(encoding, errors)
+    if compress:
+        raise ValueError('output can only be compressed if it is encoded')
+    return lambda string: string
+
+
+def _compress_wbits(compress):
+    """Return the `wbits` argument of `zlib.compressobj()` producing output in
+    the given compression format.
+    """
+    if compress == 'gzip':
+        return 16 + zlib.MAX_WBITS
+    elif compress == 'deflate':
+        return zlib.MAX_WBITS
+    raise ValueError('unknown compression format %r' % compress)
+
+
+def _buffer(iterator, size):
+    """Join the strings produced by the iterator into chunks of at least the
+    given number of characters.
+    """
+    buf = []
+    append = buf.append
+    length = 0
+    for string in iterator:
+        append(string)
+        length += len(string)
+        if length >= size:
+            yield ''.join(buf)
+            del buf[:]
+            length = 0
+    if buf:
+        yield ''.join(buf)
 
 
 def get_serializer(method='xml', **kwargs):
@@ -79,23 +228,36 @@ def get_serializer(method='xml', **kwargs):
     return method(**kwargs)
 
 
-def _prepare_cache(use_cache=True):
+def _prepare_cache(use_cache=True, owner=None):
     """Prepare a private token serialization cache.
 
     :param use_cache: boolean indicating whether a real cache should
                       be used or not. If not, the returned functions
-                      are no-ops.
+                      are no-ops. May also be a `TagCache`, which is then
+                      used for the serialized tags.
+    :param owner: the serializer class, used to tell apart the output of
+                  different serializers stored in a shared `TagCache`
 
     :return: emit and get functions, for storing and retrieving
              serialized values from the cache.
     """
-    cache = {}
-    if use_cache:
+    if isinstance(use_cache, TagCache):
+        cache = _SharedCache(use_cache, owner)
+        shared = use_cache
+        def _emit(kind, input, output):
+            cache[kind, input] = output
+            if kind is START or kind is END or kind is EMPTY:
+                shared.put((owner, kind, input), output)
+            return output
+        _get = cache.__getitem__
+    elif use_cache:
+        cache = {}
         def _emit(kind, input, output):
             cache[kind, input] = output
             return output
         _get = cache.get
     else:
+        cache = {}
         def _emit(kind, input, output):
             return output
         def _get(key):
@@ -103,6 +265,195 @@ def _prepare_cache(use_cache=True):
     return _emit, _get, cache
 
 
+class TagCache(object):
+    """Cache of serialized start and end tags that is shared by serializers,
+    so that tags found in the output of many renders are only serialized
+    once.
+    
+    An instance is passed as the `cache` argument of a serializer, usually
+    through the `Stream.render()` method:
+    
+    >>> from genshi.builder import tag
+    >>> cache = TagCache(capacity=100)
+    >>> for idx in range(2):
+    ...     print(tag.td(idx, class_='cell').generate().render('html',
+    ...                                                        cache=cache))
+    <td class="cell">0</td>
+    <td class="cell">1</td>
+    >>> len(cache)
+    2
+    
+    The number of tags kept is limited, and the tags that have not been used
+    for the longest time are dropped when that limit is reached. The cache
+    can be used by serializers in multiple threads at once. Text and other
+    events are still only cached for the duration of a single render.
+    
+    :since: version 0.8
+    """
+
+    def __init__(self, capacity=10000):
+        """Create the cache.
+        
+        :param capacity: the maximum number of tags to keep
+        """
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __nonzero__(self):
+        return True
+
+    def get(self, key):
+        """Return the serialized output stored under the given key, or `None`.
+        
+        This does not wait for other threads using the cache.
+        """
+        output = self._cache.peek(key)
+        if output is not None and self._lock.acquire(False):
+            # Mark the tag as recently used, unless another thread is
+            # currently modifying the cache
+            try:
+                try:
+                    self._cache[key]
+                except KeyError:
+                    pass
+            finally:
+                self._lock.release()
+        return output
+
+    def put(self, key, output):
+        """Store serialized output under the given key."""
+        self._lock.acquire()
+        try:
+            self._cache[key] = output
+        finally:
+            self._lock.release()
+
+
+class _SharedCache(dict):
+    """The serialization cache of a single render, which looks up tags that
+    are not cached yet in a `TagCache`.
+    """
+    __slots__ = ['shared', 'owner']
+
+    def __init__(self, shared, owner):
+        self.shared = shared
+        self.owner = owner
+
+    def __missing__(self, key):
+        kind = key[0]
+        if kind is START or kind is END or kind is EMPTY:
+            output = self.shared.get((self.owner,) + key)
+            if output is not None:
+                self[key] = output
+            return output
+
+
+class StaticRun(object):
+    """A sequence of markup events that does not depend on any template data.
+    
+    Templates replace such sequences by a single `STATIC` event with an
+    instance of this class as data. As long as the sequence is balanced (that
+    is, it starts with a `START` event and ends with the corresponding `END`
+    event), the output filters and serializers can process the events once
+    and then reuse the result every time the run is encountered again.
+    
+    >>> from genshi.input import XML
+    >>> run = StaticRun(list(XML('<p>Hello, <b>world</b>!</p>')))
+    >>> events = [(STATIC, run, (None, -1, -1))]
+    >>> print(''.join(XMLSerializer()(events)))
+    <p>Hello, <b>world</b>!</p>
+    
+    Iterating over a run produces the original events:
+    
+    >>> for kind, data, pos in run:
+    ...     print('%s %r' % (kind, data))
+    START (QName('p'), Attrs())
+    TEXT u'Hello, '
+    START (QName('b'), Attrs())
+    TEXT u'world'
+    END QName('b')
+    TEXT u'!'
+    END QName('p')
+    """
+    __slots__ = ['events', 'namespaces', '_derived']
+
+    def __init__(self, events):
+        """Create the run.
+        
+        :param events: the list of events
+        """
+        self.events = events
+        namespaces = set()
+        for kind, data, pos in events:
+            if kind is START or kind is EMPTY:
+                tag, attrs = data
+                namespaces.add(getattr(tag, 'namespace', None))
+                for name, value in attrs:
+                    namespaces.add(getattr(name, 'namespace', None))
+        namespaces.discard(None)
+        self.namespaces = tuple(namespaces)
+        self._derived = {}
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __repr__(self):
+        return '<%s (%d events)>' % (type(self).__name__, len(self.events))
+
+    def derive(self, key, function):
+        """Return the result of calling ``function`` with the list of events
+        of this run, caching it under the given key.
+        
+        :param key: a hashable object identifying the processing performed by
+                    the function, including any state it depends on
+        :param function: the function that processes the events
+        """
+        try:
+            return self._derived[key]
+        except KeyError:
+            result = self._derived[key] = function(self.events)
+            return result
+
+
+class _StaticText(unicode):
+    """Text of a template that does not depend on the context data, which
+    also provides the text with ignorable white space stripped, as done by the
+    `WhitespaceFilter` outside of elements preserving white space.
+    """
+    __slots__ = ['stripped']
+
+    def __new__(cls, text):
+        self = unicode.__new__(cls, text)
+        self.stripped = _collapse_lines('\n', _trim_trailing_space('', text))
+        return self
+
+    def __getnewargs__(self):
+        return (unicode(self),)
+
+
+STATIC = StreamEventKind('STATIC')
+
+# Flags making up the state of the serialization loops
+_VERBATIM = 1 # text is not escaped (in CDATA sections, or script elements)
+_HAVE_DECL = 2 # the XML declaration has been written
+_HAVE_DOCTYPE = 4 # the DOCTYPE declaration has been written
+
+
+def _expand_static(stream):
+    """Replace any `STATIC` events in the stream by the events of the
+    corresponding runs.
+    """
+    for event in stream:
+        if event[0] is STATIC:
+            for event in event[1].events:
+                yield event
+        else:
+            yield event
+
+
 class DocType(object):
     """Defines a number of commonly used DOCTYPE declarations as constants."""
 
@@ -215,9 +566,12 @@ class XMLSerializer(object):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; if this is
+                      a `TagCache`, serialized tags are also stored in and
+                      looked up from that cache
         :note: Changed in 0.4.2: The  `doctype` parameter can now be a string.
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.8: The `cache` parameter accepts a `TagCache`
         """
         self.filters = [EmptyTagFilter()]
         if strip_whitespace:
@@ -229,15 +583,49 @@ class XMLSerializer(object):
         self.cache = cache
 
     def _prepare_cache(self):
-        return _prepare_cache(self.cache)[:2]
+        return _prepare_cache(self.cache, type(self))[:2]
 
     def __call__(self, stream):
-        have_decl = have_doctype = False
-        in_cdata = False
+        filters = _standard_filters(self.filters)
+        if filters is not None:
+            stream = _apply_filters(stream, *filters)
+        else:
+            for filter_ in self.filters:
+                stream = filter_(stream)
+        return self._serialize_events(stream)
+
+    def _serialize_events(self, stream, *state):
+        """Serialize the given stream, using the C implementation of the
+        serialization loop if it is available and `_serialize()` has not been
+        overridden in a subclass.
+        """
+        mode = _speedups_serialize and _SPEEDUPS_MODES.get(type(self)._serialize)
+        if mode is None:
+            return self._serialize(stream, *state)
+        _emit, _get, cache = _prepare_cache(self.cache, type(self))
+        if not self.cache:
+            cache = None
+        return _speedups_serialize(
+            stream, mode, state and state[0] and _VERBATIM or 0, cache,
+            self._serialize_other, _emit,
+            getattr(self, '_BOOLEAN_ATTRS', None),
+            getattr(self, '_EMPTY_ELEMS', None),
+            getattr(self, '_NOESCAPE_ELEMS', None),
+            START, END, TEXT, EMPTY
+        )
+
+    def _serialize_static(self, run, *state):
+        """Return the serialized output for a `StaticRun`, given the state of
+        the serializer at the point the run is encountered.
+        """
+        return run.derive((type(self),) + state, lambda events: Markup(
+            ''.join(self._serialize_events(events, *state))
+        ))
+
+    def _serialize(self, stream, in_cdata=False):
+        state = in_cdata and _VERBATIM or 0
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -257,49 +645,67 @@ class XMLSerializer(object):
                 yield _emit(kind, data, Markup('</%s>' % data))
 
             elif kind is TEXT:
-                if in_cdata:
+                if state & _VERBATIM:
                     yield _emit(kind, data, data)
                 else:
                     yield _emit(kind, data, escape(data, quotes=False))
 
-            elif kind is COMMENT:
-                yield _emit(kind, data, Markup('<!--%s-->' % data))
-
-            elif kind is XML_DECL and not have_decl:
-                version, encoding, standalone = data
-                buf = ['<?xml version="%s"' % version]
-                if encoding:
-                    buf.append(' encoding="%s"' % encoding)
-                if standalone != -1:
-                    standalone = standalone and 'yes' or 'no'
-                    buf.append(' standalone="%s"' % standalone)
-                buf.append('?>\n')
-                yield Markup(''.join(buf))
-                have_decl = True
-
-            elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
-                have_doctype = True
-
-            elif kind is START_CDATA:
-                yield Markup('<![CDATA[')
-                in_cdata = True
-
-            elif kind is END_CDATA:
-                yield Markup(']]>')
-                in_cdata = False
-
-            elif kind is PI:
-                yield _emit(kind, data, Markup('<?%s %s?>' % data))
+            else:
+                output, state = self._serialize_other(kind, data, state,
+                                                      _emit)
+                if output is not None:
+                    yield output
+
+    def _serialize_other(self, kind, data, state, _emit):
+        """Serialize an event of any kind other than `START`, `EMPTY`, `END`
+        and `TEXT`.
+        
+        :param state: the state of the serializer, a combination of the
+                      ``_VERBATIM``, ``_HAVE_DECL`` and ``_HAVE_DOCTYPE`` flags
+        :param _emit: the function storing output in the cache
+        :return: a ``(output, state)`` tuple of the output (or `None` if the
+                 event produces none) and the new state of the serializer
+        """
+        if kind is STATIC:
+            return self._serialize_static(data, bool(state & _VERBATIM)), state
+
+        elif kind is COMMENT:
+            return _emit(kind, data, Markup('<!--%s-->' % data)), state
+
+        elif kind is XML_DECL and not state & _HAVE_DECL:
+            version, encoding, standalone = data
+            buf = ['<?xml version="%s"' % version]
+            if encoding:
+                buf.append(' encoding="%s"' % encoding)
+            if standalone != -1:
+                standalone = standalone and 'yes' or 'no'
+                buf.append(' standalone="%s"' % standalone)
+            buf.append('?>\n')
+            return Markup(''.join(buf)), state | _HAVE_DECL
+
+        elif kind is DOCTYPE and not state & _HAVE_DOCTYPE:
+            name, pubid, sysid = data
+            buf = ['<!DOCTYPE %s']
+            if pubid:
+                buf.append(' PUBLIC "%s"')
+            elif sysid:
+                buf.append(' SYSTEM')
+            if sysid:
+                buf.append(' "%s"')
+            buf.append('>\n')
+            output = Markup(''.join(buf)) % tuple([p for p in data if p])
+            return output, state | _HAVE_DOCTYPE
+
+        elif kind is START_CDATA:
+            return Markup('<![CDATA['), state | _VERBATIM
+
+        elif kind is END_CDATA:
+            return Markup(']]>'), state & ~_VERBATIM
+
+        elif kind is PI:
+            return _emit(kind, data, Markup('<?%s %s?>' % data)), state
+
+        return None, state
 
 
 class XHTMLSerializer(XMLSerializer):
@@ -339,16 +745,12 @@ class XHTMLSerializer(XMLSerializer):
         self.drop_xml_decl = drop_xml_decl
         self.cache = cache
 
-    def __call__(self, stream):
+    def _serialize(self, stream, in_cdata=False):
         boolean_attrs = self._BOOLEAN_ATTRS
         empty_elems = self._EMPTY_ELEMS
-        drop_xml_decl = self.drop_xml_decl
-        have_decl = have_doctype = False
-        in_cdata = False
+        state = in_cdata and _VERBATIM or 0
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -381,49 +783,21 @@ class XHTMLSerializer(XMLSerializer):
                 yield _emit(kind, data, Markup('</%s>' % data))
 
             elif kind is TEXT:
-                if in_cdata:
+                if state & _VERBATIM:
                     yield _emit(kind, data, data)
                 else:
                     yield _emit(kind, data, escape(data, quotes=False))
 
-            elif kind is COMMENT:
-                yield _emit(kind, data, Markup('<!--%s-->' % data))
-
-            elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
-                have_doctype = True
-
-            elif kind is XML_DECL and not have_decl and not drop_xml_decl:
-                version, encoding, standalone = data
-                buf = ['<?xml version="%s"' % version]
-                if encoding:
-                    buf.append(' encoding="%s"' % encoding)
-                if standalone != -1:
-                    standalone = standalone and 'yes' or 'no'
-                    buf.append(' standalone="%s"' % standalone)
-                buf.append('?>\n')
-                yield Markup(''.join(buf))
-                have_decl = True
-
-            elif kind is START_CDATA:
-                yield Markup('<![CDATA[')
-                in_cdata = True
-
-            elif kind is END_CDATA:
-                yield Markup(']]>')
-                in_cdata = False
-
-            elif kind is PI:
-                yield _emit(kind, data, Markup('<?%s %s?>' % data))
+            else:
+                output, state = self._serialize_other(kind, data, state,
+                                                      _emit)
+                if output is not None:
+                    yield output
+
+    def _serialize_other(self, kind, data, state, _emit):
+        if kind is XML_DECL and self.drop_xml_decl:
+            return None, state
+        return XMLSerializer._serialize_other(self, kind, data, state, _emit)
 
 
 class HTMLSerializer(XHTMLSerializer):
@@ -449,8 +823,11 @@ class HTMLSerializer(XHTMLSerializer):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; if this is
+                      a `TagCache`, serialized tags are also stored in and
+                      looked up from that cache
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.8: The `cache` parameter accepts a `TagCache`
         """
         super(HTMLSerializer, self).__init__(doctype, False)
         self.filters = [EmptyTagFilter()]
@@ -462,18 +839,15 @@ class HTMLSerializer(XHTMLSerializer):
         }, cache=cache))
         if doctype:
             self.filters.append(DocTypeInserter(doctype))
-        self.cache = True
+        self.cache = cache
 
-    def __call__(self, stream):
+    def _serialize(self, stream, noescape=False):
         boolean_attrs = self._BOOLEAN_ATTRS
         empty_elems = self._EMPTY_ELEMS
         noescape_elems = self._NOESCAPE_ELEMS
-        have_doctype = False
-        noescape = False
+        state = noescape and _VERBATIM or 0
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, _ in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -483,9 +857,9 @@ class HTMLSerializer(XHTMLSerializer):
                 yield output
                 if (kind is START or kind is EMPTY) \
                         and data[0] in noescape_elems:
-                    noescape = True
+                    state |= _VERBATIM
                 elif kind is END:
-                    noescape = False
+                    state &= ~_VERBATIM
 
             elif kind is START or kind is EMPTY:
                 tag, attrib = data
@@ -505,36 +879,37 @@ class HTMLSerializer(XHTMLSerializer):
                         buf.append('</%s>' % tag)
                 yield _emit(kind, data, Markup(''.join(buf)))
                 if tag in noescape_elems:
-                    noescape = True
+                    state |= _VERBATIM
 
             elif kind is END:
                 yield _emit(kind, data, Markup('</%s>' % data))
-                noescape = False
+                state &= ~_VERBATIM
 
             elif kind is TEXT:
-                if noescape:
+                if state & _VERBATIM:
                     yield _emit(kind, data, data)
                 else:
                     yield _emit(kind, data, escape(data, quotes=False))
 
-            elif kind is COMMENT:
-                yield _emit(kind, data, Markup('<!--%s-->' % data))
+            else:
+                output, state = self._serialize_other(kind, data, state,
+                                                      _emit)
+                if output is not None:
+                    yield output
+
+    def _serialize_other(self, kind, data, state, _emit):
+        if kind is STATIC:
+            output = self._serialize_static(data, bool(state & _VERBATIM))
+            return output, state & ~_VERBATIM
+        elif kind is XML_DECL or kind is START_CDATA or kind is END_CDATA:
+            return None, state
+        return XHTMLSerializer._serialize_other(self, kind, data, state, _emit)
 
-            elif kind is DOCTYPE and not have_doctype:
-                name, pubid, sysid = data
-                buf = ['<!DOCTYPE %s']
-                if pubid:
-                    buf.append(' PUBLIC "%s"')
-                elif sysid:
-                    buf.append(' SYSTEM')
-                if sysid:
-                    buf.append(' "%s"')
-                buf.append('>\n')
-                yield Markup(''.join(buf)) % tuple([p for p in data if p])
-                have_doctype = True
 
-            elif kind is PI:
-                yield _emit(kind, data, Markup('<?%s %s?>' % data))
+# Serialization loops implemented by the C extension, by the modes it uses
+_SPEEDUPS_MODES = {XMLSerializer._serialize: 0,
+                   XHTMLSerializer._serialize: 1,
+                   HTMLSerializer._serialize: 2}
 
 
 class TextSerializer(object):
@@ -602,9 +977,15 @@ class EmptyTagFilter(object):
                 else:
                     yield prev
             if ev[0] is not START:
+                if ev[0] is STATIC:
+                    ev = STATIC, ev[1].derive((type(self),),
+                                              self._filter_static), ev[2]
                 yield ev
             prev = ev
 
+    def _filter_static(self, events):
+        return StaticRun(list(self(events)))
+
 
 EMPTY = EmptyTagFilter.EMPTY
 
@@ -636,9 +1017,43 @@ class NamespaceFlattener(object):
         self.cache = cache
 
     def __call__(self, stream):
+        # As long as no namespaces are involved, the names of elements and
+        # attributes are their local names, so the events can be passed
+        # through unchanged; static runs record their namespaces when they
+        # are created, so they need not be inspected here
+        stream = iter(stream)
+        for event in stream:
+            kind, data, pos = event
+            if kind is START or kind is EMPTY:
+                if data[0].namespace:
+                    break
+                for attr, value in data[1]:
+                    if attr.namespace:
+                        break
+                else:
+                    yield event
+                    continue
+                break
+            elif kind is END:
+                if data.namespace:
+                    break
+            elif kind is STATIC:
+                if data.namespaces:
+                    break
+            elif kind is START_NS or kind is END_NS:
+                break
+            yield event
+        else:
+            return
+        for event in self._flatten(chain([event], stream)):
+            yield event
+
+    def _flatten(self, stream):
         prefixes = dict([(v, [k]) for k, v in self.prefixes.items()])
         namespaces = {XML_NAMESPACE.uri: ['xml']}
-        _emit, _get, cache = _prepare_cache(self.cache)
+        # The flattened events depend on the namespaces in scope, so they are
+        # never stored in a shared cache
+        _emit, _get, cache = _prepare_cache(bool(self.cache))
         def _push_ns(prefix, uri):
             namespaces.setdefault(uri, []).append(prefix)
             prefixes.setdefault(prefix, []).append(uri)
@@ -668,7 +1083,41 @@ class NamespaceFlattener(object):
                 yield 'ns%d' % val
         _gen_prefix = _gen_prefix().next
 
-        for kind, data, pos in stream:
+        def _expand_unknown(stream):
+            # Static runs using namespaces that have not been declared are
+            # processed event by event, as new prefixes need to be generated
+            for event in stream:
+                if event[0] is STATIC and [uri for uri in event[1].namespaces
+                                           if uri not in namespaces]:
+                    for event in event[1].events:
+                        yield event
+                else:
+                    yield event
+
+        def _flatten_static(events):
+            pending = list(ns_attrs)
+            new_events = []
+            for kind, data, pos in events:
+                if kind is START or kind is EMPTY:
+                    tag, attrs = data
+                    new_attrs = pending
+                    pending = []
+                    for attr, value in attrs:
+                        new_attrs.append((_qname(attr), value))
+                    data = _qname(tag), Attrs(new_attrs)
+                elif kind is END:
+                    data = _qname(data)
+                new_events.append((kind, data, pos))
+            return StaticRun(new_events)
+
+        def _qname(name):
+            if name.namespace:
+                prefix = namespaces[name.namespace][-1]
+                if prefix:
+                    return '%s:%s' % (prefix, name.localname)
+            return name.localname
+
+        for kind, data, pos in _expand_unknown(stream):
             if kind is TEXT and isinstance(data, Markup):
                 yield kind, data, pos
                 continue
@@ -733,10 +1182,21 @@ class NamespaceFlattener(object):
                         if attr in ns_attrs:
                             ns_attrs.remove(attr)
 
+            elif kind is STATIC:
+                key = (type(self), tuple(ns_attrs)) + tuple([
+                    namespaces[uri][-1] for uri in data.namespaces
+                ])
+                yield kind, data.derive(key, _flatten_static), pos
+                del ns_attrs[:]
+
             else:
                 yield kind, data, pos
 
 
+_trim_trailing_space = re.compile('[ \t]+(?=\n)').sub
+_collapse_lines = re.compile('\n{2,}').sub
+
+
 class WhitespaceFilter(object):
     """A filter that removes extraneous ignorable white space from the
     stream.
@@ -762,13 +1222,12 @@ class WhitespaceFilter(object):
         self.noescape = frozenset(noescape)
 
     def __call__(self, stream, ctxt=None, space=XML_NAMESPACE['space'],
-                 trim_trailing_space=re.compile('[ \t]+(?=\n)').sub,
-                 collapse_lines=re.compile('\n{2,}').sub):
+                 trim_trailing_space=_trim_trailing_space,
+                 collapse_lines=_collapse_lines, preserve=0,
+                 noescape=False):
         mjoin = Markup('').join
         preserve_elems = self.preserve
-        preserve = 0
         noescape_elems = self.noescape
-        noescape = False
 
         textbuf = []
         push_text = textbuf.append
@@ -781,12 +1240,17 @@ class WhitespaceFilter(object):
                 push_text(data)
             else:
                 if textbuf:
+                    strip = not preserve
                     if len(textbuf) > 1:
                         text = mjoin(textbuf, escape_quotes=False)
                         del textbuf[:]
+                    elif strip and type(textbuf[0]) is _StaticText:
+                        # White space has been stripped in advance
+                        text = escape(pop_text().stripped, quotes=False)
+                        strip = False
                     else:
                         text = escape(pop_text(), quotes=False)
-                    if not preserve:
+                    if strip:
                         text = collapse_lines('\n', trim_trailing_space('', text))
                     yield TEXT, Markup(text), pos
 
@@ -809,9 +1273,19 @@ class WhitespaceFilter(object):
                 elif kind is END_CDATA:
                     noescape = False
 
+                elif kind is STATIC:
+                    data = self._filter_static(data, bool(preserve), noescape)
+                    noescape = False
+
                 if kind:
                     yield kind, data, pos
 
+    def _filter_static(self, run, preserve, noescape):
+        key = (type(self), self.preserve, self.noescape, preserve, noescape)
+        return run.derive(key, lambda events: StaticRun(list(
+            self(events, preserve=int(preserve), noescape=noescape)
+        )))
+
 
 class DocTypeInserter(object):
     """A filter that inserts the DOCTYPE declaration in the correct location,
@@ -841,3 +1315,188 @@ class DocTypeInserter(object):
 
         if not doctype_inserted:
             yield self.doctype_event
+
+
+def _standard_filters(filters):
+    """Check whether the given list of filters has the structure set up by the
+    XML, XHTML and HTML serializers.
+    
+    :return: an ``(empty, whitespace, flattener, doctype)`` tuple of the
+             filters, where ``whitespace`` and ``doctype`` may be `None`, or
+             `None` if the list contains other filters
+    """
+    filters = list(filters)
+    empty = whitespace = flattener = doctype = None
+    if filters and type(filters[0]) is EmptyTagFilter:
+        empty = filters.pop(0)
+    if filters and type(filters[0]) is WhitespaceFilter:
+        whitespace = filters.pop(0)
+    if filters and type(filters[0]) is NamespaceFlattener:
+        flattener = filters.pop(0)
+    if filters and type(filters[0]) is DocTypeInserter:
+        doctype = filters.pop(0)
+    if empty is None or flattener is None or filters:
+        return None
+    return empty, whitespace, flattener, doctype
+
+
+def _apply_filters(stream, empty, whitespace, flattener, doctype,
+                   space=XML_NAMESPACE['space'],
+                   trim_trailing_space=_trim_trailing_space,
+                   collapse_lines=_collapse_lines):
+    """Apply the given `EmptyTagFilter`, `WhitespaceFilter`,
+    `NamespaceFlattener` and `DocTypeInserter` (the second and the last of
+    which may be `None`) to the stream in a single loop, rather than chaining
+    the generators of the filters.
+    
+    As long as no namespaces are involved, the namespace flattener would pass
+    the events through unchanged. Once they are, the remaining events are
+    processed by chaining the filters after all.
+    """
+    stream = iter(stream)
+    if whitespace is not None:
+        mjoin = Markup('').join
+        preserve_elems = whitespace.preserve
+        noescape_elems = whitespace.noescape
+        preserve = 0
+        noescape = False
+        textbuf = []
+        push_text = textbuf.append
+        pop_text = textbuf.pop
+    if doctype is not None:
+        doctype = doctype.doctype_event
+    prev = None # a START event that may need to be combined with its END
+
+    for event in stream:
+        # Combine START and END events into EMPTY events
+        if event[0] is START:
+            if prev is None:
+                prev = event
+                continue
+            events = (prev,)
+            prev = event
+        elif prev is not None:
+            if event[0] is END:
+                events = ((EMPTY, prev[1], prev[2]),)
+            else:
+                events = (prev, event)
+            prev = None
+        else:
+            events = (event,)
+
+        idx = 0
+        for kind, data, pos in events:
+            idx += 1
+            if kind is STATIC:
+                data = data.derive((type(empty),), empty._filter_static)
+
+            # Remove ignorable white space
+            if whitespace is not None:
+                if kind is TEXT:
+                    if noescape:
+                        data = Markup(data)
+                    push_text(data)
+                    continue
+
+                if textbuf:
+                    strip = not preserve
+                    if len(textbuf) > 1:
+                        text = mjoin(textbuf, escape_quotes=False)
+                        del textbuf[:]
+                    elif strip and type(textbuf[0]) is _StaticText:
+                        text = escape(pop_text().stripped, quotes=False)
+                        strip = False
+                    else:
+                        text = escape(pop_text(), quotes=False)
+                    if strip and '\n' in text:
+                        text = Markup(collapse_lines(
+                            '\n', trim_trailing_space('', text)
+                        ))
+                    if doctype is not None:
+                        yield doctype
+                        doctype = None
+                    yield TEXT, text, pos
+
+                if kind is START:
+                    tag, attrs = data
+                    if preserve or (tag in preserve_elems or
+                                    attrs.get(space) == 'preserve'):
+                        preserve += 1
+                    if not noescape and tag in noescape_elems:
+                        noescape = True
+
+                elif kind is END:
+                    noescape = False
+                    if preserve:
+                        preserve -= 1
+
+                elif kind is START_CDATA:
+                    noescape = True
+
+                elif kind is END_CDATA:
+                    noescape = False
+
+                elif kind is STATIC:
+                    data = whitespace._filter_static(data, bool(preserve),
+                                                     noescape)
+                    noescape = False
+
+            # Insert the DOCTYPE declaration
+            if doctype is not None:
+                if kind is XML_DECL:
+                    yield kind, data, pos
+                    yield doctype
+                    doctype = None
+                    continue
+                yield doctype
+                doctype = None
+
+            # Check for namespaces
+            if kind is START or kind is EMPTY:
+                namespaced = data[0].namespace
+                if not namespaced:
+                    for attr, value in data[1]:
+                        if attr.namespace:
+                            namespaced = True
+                            break
+            elif kind is END:
+                namespaced = data.namespace
+            elif kind is STATIC:
+                namespaced = data.namespaces
+            else:
+                namespaced = kind is START_NS or kind is END_NS
+
+            if namespaced:
+                rest = list(events[idx:])
+                if prev is not None:
+                    rest.append(prev)
+                rest = empty(chain(rest, stream))
+                if whitespace is not None:
+                    rest = whitespace(rest, preserve=preserve,
+                                      noescape=noescape)
+                for event in flattener._flatten(chain([(kind, data, pos)],
+                                                      rest)):
+                    yield event
+                return
+
+            yield kind, data, pos
+
+    # A START event left at the end of the stream is dropped, like the
+    # `EmptyTagFilter` does
+    if whitespace is not None and textbuf:
+        strip = not preserve
+        if len(textbuf) > 1:
+            text = mjoin(textbuf, escape_quotes=False)
+        elif strip and type(textbuf[0]) is _StaticText:
+            text = escape(textbuf[0].stripped, quotes=False)
+            strip = False
+        else:
+            text = escape(textbuf[0], quotes=False)
+        if strip and '\n' in text:
+            text = Markup(collapse_lines('\n', trim_trailing_space('', text)))
+        if doctype is not None:
+            yield doctype
+            doctype = None
+        yield TEXT, text, None
+    if doctype is not None:
+        yield doctype
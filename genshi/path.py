@@ -641,6 +641,34 @@ class Path(object):
             return retval
         return _multi
 
+    def _element_names(self):
+        """Return the set of local names of the elements that the path can
+        match when it is tested as a pattern (that is, with ``ignore_context``
+        set to `True`), or `None` if that can not be determined.
+
+        If a set is returned, the test function does not need to see any
+        events other than `START` events for elements with one of these
+        names: it returns `None` for all other events without updating its
+        internal state.
+
+        >>> sorted(Path('foo|bar[@id]|ns:baz')._element_names())
+        ['bar', 'baz', 'foo']
+        >>> print(Path('foo/bar')._element_names())
+        None
+        >>> print(Path('@class|*')._element_names())
+        None
+        """
+        names = set()
+        for strategy in self.strategies:
+            if not isinstance(strategy, SingleStepStrategy):
+                return None
+            axis, nodetest, predicates = strategy.path[0]
+            if axis is ATTRIBUTE or type(nodetest) not in (LocalNameTest,
+                                                            QualifiedNameTest):
+                return None
+            names.add(nodetest.name)
+        return names
+
 
 class PathSyntaxError(Exception):
     """Exception raised when an XPath expression is syntactically incorrect."""
@@ -16,10 +16,15 @@
 from collections import deque
 import os
 import sys
+from time import time
 
 from genshi.compat import StringIO, BytesIO
-from genshi.core import Attrs, Stream, StreamEventKind, START, TEXT, _ensure
+from genshi.core import Attrs, Stream, StreamEventKind, START, END, TEXT, \
+                        COMMENT, PI, _ensure
 from genshi.input import ParseError
+from genshi.output import HTMLSerializer, StaticRun, XHTMLSerializer, \
+                          XMLSerializer, STATIC, _expand_static, _StaticText, \
+                          get_serializer
 
 __all__ = ['Context', 'DirectiveFactory', 'Template', 'TemplateError',
            'TemplateRuntimeError', 'TemplateSyntaxError', 'BadDirectiveError']
@@ -117,16 +122,32 @@ class Context(object):
     {'one': 'frost'}
     >>> ctxt.get('one')
     'foo'
+    
+    Besides the stack itself, the context maintains an index mapping every
+    variable name to the scopes that define it, so that looking up a variable
+    does not depend on the number of nested scopes. For the index to remain
+    accurate, variables should only be added to or removed from scopes that
+    are on the stack through the context (for example using item assignment
+    on the context, which affects the current scope), and not by modifying
+    the scope dictionaries directly.
     """
 
+    # Function applied to the result of every expression evaluated in this
+    # context, if any (used for asynchronous rendering)
+    _resolve = None
+
+    # The `Profiler` recording the time spent rendering with this context, if
+    # any (see `genshi.template.profiler`)
+    _profiler = None
+
     def __init__(self, **data):
         """Initialize the template context with the given keyword arguments as
         data.
         """
         self.frames = deque([data])
-        self.pop = self.frames.popleft
-        self.push = self.frames.appendleft
+        self._scopes = {}
         self._match_templates = []
+        self._match_changes = 0 # incremented when match templates change
         self._choice_stack = []
 
         # Helper functions for use in expressions
@@ -140,6 +161,8 @@ class Context(object):
             return self.get(name, default)
         data.setdefault('defined', defined)
         data.setdefault('value_of', value_of)
+        for key in data:
+            self._scopes[key] = [data]
 
     def __repr__(self):
         return repr(list(self.frames))
@@ -149,7 +172,7 @@ class Context(object):
         
         :param key: the name of the variable
         """
-        return self._find(key)[1] is not None
+        return key in self._scopes
     has_key = __contains__
 
     def __delitem__(self, key):
@@ -160,6 +183,7 @@ class Context(object):
         for frame in self.frames:
             if key in frame:
                 del frame[key]
+        self._scopes.pop(key, None)
 
     def __getitem__(self, key):
         """Get a variables's value, starting at the current scope and going
@@ -179,7 +203,7 @@ class Context(object):
         
         :return: the number of variables in the context
         """
-        return len(self.items())
+        return len(self._scopes)
 
     def __setitem__(self, key, value):
         """Set a variable in the current scope.
@@ -187,7 +211,13 @@ class Context(object):
         :param key: the name of the variable
         :param value: the variable value
         """
-        self.frames[0][key] = value
+        frame = self.frames[0]
+        frame[key] = value
+        scope = self._scopes.get(key)
+        if scope is None:
+            self._scopes[key] = [frame]
+        elif scope[-1] is not frame:
+            scope.append(frame)
 
     def _find(self, key, default=None):
         """Retrieve a given variable's value and the frame it was found in.
@@ -198,9 +228,10 @@ class Context(object):
         :param default: the default value to return when the variable is not
                         found
         """
-        for frame in self.frames:
-            if key in frame:
-                return frame[key], frame
+        scope = self._scopes.get(key)
+        if scope:
+            frame = scope[-1]
+            return frame[key], frame
         return default, None
 
     def get(self, key, default=None):
@@ -211,9 +242,9 @@ class Context(object):
         :param default: the default value to return when the variable is not
                         found
         """
-        for frame in self.frames:
-            if key in frame:
-                return frame[key]
+        scope = self._scopes.get(key)
+        if scope:
+            return scope[-1][key]
         return default
 
     def keys(self):
@@ -236,16 +267,49 @@ class Context(object):
 
     def update(self, mapping):
         """Update the context from the mapping provided."""
-        self.frames[0].update(mapping)
+        for key in mapping:
+            self[key] = mapping[key]
 
     def push(self, data):
         """Push a new scope on the stack.
         
         :param data: the data dictionary to push on the context stack.
         """
+        self.frames.appendleft(data)
+        scopes = self._scopes
+        for key in data:
+            if key in scopes:
+                scopes[key].append(data)
+            else:
+                scopes[key] = [data]
 
     def pop(self):
         """Pop the top-most scope from the stack."""
+        data = self.frames.popleft()
+        scopes = self._scopes
+        for key in data:
+            scope = scopes.get(key)
+            if scope and scope[-1] is data:
+                if len(scope) == 1:
+                    del scopes[key]
+                else:
+                    scope.pop()
+        return data
+
+    def _set_global(self, key, value):
+        """Set a variable in the bottom-most scope, so that it remains
+        available until processing of the template has finished.
+        
+        :param key: the name of the variable
+        :param value: the variable value
+        """
+        frame = self.frames[-1]
+        frame[key] = value
+        scope = self._scopes.get(key)
+        if scope is None:
+            self._scopes[key] = [frame]
+        elif scope[0] is not frame:
+            scope.insert(0, frame)
 
     def copy(self):
         """Create a copy of this Context object."""
@@ -255,6 +319,8 @@ class Context(object):
         ctxt = Context()
         ctxt.frames.pop()  # pop empty dummy context
         ctxt.frames.extend(self.frames)
+        ctxt._scopes = dict([(key, list(scope)) for key, scope
+                             in self._scopes.items()])
         ctxt._match_templates.extend(self._match_templates)
         ctxt._choice_stack.extend(self._choice_stack)
         return ctxt
@@ -271,10 +337,22 @@ def _apply_directives(stream, directives, ctxt, vars):
     :return: the stream with the given directives applied
     """
     if directives:
+        profiler = ctxt._profiler
+        if profiler is not None:
+            marker = profiler._start()
         stream = directives[0](iter(stream), directives[1:], ctxt, **vars)
+        if profiler is not None:
+            stream = profiler._stream(marker, directives[0], stream)
     return stream
 
 
+def _getmtime(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        return None
+
+
 def _eval_expr(expr, ctxt, vars=None):
     """Evaluate the given `Expression` object.
     
@@ -284,11 +362,18 @@ def _eval_expr(expr, ctxt, vars=None):
                  expression
     :return: the result of the evaluation
     """
+    profiler = ctxt._profiler
+    if profiler is not None:
+        marker = profiler._start()
     if vars:
         ctxt.push(vars)
     retval = expr.evaluate(ctxt)
     if vars:
         ctxt.pop()
+    if ctxt._resolve is not None:
+        retval = ctxt._resolve(retval)
+    if profiler is not None:
+        profiler._stop(marker, expr)
     return retval
 
 
@@ -300,6 +385,9 @@ def _exec_suite(suite, ctxt, vars=None):
     :param vars: additional variables that should be available to the
                  code
     """
+    profiler = ctxt._profiler
+    if profiler is not None:
+        marker = profiler._start()
     if vars:
         ctxt.push(vars)
         ctxt.push({})
@@ -307,7 +395,9 @@ def _exec_suite(suite, ctxt, vars=None):
     if vars:
         top = ctxt.pop()
         ctxt.pop()
-        ctxt.frames[0].update(top)
+        ctxt.update(top)
+    if profiler is not None:
+        profiler._stop(marker, suite)
 
 
 class DirectiveFactoryMeta(type):
@@ -381,6 +471,23 @@ class Template(DirectiveFactory):
     serializer = None
     _number_conv = unicode # function used to convert numbers to event data
 
+    compiled = False
+    """Whether the prepared template stream should be compiled into Python
+    code the first time the template is rendered.
+    
+    :see: `genshi.template.codegen`
+    :since: version 0.8
+    """
+
+    fragment_cache = None
+    """The object storing the output of the ``py:cache`` directives in this
+    template. If `None`, a `FragmentCache` is created for the template when a
+    ``py:cache`` directive is first applied.
+    
+    :see: `genshi.template.directives.FragmentCache`
+    :since: version 0.8
+    """
+
     def __init__(self, source, filepath=None, filename=None, loader=None,
                  encoding=None, lookup='strict', allow_exec=True):
         """Initialize a template from either a string, a file-like object, or
@@ -406,6 +513,9 @@ class Template(DirectiveFactory):
         self.loader = loader
         self.lookup = lookup
         self.allow_exec = allow_exec
+        self._code = None
+        self._static = None
+        self._dependencies = {} # modification times of inlined templates
         self._init_filters()
         self._init_loader()
         self._prepared = False
@@ -423,6 +533,8 @@ class Template(DirectiveFactory):
     def __getstate__(self):
         state = self.__dict__.copy()
         state['filters'] = []
+        state['_code'] = None
+        state['_static'] = None
         return state
 
     def __setstate__(self, state):
@@ -471,15 +583,20 @@ class Template(DirectiveFactory):
 
     def _prepare_self(self, inlined=None):
         if not self._prepared:
+            start = time()
             self._stream = list(self._prepare(self._stream, inlined))
             self._prepared = True
+            # Let the loader account for the time spent
+            record = getattr(self.loader, '_record', None)
+            if record is not None:
+                record('prepare', self.filename, time() - start)
 
     def _prepare(self, stream, inlined):
         """Call the `attach` method of every directive found in the template.
         
         :param stream: the event stream of the template
         """
-        from genshi.template.loader import TemplateNotFound
+        from genshi.template.loader import TemplateLoader, TemplateNotFound
         if inlined is None:
             inlined = set((self.filepath,))
 
@@ -502,29 +619,40 @@ class Template(DirectiveFactory):
                 if kind is INCLUDE:
                     href, cls, fallback = data
                     tmpl_inlined = False
-                    if (isinstance(href, basestring) and
-                            not getattr(self.loader, 'auto_reload', True)):
-                        # If the path to the included template is static, and
-                        # auto-reloading is disabled on the template loader,
-                        # the template is inlined into the stream provided it
-                        # is not already in the stack of templates being
-                        # processed.
+                    auto_reload = getattr(self.loader, 'auto_reload', True)
+                    if (isinstance(href, basestring) and (not auto_reload or
+                            isinstance(self.loader, TemplateLoader))):
+                        # If the path to the included template is static, the
+                        # template is inlined into the stream provided it is
+                        # not already in the stack of templates being
+                        # processed. If auto-reloading is enabled, this is only
+                        # done for templates loaded from local files, whose
+                        # modification time is recorded so that the loader
+                        # can check them for changes along with this template,
+                        # and missing templates are left to be included at run
+                        # time, as they may still be added.
                         tmpl = None
                         try:
                             tmpl = self.loader.load(href, relative_to=pos[0],
                                                     cls=cls or self.__class__)
                         except TemplateNotFound:
-                            if fallback is None:
+                            if fallback is None and not auto_reload:
                                 raise
                         if tmpl is not None:
-                            if tmpl.filepath not in inlined:
+                            mtime = None
+                            if auto_reload:
+                                mtime = _getmtime(tmpl.filepath)
+                            if tmpl.filepath not in inlined and (
+                                    not auto_reload or mtime is not None):
                                 inlined.add(tmpl.filepath)
                                 tmpl._prepare_self(inlined)
                                 for event in tmpl.stream:
                                     yield event
                                 inlined.discard(tmpl.filepath)
+                                self._dependencies[tmpl.filepath] = mtime
+                                self._dependencies.update(tmpl._dependencies)
                                 tmpl_inlined = True
-                        else:
+                        elif not auto_reload:
                             for event in self._prepare(fallback, inlined):
                                 yield event
                             tmpl_inlined = True
@@ -564,10 +692,139 @@ class Template(DirectiveFactory):
             ctxt = Context(**kwargs)
 
         stream = self.stream
-        for filter_ in self.filters:
+        filters = self.filters
+        static = not [f for f in filters
+                      if getattr(f, '__self__', None) is not self
+                      or f.__name__ not in ('_flatten', '_include', '_match')]
+        if static:
+            # Only the built-in filters are used, so runs of static events
+            # can be passed on to the serializer as a whole
+            if self._static is None:
+                self._static = self._prepare_static(stream)
+            stream = self._static
+        if self.compiled and filters and filters[0] == self._flatten and \
+                ctxt._profiler is None:
+            # Use the compiled form of the template instead of flattening the
+            # stream (unless that has been replaced by a custom filter, or the
+            # directives need to be applied one by one for the profiler)
+            code = self._code
+            if code is None or code[0] is not stream:
+                from genshi.template.codegen import compile_stream
+                code = self._code = (stream, compile_stream(self, stream))
+            stream = code[1](self, ctxt, vars)
+            filters = filters[1:]
+        for filter_ in filters:
             stream = filter_(iter(stream), ctxt, **vars)
+        if static:
+            return _StaticStream(stream, self.serializer)
         return Stream(stream, self.serializer)
 
+    def generate_async(self, **kwargs):
+        """Apply the template to the given context data, allowing the data to
+        contain awaitable objects and asynchronous iterables.
+        
+        Any keyword arguments are made available to the template as context
+        data. Awaitable objects (such as coroutines or futures), both in the
+        data and returned by template expressions, are replaced by their
+        result when used, and asynchronous iterables can be used in ``py:for``
+        loops.
+        
+        The returned stream must be rendered using its `render_async()`
+        method (or the `genshi.aio.render_async` function), from a coroutine
+        running in the event loop that should complete the awaitables:
+        
+          stream = tmpl.generate_async(user=fetch_user(user_id))
+          async for chunk in stream.render_async('html'):
+              await response.write(chunk)
+        
+        This method requires Python 3.5 or later.
+        
+        :return: a markup event stream representing the result of applying
+                 the template to the context data.
+        :see: `genshi.aio`
+        :since: version 0.8
+        """
+        from genshi.aio import AsyncContext, _check
+        _check()
+        return self.generate(AsyncContext(**kwargs))
+
+    def _prepare_static(self, stream):
+        """Replace balanced runs of events that do not depend on the context
+        data by `STATIC` events, both at the top level of the given stream and
+        in the bodies of the built-in control flow directives. Text outside of
+        such runs is replaced by `_StaticText` instances, so that white space
+        is only stripped from it once. The bodies of loops are analyzed for
+        references to the loop variables that can be substituted directly.
+        """
+        from genshi.template.directives import AttrsDirective, \
+            ChooseDirective, ForDirective, IfDirective, OtherwiseDirective, \
+            StripDirective, WhenDirective, WithDirective
+        # Directives that don't look into their body, except for possibly
+        # the first and last event (which are never part of a static run).
+        # Definitions and match templates are excluded because their bodies
+        # may end up being processed by other templates.
+        transparent = (AttrsDirective, ChooseDirective, ForDirective,
+                       IfDirective, OtherwiseDirective, StripDirective,
+                       WhenDirective, WithDirective)
+
+        def _static_end(stream, idx):
+            # Return the index of the last event of the longest balanced run
+            # of static events starting at the given index, or -1
+            depth = 0
+            end = -1
+            for idx in xrange(idx, len(stream)):
+                kind, data, pos = stream[idx]
+                if kind is START:
+                    if [1 for _, value in data[1] if type(value) is list]:
+                        break
+                    depth += 1
+                elif kind is END:
+                    depth -= 1
+                    if depth < 0:
+                        break
+                    elif depth == 0:
+                        end = idx
+                elif kind is not TEXT and kind is not COMMENT and \
+                        kind is not PI:
+                    break
+            return end
+
+        def _coalesce(stream):
+            new_stream = []
+            idx = 0
+            while idx < len(stream):
+                kind, data, pos = event = stream[idx]
+                if kind is START:
+                    end = _static_end(stream, idx)
+                    if end > idx:
+                        run = StaticRun(stream[idx:end + 1])
+                        new_stream.append((STATIC, run, pos))
+                        idx = end + 1
+                        continue
+                elif kind is TEXT:
+                    if type(data) is unicode and '\n' in data:
+                        event = kind, _StaticText(data), pos
+                elif kind is SUB:
+                    directives, substream = data
+                    if len(substream) > 2 and not [
+                            d for d in directives
+                            if not isinstance(d, transparent)]:
+                        substream = substream[:1] + \
+                                    _coalesce(substream[1:-1]) + \
+                                    substream[-1:]
+                        if len(directives) == 1 and \
+                                isinstance(directives[0], ForDirective):
+                            # Let the loop substitute references to the loop
+                            # variables in its body
+                            directives = [directives[0]._specialize(
+                                substream, self._number_conv)]
+                        event = kind, (directives, substream), pos
+                new_stream.append(event)
+                idx += 1
+            return new_stream
+
+        return _coalesce(stream)
+
     def _flatten(self, stream, ctxt, **vars):
         number_conv = self._number_conv
         stack = []
@@ -646,10 +903,22 @@ class Template(DirectiveFactory):
                         if subkind is TEXT:
                             parts.append(subdata)
                     href = ''.join([x for x in parts if x is not None])
+                profiler = ctxt._profiler
+                if profiler is not None:
+                    marker = profiler._start()
                 try:
                     tmpl = self.loader.load(href, relative_to=event[2][0],
                                             cls=cls or self.__class__)
-                    for event in tmpl.generate(ctxt, **vars):
+                    events = tmpl.generate(ctxt, **vars)
+                    if profiler is not None:
+                        filename, lineno = event[2][:2]
+                        if filename == self.filename:
+                            # Use the same path as for expressions
+                            filename = self.filepath
+                        events = profiler._stream(marker, (
+                            filename, lineno, 'xi:include href="%s"' % href
+                        ), events)
+                    for event in events:
                         yield event
                 except TemplateNotFound:
                     if fallback is None:
@@ -662,6 +931,28 @@ class Template(DirectiveFactory):
                 yield event
 
 
+class _StaticStream(Stream):
+    """Stream produced by a template that may contain `STATIC` events.
+    
+    The static runs are only passed on as such to the serializers that know
+    how to deal with them; in every other case, iterating over the stream
+    produces the original events of the runs.
+    """
+    __slots__ = []
+
+    def __iter__(self):
+        return _expand_static(self.events)
+
+    def serialize(self, method='xml', **kwargs):
+        if method is None:
+            method = self.serializer or 'xml'
+        serializer = get_serializer(method, **kwargs)
+        if type(serializer) in (XMLSerializer, XHTMLSerializer,
+                                HTMLSerializer):
+            return serializer(self.events)
+        return serializer(_ensure(self))
+
+
 EXEC = Template.EXEC
 EXPR = Template.EXPR
 INCLUDE = Template.INCLUDE
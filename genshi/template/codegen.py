@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Compilation of prepared template streams into Python generator functions.
+
+When a template is rendered, the prepared event stream is normally walked by
+`Template._flatten`, which dispatches on the kind of every event and applies
+directives through the generic `_apply_directives` protocol. For templates
+that are rendered many times, this module can instead translate the prepared
+stream into the source code of a Python generator function that produces the
+same events directly, so that the interpretive overhead only has to be paid
+once.
+
+The built-in control flow directives (``py:for``, ``py:if``, ``py:choose``,
+``py:when``, ``py:otherwise``, ``py:with``, ``py:strip`` and ``py:attrs``) are
+translated into the equivalent Python statements. Any other directive
+(including ``py:def``, ``py:match`` and directives provided by custom
+directive factories) is applied through the regular interpreted code path, so
+the output of a compiled template is always the same as that of the
+interpreted one.
+
+Templates rendered with a context that records timings in a
+`genshi.template.profiler.Profiler` are always interpreted, so that the time
+spent in each directive can be measured.
+"""
+
+from genshi.core import Attrs, QName, START, TEXT, _ensure
+from genshi.template.base import TemplateRuntimeError, EXEC, EXPR, SUB, \
+                                 _apply_directives, _eval_expr, \
+                                 _exec_suite
+from genshi.template.directives import AttrsDirective, ChooseDirective, \
+                                       ForDirective, IfDirective, \
+                                       OtherwiseDirective, StripDirective, \
+                                       WhenDirective, WithDirective
+
+__all__ = ['compile_stream']
+__docformat__ = 'restructuredtext en'
+
+# Python limits the number of nested loops in a single function, and the
+# tokenizer limits the depth of indentation, so deeply nested templates are
+# partially left to the interpreter
+MAX_BLOCKS = 16
+MAX_INDENT = 64
+
+
+def compile_stream(template, stream):
+    """Compile a prepared template stream into a generator function.
+
+    The returned function should be called with the template, the `Context`
+    and a dictionary of additional variables, and returns an iterator over the
+    same events that `Template._flatten` would produce for the given stream.
+
+    >>> from genshi.template import MarkupTemplate, Context
+    >>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+    ...   <li py:for="item in items" py:if="item % 2">${item}</li>
+    ... </ul>''')
+    >>> render = compile_stream(tmpl, tmpl.stream)
+    >>> ctxt = Context(items=[1, 2, 3])
+    >>> from genshi.core import Stream
+    >>> print(Stream(render(tmpl, ctxt, {})))
+    <ul>
+      <li>1</li><li>3</li>
+    </ul>
+
+    :param template: the `Template` object the stream belongs to
+    :param stream: the prepared event stream of the template
+    :return: the generator function
+    """
+    return _CodeGenerator(template).compile(stream)
+
+
+def _eval_attrs(template, attrs, ctxt, vars):
+    """Evaluate the interpolated attribute values of a start tag, dropping any
+    attribute whose value evaluates to nothing.
+    """
+    new_attrs = []
+    for name, value in attrs:
+        if type(value) is list: # this is an interpolated string
+            values = [event[1]
+                for event in template._flatten(value, ctxt, **vars)
+                if event[0] is TEXT and event[1] is not None
+            ]
+            if not values:
+                continue
+            value = ''.join(values)
+        new_attrs.append((name, value))
+    return Attrs(new_attrs)
+
+
+def _push_with(directive, ctxt, vars):
+    """Push the scope of a ``py:with`` directive on the context."""
+    ctxt.push({})
+    for targets, expr in directive.vars:
+        value = _eval_expr(expr, ctxt, vars)
+        for assign in targets:
+            assign(ctxt, value)
+
+
+def _choose(directive, ctxt, vars):
+    """Return the choice stack entry for a ``py:choose`` directive."""
+    info = [False, bool(directive.expr), None]
+    if directive.expr:
+        info[2] = _eval_expr(directive.expr, ctxt, vars)
+    return info
+
+
+def _when(directive, ctxt, vars, pos):
+    """Return whether the body of a ``py:when`` directive should be output."""
+    info = ctxt._choice_stack and ctxt._choice_stack[-1]
+    if not info:
+        raise TemplateRuntimeError('"when" directives can only be used '
+                                   'inside a "choose" directive',
+                                   directive.filename, *pos[1:])
+    if info[0]:
+        return False
+    if not directive.expr and not info[1]:
+        raise TemplateRuntimeError('either "choose" or "when" directive '
+                                   'must have a test expression',
+                                   directive.filename, *pos[1:])
+    if info[1]:
+        value = info[2]
+        if directive.expr:
+            matched = value == _eval_expr(directive.expr, ctxt, vars)
+        else:
+            matched = bool(value)
+    else:
+        matched = bool(_eval_expr(directive.expr, ctxt, vars))
+    info[0] = matched
+    return matched
+
+
+def _otherwise(directive, ctxt, pos):
+    """Return whether the body of a ``py:otherwise`` directive should be
+    output.
+    """
+    info = ctxt._choice_stack and ctxt._choice_stack[-1]
+    if not info:
+        raise TemplateRuntimeError('an "otherwise" directive can only be '
+                                   'used inside a "choose" directive',
+                                   directive.filename, *pos[1:])
+    if info[0]:
+        return False
+    info[0] = True
+    return True
+
+
+def _merge_attrs(directive, event, ctxt, vars):
+    """Apply a ``py:attrs`` directive to the given start event."""
+    kind, (tag, attrib), pos = event
+    attrs = _eval_expr(directive.expr, ctxt, vars)
+    if attrs:
+        if hasattr(attrs, 'events'): # a `Stream`
+            try:
+                attrs = iter(attrs).next()
+            except StopIteration:
+                attrs = []
+        elif not isinstance(attrs, list): # assume it's a dict
+            attrs = attrs.items()
+        attrib |= [
+            (QName(n), v is not None and unicode(v).strip() or None)
+            for n, v in attrs
+        ]
+    return kind, (tag, attrib), pos
+
+
+class _CodeGenerator(object):
+    """Translates a prepared template stream into Python source code."""
+
+    def __init__(self, template):
+        self.template = template
+        self.lines = []
+        self.indent = 1
+        self.blocks = 0
+        self.counter = 0
+        self.constants = {}
+        self.handlers = {
+            AttrsDirective: self._attrs,
+            ChooseDirective: self._choose,
+            ForDirective: self._for,
+            IfDirective: self._if,
+            OtherwiseDirective: self._otherwise,
+            StripDirective: self._strip,
+            WhenDirective: self._when,
+            WithDirective: self._with
+        }
+
+    def compile(self, stream):
+        self.lines.append('def _render(self, ctxt, vars):')
+        self._line('flatten = self._flatten')
+        self._line('number_conv = self._number_conv')
+        self._line('push = ctxt.push')
+        self._line('pop = ctxt.pop')
+        self._line('choice_stack = ctxt._choice_stack')
+        self._line('if 0: yield None') # make sure this is a generator
+        self._stream(list(stream))
+
+        source = '\n'.join(self.lines) + '\n'
+        namespace = dict(self.constants)
+        namespace.update({
+            'START': START, 'TEXT': TEXT, 'Attrs': Attrs,
+            '_apply_directives': _apply_directives, '_ensure': _ensure,
+            '_eval_expr': _eval_expr, '_exec_suite': _exec_suite,
+            '_eval_attrs': _eval_attrs, '_push_with': _push_with,
+            '_choose': _choose, '_when': _when, '_otherwise': _otherwise,
+            '_merge_attrs': _merge_attrs, '_numbers': (int, float, long),
+            '_strings': basestring, '_text': unicode
+        })
+        filename = self.template.filepath or '<string>'
+        if not isinstance(filename, str):
+            filename = filename.encode('utf-8', 'replace')
+        code = compile(source, '<compiled %s>' % filename, 'exec')
+        exec code in namespace
+        return namespace['_render']
+
+    def _line(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def _const(self, value):
+        name = '_c%d' % len(self.constants)
+        self.constants[name] = value
+        return name
+
+    def _name(self, prefix):
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def _stream(self, stream):
+        for event in stream:
+            kind, data, pos = event
+
+            if kind is START and data[1] and \
+                    [1 for _, value in data[1] if type(value) is list]:
+                self._line('yield START, (%s, _eval_attrs(self, %s, ctxt, '
+                           'vars)), %s' % (self._const(data[0]),
+                                           self._const(data[1]),
+                                           self._const(pos)))
+
+            elif kind is EXPR:
+                self._expr(data, pos)
+
+            elif kind is SUB:
+                self._sub(data[0], data[1])
+
+            elif kind is EXEC:
+                self._line('_exec_suite(%s, ctxt, vars)' % self._const(data))
+
+            else:
+                # Static events, and includes, which are processed by a
+                # later filter
+                self._line('yield %s' % self._const(event))
+
+    def _expr(self, expr, pos):
+        result = self._name('_r')
+        pos = self._const(pos)
+        line = self._line
+        line('%s = _eval_expr(%s, ctxt, vars)' % (result, self._const(expr)))
+        line('if %s is not None:' % result)
+        self.indent += 1
+        line('if isinstance(%s, _strings):' % result)
+        line('    yield TEXT, %s, %s' % (result, pos))
+        line('elif isinstance(%s, _numbers):' % result)
+        line('    yield TEXT, number_conv(%s), %s' % (result, pos))
+        line('elif hasattr(%s, "__iter__"):' % result)
+        line('    for _event in flatten(_ensure(%s), ctxt, **vars):' % result)
+        line('        yield _event')
+        line('else:')
+        line('    yield TEXT, _text(%s), %s' % (result, pos))
+        self.indent -= 1
+
+    def _sub(self, directives, stream):
+        if not directives:
+            self._stream(stream)
+            return
+        handler = self.handlers.get(type(directives[0]))
+        if handler is None or self.indent >= MAX_INDENT or \
+                self.blocks >= MAX_BLOCKS or \
+                not handler(directives[0], directives[1:], stream):
+            self._interpret(directives, stream)
+
+    def _interpret(self, directives, stream):
+        self._line('for _event in flatten(_apply_directives(%s, %s, ctxt, '
+                   'vars), ctxt, **vars):' % (self._const(stream),
+                                              self._const(directives)))
+        self._line('    yield _event')
+
+    def _block(self, directives, stream):
+        self.indent += 1
+        mark = len(self.lines)
+        self._sub(directives, stream)
+        if len(self.lines) == mark:
+            self._line('pass')
+        self.indent -= 1
+
+    # Directive handlers; each returns whether it was able to compile the
+    # directive, in which case it has written the code for the remaining
+    # directives and the body, too
+
+    def _attrs(self, directive, directives, stream):
+        if directives or not stream or stream[0][0] is not START:
+            return False
+        event = self._name('_e')
+        self._line('%s = _merge_attrs(%s, %s, ctxt, vars)' % (
+            event, self._const(directive), self._const(stream[0])))
+        self._line('if %s[1][1]:' % event)
+        self._line('    yield START, (%s[1][0], _eval_attrs(self, %s[1][1], '
+                   'ctxt, vars)), %s[2]' % (event, event, event))
+        self._line('else:')
+        self._line('    yield %s' % event)
+        self._stream(stream[1:])
+        return True
+
+    def _choose(self, directive, directives, stream):
+        self._line('choice_stack.append(_choose(%s, ctxt, vars))' %
+                   self._const(directive))
+        self._sub(directives, stream)
+        self._line('choice_stack.pop()')
+        return True
+
+    def _for(self, directive, directives, stream):
+        iterable, scope, item = [self._name(prefix) for prefix
+                                 in ('_i', '_s', '_v')]
+        line = self._line
+        line('%s = _eval_expr(%s, ctxt, vars)' % (iterable,
+                                                  self._const(directive.expr)))
+        line('if %s is not None:' % iterable)
+        self.indent += 1
+        line('%s = {}' % scope)
+        line('for %s in %s:' % (item, iterable))
+        self.indent += 1
+        self.blocks += 1
+        line('%s(%s, %s)' % (self._const(directive.assign), scope, item))
+        line('push(%s)' % scope)
+        self._sub(directives, stream)
+        line('pop()')
+        self.blocks -= 1
+        self.indent -= 2
+        return True
+
+    def _if(self, directive, directives, stream):
+        self._line('if _eval_expr(%s, ctxt, vars):' %
+                   self._const(directive.expr))
+        self._block(directives, stream)
+        return True
+
+    def _otherwise(self, directive, directives, stream):
+        pos = stream and stream[0][2] or (None, -1, -1)
+        self._line('if _otherwise(%s, ctxt, %s):' % (self._const(directive),
+                                                     self._const(pos)))
+        self._block(directives, stream)
+        return True
+
+    def _strip(self, directive, directives, stream):
+        if directive.expr:
+            self._line('if _eval_expr(%s, ctxt, vars):' %
+                       self._const(directive.expr))
+            self._block(directives, stream[1:-1])
+            self._line('else:')
+            self._block(directives, stream)
+        else:
+            self._sub(directives, stream[1:-1])
+        return True
+
+    def _when(self, directive, directives, stream):
+        pos = stream and stream[0][2] or (None, -1, -1)
+        self._line('if _when(%s, ctxt, vars, %s):' % (self._const(directive),
+                                                      self._const(pos)))
+        self._block(directives, stream)
+        return True
+
+    def _with(self, directive, directives, stream):
+        self._line('_push_with(%s, ctxt, vars)' % self._const(directive))
+        self._sub(directives, stream)
+        self._line('pop()')
+        return True
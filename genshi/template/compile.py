@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Ahead-of-time loading of all templates in a set of directories.
+
+Running this module as a script loads and prepares every template file found
+in the given directories, reports any errors, and stores the prepared
+templates in a cache directory, from where a `TemplateLoader` using the same
+``cache_dir`` can load them without parsing the template files again::
+
+  $ python -m genshi.template.compile -c /var/cache/myapp templates
+
+The loader needs to be created with the same options as the loader of the
+application (see the ``--help`` output), as cache entries written with
+different options are not used. The exit status is 1 if any of the templates
+could not be loaded.
+"""
+
+import fnmatch
+from optparse import OptionParser
+import os
+import sys
+
+from genshi.template.base import TemplateError
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+__all__ = ['compile_templates', 'find_templates', 'main']
+__docformat__ = 'restructuredtext en'
+
+MARKUP_PATTERNS = ('*.html', '*.xhtml', '*.xml')
+TEXT_PATTERNS = ('*.txt',)
+
+
+def find_templates(search_path, markup_patterns=MARKUP_PATTERNS,
+                   text_patterns=TEXT_PATTERNS, exclude=()):
+    """Find the template files in the given directories.
+    
+    :param search_path: a list of directory paths
+    :param markup_patterns: the shell-style patterns matching the names of
+                            markup template files
+    :param text_patterns: the shell-style patterns matching the names of text
+                          template files
+    :param exclude: a list of directory paths not to search
+    :return: an iterator over ``(filename, cls)`` tuples, where ``filename``
+             is relative to the directory containing the file, and ``cls`` is
+             the template class to load the file with
+    """
+    exclude = [os.path.abspath(path) for path in exclude]
+    for dirname in search_path:
+        for dirpath, dirnames, filenames in os.walk(dirname):
+            dirnames[:] = sorted([
+                name for name in dirnames
+                if os.path.abspath(os.path.join(dirpath, name)) not in exclude
+            ])
+            for name in sorted(filenames):
+                for patterns, cls in [(markup_patterns, MarkupTemplate),
+                                      (text_patterns, NewTextTemplate)]:
+                    if [p for p in patterns if fnmatch.fnmatch(name, p)]:
+                        path = os.path.join(dirpath, name)
+                        yield os.path.relpath(path, dirname), cls
+                        break
+
+
+def compile_templates(search_path, cache_dir=None, processes=None,
+                      markup_patterns=MARKUP_PATTERNS,
+                      text_patterns=TEXT_PATTERNS, **kwargs):
+    """Load and prepare all templates found in the given directories.
+    
+    The templates are loaded by a pool of worker processes, each using its own
+    `TemplateLoader`. Any additional keyword arguments are passed to the
+    constructor of the loaders.
+    
+    :param search_path: a list of directory paths
+    :param cache_dir: the path to the directory in which the prepared
+                      templates are stored (see `TemplateLoader`), or `None`
+                      to only check the templates for errors
+    :param processes: the number of worker processes to use; defaults to the
+                      number of CPUs, and if set to 1, the templates are loaded
+                      in the current process
+    :param markup_patterns: the shell-style patterns matching the names of
+                            markup template files
+    :param text_patterns: the shell-style patterns matching the names of text
+                          template files
+    :return: an iterator over ``(filename, error)`` tuples for all templates
+             found, where ``error`` is `None` if the template was loaded
+             successfully, and otherwise a ``(path, lineno, message)`` tuple
+             describing the error (``lineno`` is -1 if unknown)
+    """
+    loader = TemplateLoader(search_path, cache_dir=cache_dir, **kwargs)
+    tasks = find_templates(loader.search_path, markup_patterns, text_patterns,
+                           exclude=filter(None, [cache_dir]))
+    if processes == 1:
+        _init_worker(loader)
+        for task in tasks:
+            yield _compile_worker(task)
+        return
+
+    from multiprocessing import Pool
+    pool = Pool(processes, _init_worker, (loader,))
+    try:
+        for result in pool.imap(_compile_worker, tasks):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
+def main(argv=None):
+    """Run the command-line interface; see the module docstring.
+    
+    :param argv: the command-line arguments (without the program name);
+                 defaults to ``sys.argv[1:]``
+    :return: the exit status
+    """
+    parser = OptionParser(usage='%prog [options] DIRECTORY...',
+                          prog='python -m genshi.template.compile')
+    parser.add_option('-c', '--cache-dir', dest='cache_dir',
+                      help='the directory to store the prepared templates in')
+    parser.add_option('-e', '--encoding', dest='encoding',
+                      help='the encoding of the template files')
+    parser.add_option('-j', '--processes', dest='processes', type='int',
+                      help='the number of worker processes')
+    parser.add_option('-l', '--lookup', dest='variable_lookup', metavar='NAME',
+                      type='choice', choices=['strict', 'lenient'],
+                      default='strict',
+                      help='the variable lookup mechanism (default: strict)')
+    parser.add_option('--no-exec', dest='allow_exec', action='store_false',
+                      default=True,
+                      help='do not allow Python code blocks in templates')
+    parser.add_option('--callback', dest='callback', metavar='NAME',
+                      help='the dotted name of the function the loader calls '
+                           'with every loaded template')
+    parser.add_option('-m', '--markup', dest='markup_patterns',
+                      action='append', metavar='PATTERN',
+                      help='a pattern matching markup template file names '
+                           '(default: %s)' % ', '.join(MARKUP_PATTERNS))
+    parser.add_option('-t', '--text', dest='text_patterns', action='append',
+                      metavar='PATTERN',
+                      help='a pattern matching text template file names '
+                           '(default: %s)' % ', '.join(TEXT_PATTERNS))
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true',
+                      help='only report errors')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no template directories given')
+    callback = None
+    if options.callback:
+        try:
+            callback = _import(options.callback)
+        except (ImportError, AttributeError, ValueError), e:
+            parser.error('can not import callback %s: %s' % (options.callback,
+                                                              e))
+
+    failed = 0
+    results = compile_templates(
+        [os.path.abspath(arg) for arg in args], cache_dir=options.cache_dir,
+        processes=options.processes,
+        markup_patterns=options.markup_patterns or MARKUP_PATTERNS,
+        text_patterns=options.text_patterns or TEXT_PATTERNS,
+        default_encoding=options.encoding,
+        variable_lookup=options.variable_lookup,
+        allow_exec=options.allow_exec, callback=callback
+    )
+    for filename, error in results:
+        if error is not None:
+            failed += 1
+            path, lineno, message = error
+            if lineno >= 0:
+                path = '%s:%d' % (path, lineno)
+            sys.stderr.write('%s: %s\n' % (path, message))
+        elif not options.quiet:
+            sys.stdout.write('%s\n' % filename)
+    return failed and 1 or 0
+
+
+def _import(name):
+    """Return the object with the given dotted name, such as
+    ``myapp.templating.setup``.
+    """
+    module, attr = name.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)
+
+
+_worker_loader = None
+
+def _init_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+
+def _compile_worker(task):
+    filename, cls = task
+    try:
+        tmpl = _worker_loader.load(filename, cls=cls)
+        tmpl.stream # make sure the template has been prepared
+    except TemplateError, e:
+        path = e.filename
+        if path == '<string>':
+            path = filename
+        return filename, (path, e.lineno, e.msg)
+    except Exception, e:
+        return filename, (filename, -1, '%s: %s' % (type(e).__name__, e))
+    return filename, None
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,17 +13,28 @@
 
 """Implementation of the various template directives."""
 
-from genshi.core import QName, Stream
+from copy import copy
+from itertools import count
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import time
+
+from genshi.core import Attrs, QName, Stream, START, TEXT
 from genshi.path import Path
 from genshi.template.base import TemplateRuntimeError, TemplateSyntaxError, \
-                                 EXPR, _apply_directives, _eval_expr
+                                 EXEC, EXPR, _apply_directives, _eval_expr, \
+                                 _getmtime
 from genshi.template.eval import Expression, ExpressionASTTransformer, \
-                                 _ast, _parse
-
-__all__ = ['AttrsDirective', 'ChooseDirective', 'ContentDirective',
-           'DefDirective', 'ForDirective', 'IfDirective', 'MatchDirective',
-           'OtherwiseDirective', 'ReplaceDirective', 'StripDirective',
-           'WhenDirective', 'WithDirective']
+                                 LenientLookup, StrictLookup, _ast, _parse
+from genshi.util import LRUCache, flatten
+
+__all__ = ['AttrsDirective', 'CacheDirective', 'ChooseDirective',
+           'ContentDirective', 'DefDirective', 'ForDirective', 'IfDirective',
+           'MatchDirective', 'MemoizeDirective', 'OtherwiseDirective',
+           'ReplaceDirective', 'StripDirective', 'WhenDirective',
+           'WithDirective']
 __docformat__ = 'restructuredtext en'
 
 
@@ -124,13 +135,112 @@ def _assignment(ast):
             return tuple([_names(child) for child in node.elts])
         elif isinstance(node, _ast.Name):
             return node.id
-    def _assign(data, value, names=_names(ast)):
+    return _Assignment(_names(ast))
+
+
+def _assign(data, value, names):
+    if type(names) is tuple:
+        for idx in range(len(names)):
+            _assign(data, value[idx], names[idx])
+    else:
+        data[names] = value
+
+
+class _Assignment(object):
+    """Callable applying an assignment to a dictionary.
+    
+    This is a class rather than a closure so that directives using it can be
+    pickled along with the template.
+    """
+    __slots__ = ['names']
+
+    def __init__(self, names):
+        self.names = names
+
+    def __getstate__(self):
+        return self.names
+
+    def __setstate__(self, names):
+        self.names = names
+
+    def __call__(self, data, value):
+        names = self.names
         if type(names) is tuple:
-            for idx in range(len(names)):
-                _assign(data, value[idx], names[idx])
+            _assign(data, value, names)
         else:
             data[names] = value
-    return _assign
+
+
+class _LoopBody(list):
+    """The events of a ``py:for`` loop body, along with the references to
+    loop variables in them that can be substituted by the values of the
+    variables without evaluating any code.
+    
+    Instances are created by `ForDirective._specialize()` when the static runs
+    of a template are prepared, and belong to the copy of the directive made
+    for that particular loop body.
+    """
+    __slots__ = ['substs', 'number_conv']
+
+    def substitute(self, scope):
+        """Generate the events of the body for the given loop scope.
+        
+        Any event that can't be handled here (including references to loop
+        variables with values other than strings and numbers) is passed on
+        unchanged, to be processed by the flattening filter.
+        """
+        number_conv = self.number_conv
+        for idx, event in enumerate(self):
+            subst = self.substs[idx]
+            if subst is None:
+                yield event
+                continue
+            kind, data, pos = event
+            if kind is EXPR:
+                try:
+                    value = scope[subst]
+                except KeyError:
+                    yield event
+                    continue
+                if value is None:
+                    continue
+                elif isinstance(value, basestring):
+                    yield TEXT, value, pos
+                elif isinstance(value, (int, float, long)):
+                    yield TEXT, number_conv(value), pos
+                else:
+                    yield event
+            else:
+                attrs = self._attrs(subst, scope)
+                if attrs is None:
+                    yield event
+                else:
+                    yield kind, (data[0], attrs), pos
+
+    def _attrs(self, attrs, scope):
+        new_attrs = []
+        for name, value in attrs:
+            if type(value) is list:
+                values = []
+                for varname, text in value:
+                    if varname is None:
+                        values.append(text)
+                        continue
+                    result = scope.get(varname)
+                    if result is None:
+                        if varname not in scope:
+                            return None
+                    elif isinstance(result, basestring):
+                        values.append(result)
+                    elif isinstance(result, (int, float, long)):
+                        values.append(self.number_conv(result))
+                    else:
+                        return None
+                if not values:
+                    continue
+                value = ''.join(values)
+            new_attrs.append((name, value))
+        return Attrs(new_attrs)
 
 
 class AttrsDirective(Directive):
@@ -186,6 +296,200 @@ class AttrsDirective(Directive):
         return _apply_directives(_generate(), directives, ctxt, vars)
 
 
+class FragmentCache(object):
+    """Thread-safe in-memory store for the output of ``py:cache`` directives.
+    
+    The cache holds at most `capacity` fragments, and discards the least
+    recently used one when full. Fragments stored with a time-to-live expire
+    after the given number of seconds:
+    
+    >>> cache = FragmentCache(2)
+    >>> cache.set('a', [1, 2])
+    >>> cache.get('a')
+    [1, 2]
+    >>> cache.set('b', [3], ttl=-1)
+    >>> print(cache.get('b'))
+    None
+    
+    Any other object with compatible `get` and `set` methods (for example one
+    that shares fragments between processes) can be used instead, by passing
+    it as the `fragment_cache` option of `TemplateLoader`, or by assigning it
+    to the `fragment_cache` attribute of a template.
+    
+    Copies of the cache (made when it is pickled, for example along with a
+    template loader passed to other processes) start out empty.
+    """
+
+    def __init__(self, capacity=100):
+        """Create the cache.
+        
+        :param capacity: the maximum number of fragments to keep
+        """
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'capacity': self._cache.capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state['capacity'])
+
+    def get(self, key):
+        """Return the fragment stored under the given key, or `None` if no
+        such fragment is stored, or if it has expired.
+        
+        :param key: the cache key
+        """
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._cache[key]
+            except KeyError:
+                return None
+        finally:
+            self._lock.release()
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store a fragment under the given key.
+        
+        :param key: the cache key
+        :param value: the fragment
+        :param ttl: the number of seconds after which the fragment expires, or
+                    `None` if it should only be discarded when the cache is
+                    full
+        """
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        self._lock.acquire()
+        try:
+            self._cache[key] = (expires, value)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Discard all stored fragments."""
+        self._lock.acquire()
+        try:
+            self._cache = LRUCache(self._cache.capacity)
+        finally:
+            self._lock.release()
+
+
+class CacheDirective(Directive):
+    """Implementation of the ``py:cache`` template directive.
+    
+    This directive stores the output of the element it is applied to, and
+    reuses it on subsequent renderings instead of processing the element
+    again. The value of the directive can assign an expression to ``key``, in
+    which case the output is only reused while the key evaluates to the same
+    value, and a number of seconds to ``ttl``, after which the output is
+    processed again:
+    
+    >>> from genshi.template import MarkupTemplate
+    >>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+    ...   <li py:cache="key=user; ttl=60">${user} (${next(counter)})</li>
+    ... </ul>''')
+    >>> counter = count(1)
+    >>> print(tmpl.generate(user='joe', counter=counter))
+    <ul>
+      <li>joe (1)</li>
+    </ul>
+    >>> print(tmpl.generate(user='joe', counter=counter))
+    <ul>
+      <li>joe (1)</li>
+    </ul>
+    >>> print(tmpl.generate(user='jim', counter=counter))
+    <ul>
+      <li>jim (2)</li>
+    </ul>
+    
+    The key must evaluate to a hashable value. Only the output of the element
+    is stored, so any other effect of processing it (such as the definition of
+    macros or match templates) does not happen when the stored output is
+    reused.
+    
+    The output is stored in the `fragment_cache` of the template, which is
+    shared by all templates loaded by the same `TemplateLoader`. Templates not
+    loaded by a loader get a `FragmentCache` of their own.
+    """
+    __slots__ = ['key', 'ttl', 'fragment', 'template']
+
+    _fragment_ids = count()
+
+    def __init__(self, value, template, namespaces=None, lineno=-1, offset=-1):
+        Directive.__init__(self, None, template, namespaces, lineno, offset)
+        self.key = self.ttl = None
+        if type(value) is dict:
+            self.key = self._parse_expr(value.get('key'), template, lineno,
+                                        offset)
+            self.ttl = self._parse_expr(value.get('ttl'), template, lineno,
+                                        offset)
+        elif value and value.strip():
+            value = value.strip()
+            try:
+                ast = _parse(value, 'exec')
+                for node in ast.body:
+                    if not isinstance(node, _ast.Assign) or \
+                            len(node.targets) != 1 or \
+                            not isinstance(node.targets[0], _ast.Name) or \
+                            node.targets[0].id not in ('key', 'ttl'):
+                        raise TemplateSyntaxError('only assignments to "key" '
+                                                  'and "ttl" allowed in value '
+                                                  'of the "cache" directive',
+                                                  template.filepath, lineno,
+                                                  offset)
+                    setattr(self, node.targets[0].id,
+                            Expression(node.value, template.filepath, lineno,
+                                       lookup=template.lookup))
+            except SyntaxError, err:
+                err.msg += ' in expression "%s" of "%s" directive' % (
+                    value, self.tagname)
+                raise TemplateSyntaxError(err, template.filepath, lineno,
+                                          offset + (err.offset or 0))
+
+        # Identifies the directive in the keys of the cache, so that output
+        # stored by different directives can not be mixed up; the
+        # modification time of the file makes sure that output stored by a
+        # previous version of a template is not used after it was reloaded
+        if template.filepath:
+            self.fragment = (template.filepath, _getmtime(template.filepath),
+                             lineno, offset)
+        else:
+            self.fragment = self._fragment_ids.next()
+        self.template = template
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        key = None
+        if self.key:
+            key = _eval_expr(self.key, ctxt, vars)
+        key = (self.fragment, key)
+        cache = self.template.fragment_cache
+        if cache is None:
+            cache = self.template.fragment_cache = FragmentCache()
+        events = cache.get(key)
+        if events is not None:
+            return events
+
+        ttl = None
+        if self.ttl:
+            ttl = _eval_expr(self.ttl, ctxt, vars)
+        def _generate():
+            events = []
+            substream = _apply_directives(stream, directives, ctxt, vars)
+            for event in self.template._flatten(substream, ctxt, **vars):
+                events.append(event)
+                yield event
+            cache.set(key, events, ttl)
+        return _generate()
+
+    def __repr__(self):
+        return '<%s>' % (type(self).__name__)
+
+
 class ContentDirective(Directive):
     """Implementation of the ``py:content`` template directive.
     
@@ -289,6 +593,10 @@ class DefDirective(Directive):
 
     def __call__(self, stream, directives, ctxt, **vars):
         stream = list(stream)
+        memoize = None
+        if directives and isinstance(directives[0], MemoizeDirective):
+            memoize = directives[0]
+            directives = directives[1:]
 
         def function(*args, **kwargs):
             scope = {}
@@ -311,11 +619,13 @@ class DefDirective(Directive):
                 yield event
             ctxt.pop()
         function.__name__ = self.name
+        if memoize is not None:
+            function = memoize.memoize(function, ctxt, vars)
 
         # Store the function reference in the bottom context frame so that it
         # doesn't get popped off before processing the template has finished
         # FIXME: this makes context data mutable as a side-effect
-        ctxt.frames[-1][self.name] = function
+        ctxt._set_global(self.name, function)
 
         return []
 
@@ -336,7 +646,7 @@ class ForDirective(Directive):
       <li>1</li><li>2</li><li>3</li>
     </ul>
     """
-    __slots__ = ['assign', 'filename']
+    __slots__ = ['assign', 'filename', 'body']
 
     def __init__(self, value, template, namespaces=None, lineno=-1, offset=-1):
         if ' in ' not in value:
@@ -347,6 +657,7 @@ class ForDirective(Directive):
         value = 'iter(%s)' % value.strip()
         self.assign = _assignment(ast.body[0].value)
         self.filename = template.filepath
+        self.body = None
         Directive.__init__(self, value, template, namespaces, lineno, offset)
 
     @classmethod
@@ -363,14 +674,79 @@ class ForDirective(Directive):
 
         assign = self.assign
         scope = {}
-        stream = list(stream)
+        body = self.body
+        if body is None or directives or ctxt._resolve is not None or \
+                ctxt._profiler is not None:
+            body = None
+            stream = list(stream)
+        # The scope is only on the context while the body is processed, not
+        # while the next item is requested from the iterable
         for item in iterable:
             assign(scope, item)
             ctxt.push(scope)
-            for event in _apply_directives(stream, directives, ctxt, vars):
+            if body is None:
+                events = _apply_directives(stream, directives, ctxt, vars)
+            else:
+                events = body.substitute(scope)
+            for event in events:
                 yield event
             ctxt.pop()
 
+    def _specialize(self, stream, number_conv):
+        """Return a copy of the directive that substitutes the loop variables
+        in the given prepared loop body, if the body refers to them in
+        expressions or attribute values that only consist of the name of a
+        variable. Otherwise the directive itself is returned.
+        
+        The copy must only be applied to the stream it was made for.
+        
+        :param stream: the prepared events of the loop body
+        :param number_conv: the function converting numbers to text
+        """
+        names = set(flatten([self.assign.names]))
+        def _name(expr):
+            # Only the built-in lookup classes are known to return the value
+            # of a defined variable as it is
+            if expr._lookup in (LenientLookup, StrictLookup):
+                node = expr.ast.body
+                if isinstance(node, _ast.Name) and node.id in names:
+                    return node.id
+
+        substs = []
+        for kind, data, pos in stream:
+            subst = None
+            if kind is EXEC:
+                # Code blocks may rebind or delete the loop variables
+                return self
+            elif kind is EXPR:
+                subst = _name(data)
+            elif kind is START and \
+                    [1 for _, value in data[1] if type(value) is list]:
+                subst = []
+                for attrname, value in data[1]:
+                    if type(value) is list:
+                        parts = []
+                        for subkind, subdata, _ in value:
+                            if subkind is TEXT:
+                                parts.append((None, subdata))
+                            elif subkind is EXPR and _name(subdata):
+                                parts.append((_name(subdata), None))
+                            else:
+                                subst = None
+                                break
+                        if subst is None:
+                            break
+                        value = parts
+                    subst.append((attrname, value))
+            substs.append(subst)
+        if not [1 for subst in substs if subst is not None]:
+            return self
+        directive = copy(self)
+        directive.body = _LoopBody(stream)
+        directive.body.substs = substs
+        directive.body.number_conv = number_conv
+        return directive
+
     def __repr__(self):
         return '<%s>' % type(self).__name__
 
@@ -448,12 +824,96 @@ class MatchDirective(Directive):
         ctxt._match_templates.append((self.path.test(ignore_context=True),
                                       self.path, list(stream), self.hints,
                                       self.namespaces, directives))
+        ctxt._match_changes += 1
         return []
 
     def __repr__(self):
         return '<%s "%s">' % (type(self).__name__, self.path.source)
 
 
+class MemoizeDirective(Directive):
+    """Implementation of the ``py:memoize`` template directive.
+    
+    This directive can only be used together with ``py:def``, and makes the
+    output of the named template function be stored for each combination of
+    arguments it gets called with. When the function is called again with the
+    same arguments, the stored output is reused instead of processing the
+    function body again:
+    
+    >>> from itertools import count
+    >>> from genshi.template import MarkupTemplate
+    >>> tmpl = MarkupTemplate('''<div xmlns:py="http://genshi.edgewall.org/">
+    ...   <i py:def="icon(name)" py:memoize="" class="icon-$name">${next(counter)}</i>
+    ...   ${icon('ok')} ${icon('error')} ${icon('ok')}
+    ... </div>''')
+    >>> print(tmpl.generate(counter=count(1)))
+    <div>
+      <i class="icon-ok">1</i> <i class="icon-error">2</i> <i class="icon-ok">1</i>
+    </div>
+    
+    The output is only kept while the template is being rendered. The optional
+    value of the directive is an expression for the maximum number of argument
+    combinations for which output is stored (100 by default); when that number
+    is exceeded, the output for the least recently used arguments is dropped.
+    
+    As with the ``py:cache`` directive, the output of the function must depend
+    only on its arguments, and should not have any other effects. Calls with
+    arguments that are not hashable are not memoized.
+    """
+    __slots__ = ['filename', 'template']
+
+    def __init__(self, value, template, namespaces=None, lineno=-1, offset=-1):
+        Directive.__init__(self, value, template, namespaces, lineno, offset)
+        self.filename = template.filepath
+        self.template = template
+
+    @classmethod
+    def attach(cls, template, stream, value, namespaces, pos):
+        if type(value) is dict:
+            raise TemplateSyntaxError('The memoize directive can not be used '
+                                      'as an element', template.filepath,
+                                      *pos[1:])
+        return super(MemoizeDirective, cls).attach(template, stream, value,
+                                                   namespaces, pos)
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        raise TemplateRuntimeError('"memoize" directives can only be used '
+                                   'together with a "def" directive',
+                                   self.filename, *(stream.next())[2][1:])
+
+    def memoize(self, function, ctxt, vars):
+        """Return a wrapper for the template function produced by a
+        `DefDirective`, which stores the flattened output of the function
+        for the arguments it gets called with.
+        
+        :param function: the template function
+        :param ctxt: the context data
+        :param vars: additional variables that should be made available when
+                     Python code is executed
+        :return: the memoizing template function
+        """
+        capacity = 100
+        if self.expr is not None:
+            capacity = _eval_expr(self.expr, ctxt, vars)
+        cache = LRUCache(capacity)
+        flatten = self.template._flatten
+
+        def memoized(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            except TypeError: # not hashable
+                return function(*args, **kwargs)
+            events = list(flatten(function(*args, **kwargs), ctxt, **vars))
+            cache[key] = events
+            return events
+        memoized.__name__ = function.__name__
+
+        return memoized
+
+
 class ReplaceDirective(Directive):
     """Implementation of the ``py:replace`` template directive.
     
@@ -712,12 +1172,11 @@ class WithDirective(Directive):
                                                 namespaces, pos)
 
     def __call__(self, stream, directives, ctxt, **vars):
-        frame = {}
-        ctxt.push(frame)
+        ctxt.push({})
         for targets, expr in self.vars:
             value = _eval_expr(expr, ctxt, vars)
             for assign in targets:
-                assign(frame, value)
+                assign(ctxt, value)
         for event in _apply_directives(stream, directives, ctxt, vars):
             yield event
         ctxt.pop()
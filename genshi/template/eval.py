@@ -16,7 +16,7 @@
 import __builtin__
 
 from textwrap import dedent
-from types import CodeType
+from types import CodeType, FunctionType
 
 from genshi.core import Markup
 from genshi.template.astutil import ASTTransformer, ASTCodeGenerator, \
@@ -24,8 +24,8 @@ from genshi.template.astutil import ASTTransformer, ASTCodeGenerator, \
 from genshi.template.base import TemplateRuntimeError
 from genshi.util import flatten
 
-from genshi.compat import get_code_params, build_code_chunk, isstring, \
-                          IS_PYTHON2
+from genshi.compat import get_code_params, build_code_chunk, \
+                          build_function_code, isstring, IS_PYTHON2
 
 __all__ = ['Code', 'Expression', 'Suite', 'LenientLookup', 'StrictLookup',
            'Undefined', 'UndefinedError']
@@ -55,9 +55,14 @@ def _star_import_patch(mapping, modname):
     mapping.update([(name, getattr(module, name)) for name in members])
 
 
+# Version of the state of pickled `Code` objects, which needs to be changed
+# whenever the format of that state changes
+_PICKLE_VERSION = 2
+
+
 class Code(object):
     """Abstract base class for the `Expression` and `Suite` classes."""
-    __slots__ = ['source', 'code', 'ast', '_globals']
+    __slots__ = ['source', 'code', 'ast', '_lookup', '_globals']
 
     def __init__(self, source, filename=None, lineno=-1, lookup='strict',
                  xform=None):
@@ -96,19 +101,32 @@ class Code(object):
             lookup = LenientLookup
         elif isinstance(lookup, basestring):
             lookup = {'lenient': LenientLookup, 'strict': StrictLookup}[lookup]
-        self._globals = lookup.globals
+        self._lookup = lookup
+        self._globals = _lookup_globals(lookup)
 
     def __getstate__(self):
-        state = {'source': self.source, 'ast': self.ast,
-                 'lookup': self._globals.im_self}
+        state = {'version': _PICKLE_VERSION, 'source': self.source,
+                 'ast': self.ast, 'lookup': self._lookup}
         state['code'] = get_code_params(self.code)
         return state
 
     def __setstate__(self, state):
         self.source = state['source']
         self.ast = state['ast']
-        self.code = CodeType(0, *state['code'])
-        self._globals = state['lookup'].globals
+        self._lookup = state['lookup']
+        if state.get('version') == _PICKLE_VERSION:
+            self.code = CodeType(*state['code'])
+        else:
+            # Pickled by an older version, which compiled the code differently,
+            # so compile it again, keeping the location if it can be found
+            try:
+                code = CodeType(0, *state['code']) # the format of Genshi 0.7
+                filename, lineno = code.co_filename, code.co_firstlineno
+            except TypeError:
+                filename, lineno = None, -1
+            self.code = _compile(self.ast, self.source, mode=self.mode,
+                                 filename=filename, lineno=lineno)
+        self._globals = _lookup_globals(self._lookup)
 
     def __eq__(self, other):
         return (type(other) == type(self)) and (self.code == other.code)
@@ -164,9 +182,24 @@ class Expression(Code):
     >>> Expression('len(items)').evaluate(data)
     3
     """
-    __slots__ = []
+    __slots__ = ['_function']
     mode = 'eval'
 
+    def __init__(self, source, filename=None, lineno=-1, lookup='strict',
+                 xform=None):
+        Code.__init__(self, source, filename=filename, lineno=lineno,
+                      lookup=lookup, xform=xform)
+        self._init_function()
+
+    def __setstate__(self, state):
+        Code.__setstate__(self, state)
+        self._init_function()
+
+    def _init_function(self):
+        self._function = None
+        if self._globals is not None:
+            self._function = FunctionType(self.code, self._globals)
+
     def evaluate(self, data):
         """Evaluate the expression against the given data dictionary.
         
@@ -174,8 +207,10 @@ class Expression(Code):
         :return: the result of the evaluation
         """
         __traceback_hide__ = 'before_and_this'
-        _globals = self._globals(data)
-        return eval(self.code, _globals, {'__data__': data})
+        if self._function is None:
+            _globals = _data_globals(self._lookup, data)
+            return FunctionType(self.code, _globals)(data)
+        return self._function(data)
 
 
 class Suite(Code):
@@ -195,7 +230,11 @@ class Suite(Code):
         :param data: a mapping containing the data to execute in
         """
         __traceback_hide__ = 'before_and_this'
-        _globals = self._globals(data)
+        if self._globals is None:
+            _globals = _data_globals(self._lookup, data)
+        else:
+            _globals = self._globals.copy()
+            _globals['__data__'] = data
         exec self.code in _globals, data
 
 
@@ -291,6 +330,11 @@ class LookupBase(object):
     def globals(cls, data):
         """Construct the globals dictionary to use as the execution context for
         the expression or suite.
+        
+        Unless this method is overridden, the dictionary is built only once
+        per lookup class and shared by all expressions and suites using that
+        class. Subclasses overriding it get called with the data every time
+        an expression is evaluated or a suite executed, which is slower.
         """
         return {
             '__data__': data,
@@ -462,6 +506,17 @@ def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
             extract += ' ...'
         name = '<Suite %r>' % (extract)
     new_source = ASTCodeGenerator(tree).code
+    if mode == 'eval':
+        # Expressions are compiled to the body of a function taking the data
+        # as its only argument, so that evaluating them is a plain function
+        # call that doesn't need any dictionaries to be built
+        code = compile('lambda __data__: (%s)' % new_source, filename, mode)
+        code = [const for const in code.co_consts
+                if isinstance(const, CodeType)][0]
+        try:
+            return build_function_code(code, filename, name, lineno)
+        except RuntimeError:
+            return code
     code = compile(new_source, filename, mode)
 
     try:
@@ -472,6 +527,38 @@ def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
         return code
 
 
+_LOOKUP_GLOBALS = {}
+
+def _lookup_globals(lookup):
+    """Return the globals dictionary shared by all expressions and suites using
+    the given lookup class, which doesn't include the data they are evaluated
+    against, or `None` if the lookup class builds the globals depending on the
+    data.
+    """
+    try:
+        return _LOOKUP_GLOBALS[lookup]
+    except KeyError:
+        if getattr(lookup.globals, '__func__', None) is not \
+                LookupBase.globals.__func__:
+            _LOOKUP_GLOBALS[lookup] = None
+            return None
+        _globals = lookup.globals(None)
+        del _globals['__data__']
+        _globals['__builtins__'] = __builtin__.__dict__
+        _LOOKUP_GLOBALS[lookup] = _globals
+        return _globals
+
+
+def _data_globals(lookup, data):
+    """Return the globals dictionary for evaluating code against the given
+    data, built by a lookup class that overrides `LookupBase.globals()`.
+    """
+    _globals = lookup.globals(data)
+    if '__builtins__' not in _globals:
+        _globals['__builtins__'] = __builtin__.__dict__
+    return _globals
+
+
 def _new(class_, *args, **kwargs):
     ret = class_()
     for attr, value in zip(ret._fields, args):
@@ -13,12 +13,25 @@
 
 """Template loading and caching."""
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from itertools import count
 import os
+import sys
+import tempfile
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
+from time import time
 
+from genshi import __version__ as VERSION
 from genshi.template.base import TemplateError
 from genshi.util import LRUCache
 
@@ -40,6 +53,12 @@ class TemplateNotFound(TemplateError):
         self.search_path = search_path
 
 
+# Events counted in the loader statistics (other than cache hits, which are
+# counted separately), and the names of their counters
+_COUNTED = {'miss': 'misses', 'eviction': 'evictions', 'reload': 'reloads',
+            'not_found': 'not_found'}
+
+
 class TemplateLoader(object):
     """Responsible for loading templates from files on the specified search
     path.
@@ -78,7 +97,9 @@ class TemplateLoader(object):
     """
     def __init__(self, search_path=None, auto_reload=False,
                  default_encoding=None, max_cache_size=25, default_class=None,
-                 variable_lookup='strict', allow_exec=True, callback=None):
+                 variable_lookup='strict', allow_exec=True, callback=None,
+                 compiled=False, cache_dir=None, watcher=None, monitor=None,
+                 monitor_hits=False, fragment_cache=None):
         """Create the template laoder.
         
         :param search_path: a list of absolute path names that should be
@@ -89,6 +110,8 @@ class TemplateLoader(object):
                             metadata
         :param auto_reload: whether to check the last modification time of
                             template files, and reload them if they have changed
+                            (or if any of the templates included into them
+                            has changed)
         :param default_encoding: the default encoding to assume when loading
                                  templates; defaults to UTF-8
         :param max_cache_size: the maximum number of templates to keep in the
@@ -104,10 +127,36 @@ class TemplateLoader(object):
                          is passed the template object as only argument. This
                          callback can be used for example to add any desired
                          filters to the template
-        :see: `LenientLookup`, `StrictLookup`
+        :param compiled: whether loaded templates should be compiled into
+                         Python code when they are first rendered
+        :param cache_dir: (optional) the path to a directory in which parsed
+                          templates should be stored, so that they don't need
+                          to be parsed again by other loader instances or
+                          processes
+        :param watcher: (optional) a `FileWatcher` used to detect changes to
+                        template files if `auto_reload` is enabled, in which
+                        case cached templates are not checked for changes
+                        when they are loaded
+        :param monitor: (optional) a function that is invoked for every event
+                        counted in the statistics of the loader; it is passed
+                        the name of the event, the filename of the template
+                        (or `None`), and the number of events or the number of
+                        seconds spent (see `stats()`)
+        :param monitor_hits: whether the `monitor` function should also be
+                             invoked for every template found in the cache;
+                             by default, cache hits are only counted
+        :param fragment_cache: (optional) the object storing the output of the
+                               ``py:cache`` directives in templates loaded by
+                               this loader, such as a `FragmentCache`; by
+                               default, every loader creates a
+                               `FragmentCache` of its own
+        :see: `LenientLookup`, `StrictLookup`, `genshi.template.watcher`
         
         :note: Changed in 0.5: Added the `allow_exec` argument
+        :note: Changed in 0.8: Added the `compiled`, `cache_dir`, `watcher`,
+               `monitor`, `monitor_hits` and `fragment_cache` arguments
         """
+        from genshi.template.directives import FragmentCache
         from genshi.template.markup import MarkupTemplate
 
         self.search_path = search_path
@@ -124,21 +173,53 @@ class TemplateLoader(object):
         self.default_class = default_class or MarkupTemplate
         self.variable_lookup = variable_lookup
         self.allow_exec = allow_exec
+        self.compiled = compiled
+        self.cache_dir = cache_dir
+        self.watcher = watcher
         if callback is not None and not hasattr(callback, '__call__'):
             raise TypeError('The "callback" parameter needs to be callable')
         self.callback = callback
+        if monitor is not None and not hasattr(monitor, '__call__'):
+            raise TypeError('The "monitor" parameter needs to be callable')
+        self.monitor = monitor
+        self.monitor_hits = monitor_hits
+        if fragment_cache is None:
+            fragment_cache = FragmentCache()
+        self.fragment_cache = fragment_cache
         self._cache = LRUCache(max_cache_size)
         self._uptodate = {}
-        self._lock = threading.RLock()
+        self._watched = set() # cache keys of templates checked by the watcher
+        self._dependents = {} # cache keys of templates by watched file path
+        self._lock = threading.RLock() # protects the cache and watch records
+        self._load_locks = {} # [lock, users] held while loading, by cache key
+        self._counts = dict.fromkeys(_COUNTED.values(), 0)
+        # Cache hits are counted without taking the statistics lock, as the
+        # increment of an `itertools.count` is atomic. Reading the counter
+        # also increments it, so the number of reads is subtracted.
+        self._hits = count()
+        self._hits_read = 0
+        self._timings = {} # parse and prepare times by template filename
+        self._stats_lock = threading.Lock()
 
     def __getstate__(self):
         state = self.__dict__.copy()
         state['_lock'] = None
+        state['_load_locks'] = {}
+        state['_stats_lock'] = None
+        state['_hits'] = self.stats()['hits'] # counters can't be pickled
+        state['_hits_read'] = 0
+        # The watcher is bound to threads of this process, so copies of the
+        # loader check for changes when templates are loaded instead
+        state['watcher'] = None
+        state['_watched'] = set()
+        state['_dependents'] = {}
         return state
 
     def __setstate__(self, state):
         self.__dict__ = state
         self._lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._hits = count(self._hits)
 
     def load(self, filename, relative_to=None, cls=None, encoding=None):
         """Load the template with the given name.
@@ -157,6 +238,11 @@ class TemplateLoader(object):
         object (unless the ``auto_reload`` option is enabled and the file was
         changed since the last parse.)
         
+        This method can be called from multiple threads. Templates found in
+        the cache are returned without waiting for other threads, and a
+        template that is not cached is only parsed by one thread, while other
+        threads requesting the same template wait for the result.
+        
         If the `relative_to` parameter is provided, the `filename` is
         interpreted as being relative to that path.
         
@@ -184,18 +270,21 @@ class TemplateLoader(object):
         filename = os.path.normpath(filename)
         cachekey = filename
 
-        self._lock.acquire()
+        # First check the cache to avoid reparsing the same file
+        tmpl = self._get_cached(cachekey)
+        if tmpl is not None:
+            self._record_hit(cachekey)
+            return tmpl
+
+        lock = self._load_lock(cachekey)
+        lock.acquire()
         try:
-            # First check the cache to avoid reparsing the same file
-            try:
-                tmpl = self._cache[cachekey]
-                if not self.auto_reload:
-                    return tmpl
-                uptodate = self._uptodate[cachekey]
-                if uptodate is not None and uptodate():
-                    return tmpl
-            except (KeyError, OSError):
-                pass
+            # Another thread may have loaded the template in the meantime
+            tmpl = self._get_cached(cachekey)
+            if tmpl is not None:
+                self._record_hit(cachekey)
+                return tmpl
+            self._record('miss', cachekey, 1)
 
             isabs = False
 
@@ -232,22 +321,292 @@ class TemplateLoader(object):
                             # so that nested includes work properly without a
                             # search path
                             filename = filepath
-                        tmpl = self._instantiate(cls, fileobj, filepath,
-                                                 filename, encoding=encoding)
+                        tmpl = None
+                        if self.cache_dir:
+                            tmpl = self._load_cached(cls, filepath, filename,
+                                                     encoding)
+                        store = tmpl is None and self.cache_dir
+                        if tmpl is None:
+                            start = time()
+                            tmpl = self._instantiate(cls, fileobj, filepath,
+                                                     filename,
+                                                     encoding=encoding)
+                            self._record('parse', tmpl.filename,
+                                         time() - start)
+                        if self.compiled:
+                            tmpl.compiled = True
+                        if self.fragment_cache is not None:
+                            tmpl.fragment_cache = self.fragment_cache
                         if self.callback:
                             self.callback(tmpl)
-                        self._cache[cachekey] = tmpl
-                        self._uptodate[cachekey] = uptodate
+                        self._lock.acquire()
+                        try:
+                            evictions = self._cache.evictions
+                            self._uptodate[cachekey] = uptodate
+                            self._cache[cachekey] = tmpl
+                            evictions = self._cache.evictions - evictions
+                        finally:
+                            self._lock.release()
+                        if evictions:
+                            self._record('eviction', None, evictions)
+                        if store:
+                            # Storing the template prepares it, which may load
+                            # included templates; they find this template in
+                            # the cache should they include it in turn
+                            try:
+                                self._store_cached(tmpl, filepath, encoding)
+                            except:
+                                # Don't keep a template that could not be
+                                # prepared, so that loading it fails again
+                                self._drop_cached(cachekey, tmpl)
+                                raise
                     finally:
                         if hasattr(fileobj, 'close'):
                             fileobj.close()
                     return tmpl
 
+            self._record('not_found', cachekey, 1)
             raise TemplateNotFound(filename, search_path)
 
+        finally:
+            self._release_load_lock(cachekey, lock)
+
+    def _get_cached(self, cachekey):
+        """Return the template cached under the given key, or `None` if it is
+        not cached, or needs to be reloaded.
+        
+        This does not wait for other threads using the loader.
+        """
+        tmpl = self._cache.peek(cachekey)
+        if tmpl is None:
+            return None
+
+        if self.auto_reload and cachekey not in self._watched:
+            uptodate = self._uptodate.get(cachekey)
+            try:
+                changed = uptodate is None or not uptodate()
+                if not changed:
+                    # Templates inlined into this one need to be unchanged,
+                    # too, as they are not loaded again when rendering it
+                    for path, mtime in list(tmpl._dependencies.items()):
+                        if os.path.getmtime(path) != mtime:
+                            changed = True
+                            break
+            except OSError:
+                changed = True
+            if changed:
+                self._lock.acquire()
+                try:
+                    # Unless another thread got here first
+                    dropped = self._cache.peek(cachekey) is tmpl
+                    if dropped:
+                        del self._cache[cachekey]
+                finally:
+                    self._lock.release()
+                if dropped:
+                    self._record('reload', cachekey, 1)
+                return None
+            if self.watcher is not None and tmpl._prepared and \
+                    os.path.isfile(tmpl.filepath):
+                # Only now that the template has been prepared it is known
+                # which files need to be watched
+                self._watch(cachekey,
+                            [tmpl.filepath] + list(tmpl._dependencies))
+
+        # Mark the template as recently used, unless another thread is
+        # currently modifying the cache
+        if self._lock.acquire(False):
+            try:
+                try:
+                    self._cache[cachekey]
+                except KeyError:
+                    pass
+            finally:
+                self._lock.release()
+        return tmpl
+
+    def _drop_cached(self, cachekey, tmpl):
+        """Remove the given template from the cache, unless another thread has
+        replaced it in the meantime.
+        """
+        self._lock.acquire()
+        try:
+            if self._cache.peek(cachekey) is tmpl:
+                del self._cache[cachekey]
+                self._uptodate.pop(cachekey, None)
+        finally:
+            self._lock.release()
+
+    def _load_lock(self, cachekey):
+        """Return the lock held while loading the template with the given
+        cache key.
+        
+        Every call must be paired with a call to `_release_load_lock()`, so
+        that the lock is discarded once no thread is using it anymore.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._load_locks.get(cachekey)
+            if entry is None:
+                entry = self._load_locks[cachekey] = [threading.RLock(), 0]
+            entry[1] += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def _release_load_lock(self, cachekey, lock):
+        """Release a lock returned by `_load_lock()`, and discard it if no
+        other thread is waiting for it.
+        """
+        lock.release()
+        self._lock.acquire()
+        try:
+            entry = self._load_locks[cachekey]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._load_locks[cachekey]
         finally:
             self._lock.release()
 
+    def stats(self):
+        """Return statistics about the templates loaded by this loader.
+        
+        The result is a dictionary with the following items:
+        
+         * ``hits``: the number of templates found in the cache
+         * ``misses``: the number of templates that needed to be loaded
+         * ``evictions``: the number of templates dropped from the cache to
+           make room for other templates (if this keeps growing, the cache is
+           probably too small)
+         * ``reloads``: the number of cached templates dropped because their
+           files have changed (with ``auto_reload`` enabled)
+         * ``not_found``: the number of templates that could not be found
+         * ``parse_time``: the total number of seconds spent parsing templates
+         * ``prepare_time``: the total number of seconds spent preparing
+           templates for their first rendering
+         * ``templates``: a dictionary of dictionaries with the ``parses``,
+           ``parse_time`` and ``prepare_time`` of every template, by filename
+        
+        The time spent preparing a template includes the time spent loading
+        and preparing the templates inlined into it.
+        
+        >>> loader = TemplateLoader()
+        >>> loader.stats()['hits']
+        0
+        
+        :return: the statistics
+        :rtype: `dict`
+        :since: version 0.8
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = self._counts.copy()
+            stats['hits'] = next(self._hits) - self._hits_read
+            self._hits_read += 1
+            stats['templates'] = templates = {}
+            stats['parse_time'] = stats['prepare_time'] = 0.0
+            for filename, timings in self._timings.items():
+                templates[filename] = timings.copy()
+                stats['parse_time'] += timings['parse_time']
+                stats['prepare_time'] += timings['prepare_time']
+            return stats
+        finally:
+            self._stats_lock.release()
+
+    def _record(self, event, filename, value):
+        """Add the given event to the statistics of the loader, and pass it
+        on to the `monitor` function.
+        
+        :param event: the name of the event; one of "miss", "eviction",
+                      "reload", "not_found", "parse" or "prepare"
+        :param filename: the filename of the template concerned, or `None`
+        :param value: the number of seconds spent for the "parse" and "prepare"
+                      events, and the number of events otherwise
+        """
+        self._stats_lock.acquire()
+        try:
+            if event in _COUNTED:
+                self._counts[_COUNTED[event]] += value
+            else:
+                timings = self._timings.get(filename)
+                if timings is None:
+                    timings = self._timings[filename] = {
+                        'parses': 0, 'parse_time': 0.0, 'prepare_time': 0.0
+                    }
+                if event == 'parse':
+                    timings['parses'] += 1
+                timings[event + '_time'] += value
+        finally:
+            self._stats_lock.release()
+        if self.monitor is not None:
+            self.monitor(event, filename, value)
+
+    def _record_hit(self, filename):
+        """Count a template found in the cache, without acquiring the lock
+        protecting the other statistics.
+        """
+        next(self._hits)
+        if self.monitor_hits and self.monitor is not None:
+            self.monitor('hit', filename, 1)
+
+    def render_many(self, filename, contexts, method=None, encoding='utf-8',
+                    processes=None, ordered=True, chunksize=1, cls=None,
+                    **kwargs):
+        """Render a template with each of the given sets of context data, using
+        a pool of worker processes.
+        
+        Every worker process gets a copy of the loader, which it uses to load
+        and cache the template (and any templates it includes) the first time
+        it is needed. The rendered output is returned as it becomes available,
+        so the results can be processed while the remaining contexts are still
+        being rendered.
+        
+        The loader (including the `callback`, if any) and the context data
+        must be picklable on platforms where new processes are not forked.
+        
+        Any additional keyword arguments are passed to the serializer, and thus
+        depend on the `method` parameter value.
+        
+        :param filename: the relative path of the template file to render
+        :param contexts: an iterable of dictionaries, each containing the data
+                         for rendering the template once
+        :param method: the serialization method; if `None`, the default method
+                       of the template is used
+        :param encoding: how the output should be encoded; if set to `None`,
+                         the output is returned as `unicode` objects
+        :param processes: the number of worker processes to use; defaults to
+                          the number of CPUs
+        :param ordered: if `True`, the rendered output is returned in the order
+                        of the contexts; otherwise, ``(index, output)`` tuples
+                        are returned in the order in which rendering completes,
+                        where ``index`` is the position of the corresponding
+                        context
+        :param chunksize: the number of contexts sent to a worker process at
+                          once; larger values reduce the communication
+                          overhead when rendering many small documents
+        :param cls: the class of the template object to instantiate
+        :return: an iterator over the rendered output
+        :since: version 0.8
+        """
+        from multiprocessing import Pool
+        tasks = ((index, filename, cls, data, method, encoding, kwargs)
+                 for index, data in enumerate(contexts))
+        pool = Pool(processes, _init_render_worker, (self,))
+        try:
+            if ordered:
+                for index, output in pool.imap(_render_worker, tasks,
+                                               chunksize):
+                    yield output
+            else:
+                for result in pool.imap_unordered(_render_worker, tasks,
+                                                  chunksize):
+                    yield result
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
     def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
         """Instantiate and return the `Template` object based on the given
         class and parameters.
@@ -273,6 +632,154 @@ class TemplateLoader(object):
                    encoding=encoding, lookup=self.variable_lookup,
                    allow_exec=self.allow_exec)
 
+    def _watch(self, cachekey, paths):
+        """Have the watcher report changes to the given files, which the
+        template cached under the given key has been loaded from.
+        """
+        self._lock.acquire()
+        try:
+            self._watched.add(cachekey)
+            for path in paths:
+                cachekeys = self._dependents.get(path)
+                if cachekeys is None:
+                    cachekeys = self._dependents[path] = set()
+                    self.watcher.watch(path, self._changed)
+                cachekeys.add(cachekey)
+        finally:
+            self._lock.release()
+
+    def _changed(self, path):
+        """Called by the watcher when the given file has changed, to drop any
+        templates depending on it from the cache.
+        """
+        self._lock.acquire()
+        try:
+            dropped = []
+            for cachekey in self._dependents.pop(path, ()):
+                self._watched.discard(cachekey)
+                try:
+                    del self._cache[cachekey]
+                except KeyError:
+                    pass
+                else:
+                    dropped.append(cachekey)
+        finally:
+            self._lock.release()
+        for cachekey in dropped:
+            self._record('reload', cachekey, 1)
+
+    def _cache_path(self, cls, filepath):
+        key = '%s.%s:%s' % (cls.__module__, cls.__name__, filepath)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.cache_dir, sha1(key).hexdigest() + '.cache')
+
+    def _cache_header(self, filepath, encoding, dependencies=()):
+        """Return the header identifying a cache entry for the given template
+        file, or ``None`` if the template can not be cached because it (or one
+        of the templates inlined into it) is not loaded from a local file.
+        """
+        if encoding is None:
+            encoding = self.default_encoding
+        mtimes = []
+        for path in [filepath] + sorted(dependencies):
+            try:
+                mtimes.append((path, os.path.getmtime(path)))
+            except (OSError, TypeError):
+                return None
+        lookup = self.variable_lookup
+        if not isinstance(lookup, basestring):
+            lookup = _qualified_name(lookup)
+        # Included templates are looked up on the search path, and the
+        # callback may register directives, both of which change what the
+        # prepared template looks like
+        search_path = []
+        for loadfunc in self.search_path:
+            if isinstance(loadfunc, basestring):
+                search_path.append(os.path.abspath(loadfunc))
+            else:
+                search_path.append(_qualified_name(loadfunc))
+        callback = None
+        if self.callback is not None:
+            callback = _qualified_name(self.callback)
+        return (VERSION, tuple(sys.version_info), encoding, lookup,
+                self.allow_exec, search_path, callback, mtimes)
+
+    def _load_cached(self, cls, filepath, filename, encoding=None):
+        """Try to restore a template from the cache directory.
+        
+        :return: the restored `Template` instance, or ``None`` if no entry
+                 for the template exists, or the entry is out of date or
+                 corrupt
+        """
+        path = self._cache_path(cls, filepath)
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                header = pickle.load(fileobj)
+                if header[-1][0][0] != filepath or header != \
+                        self._cache_header(filepath, encoding,
+                                           [p for p, _ in header[-1][1:]]):
+                    return None
+                state = pickle.load(fileobj)
+            finally:
+                fileobj.close()
+        except Exception:
+            # The entry is unreadable, probably because it was only written
+            # partially, or by an incompatible version of Genshi
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        tmpl = cls.__new__(cls)
+        tmpl.__setstate__(state)
+        tmpl._dependencies = dict(header[-1][1:])
+        tmpl.filename = filename
+        tmpl.loader = self
+        return tmpl
+
+    def _store_cached(self, tmpl, filepath, encoding=None):
+        """Write the prepared state of the given template to the cache
+        directory.
+        
+        Any errors are ignored, as the cache only serves to speed up loading.
+        """
+        if self._cache_header(filepath, encoding) is None:
+            return
+        tmpl.stream # make sure the template has been prepared
+        header = self._cache_header(filepath, encoding, tmpl._dependencies)
+        if header is None:
+            return
+        state = tmpl.__getstate__()
+        state['loader'] = None
+        state.pop('fragment_cache', None) # set again when loaded
+        tmppath = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(header, fileobj, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(state, fileobj, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fileobj.close()
+            path = self._cache_path(type(tmpl), filepath)
+            try:
+                os.rename(tmppath, path)
+            except OSError:
+                # Windows doesn't allow renaming to an existing file
+                os.remove(path)
+                os.rename(tmppath, path)
+        except Exception:
+            if tmppath is not None and os.path.exists(tmppath):
+                os.remove(tmppath)
+
     @staticmethod
     def directory(path):
         """Loader factory for loading templates from a local directory.
@@ -339,6 +846,34 @@ class TemplateLoader(object):
         return _dispatch_by_prefix
 
 
+def _qualified_name(obj):
+    """Return a name identifying the given class or function (or bound
+    method, or callable object) across processes.
+    """
+    name = getattr(obj, '__name__', None)
+    if name is None:
+        name = type(obj).__name__
+    owner = getattr(obj, '__self__', None)
+    if owner is not None:
+        name = '%s.%s' % (type(owner).__name__, name)
+    module = getattr(obj, '__module__', None) or type(obj).__module__
+    return '%s.%s' % (module, name)
+
+
+# The loader used by the worker processes of `TemplateLoader.render_many`
+_worker_loader = None
+
+def _init_render_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+
+def _render_worker(task):
+    index, filename, cls, data, method, encoding, kwargs = task
+    tmpl = _worker_loader.load(filename, cls=cls)
+    return index, tmpl.generate(**data).render(method, encoding=encoding,
+                                               **kwargs)
+
+
 directory = TemplateLoader.directory
 package = TemplateLoader.package
 prefixed = TemplateLoader.prefixed
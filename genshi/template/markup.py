@@ -18,6 +18,7 @@ from itertools import chain
 from genshi.core import Attrs, Markup, Namespace, Stream, StreamEventKind
 from genshi.core import START, END, START_NS, END_NS, TEXT, PI, COMMENT
 from genshi.input import XMLParser
+from genshi.output import STATIC
 from genshi.template.base import BadDirectiveError, Template, \
                                  TemplateSyntaxError, _apply_directives, \
                                  EXEC, INCLUDE, SUB
@@ -46,6 +47,7 @@ class MarkupTemplate(Template):
     XINCLUDE_NAMESPACE = 'http://www.w3.org/2001/XInclude'
 
     directives = [('def', DefDirective),
+                  ('memoize', MemoizeDirective),
                   ('match', MatchDirective),
                   ('when', WhenDirective),
                   ('otherwise', OtherwiseDirective),
@@ -53,6 +55,7 @@ class MarkupTemplate(Template):
                   ('if', IfDirective),
                   ('choose', ChooseDirective),
                   ('with', WithDirective),
+                  ('cache', CacheDirective),
                   ('replace', ReplaceDirective),
                   ('content', ContentDirective),
                   ('attrs', AttrsDirective),
@@ -65,6 +68,7 @@ class MarkupTemplate(Template):
         Template.__init__(self, source, filepath=filepath, filename=filename,
                           loader=loader, encoding=encoding, lookup=lookup,
                           allow_exec=allow_exec)
+        self._namespaces = set() # namespaces with registered directives
         self.add_directives(self.DIRECTIVE_NAMESPACE, self)
 
     def _init_filters(self):
@@ -292,16 +296,22 @@ class MarkupTemplate(Template):
     def add_directives(self, namespace, factory):
         """Register a custom `DirectiveFactory` for a given namespace.
         
+        Registering directives for a namespace that has already been
+        registered has no effect.
+        
         :param namespace: the namespace URI
         :type namespace: `basestring`
         :param factory: the directive factory to register
         :type factory: `DirectiveFactory`
         :since: version 0.6
         """
+        if namespace in self._namespaces:
+            return
         assert not self._prepared, 'Too late for adding directives, ' \
                                    'template already prepared'
         self._stream = self._extract_directives(self._stream, namespace,
                                                 factory)
+        self._namespaces.add(namespace)
 
     def _match(self, stream, ctxt, start=0, end=None, **vars):
         """Internal stream filter that applies any defined match templates
@@ -309,6 +319,45 @@ class MarkupTemplate(Template):
         """
         match_templates = ctxt._match_templates
 
+        # Match templates whose path can only match elements with specific
+        # names are indexed by those names, so that every event is only
+        # tested against the templates that could possibly match it; the
+        # test functions of these templates don't need to see any other
+        # events, as they do not keep any state for them. The index is rebuilt
+        # whenever match templates are added or removed.
+        index = [None, None, {}]
+        def _candidates(name):
+            if index[0] != ctxt._match_changes:
+                index[0] = ctxt._match_changes
+                index[1] = [mt[1]._element_names() for mt in match_templates]
+                index[2] = {}
+            candidates = index[2].get(name)
+            if candidates is None:
+                stop = len(match_templates)
+                if end is not None:
+                    stop = min(stop, end)
+                candidates = index[2][name] = [
+                    (idx, match_templates[idx]) for idx in range(start, stop)
+                    if index[1][idx] is None or name in index[1][idx]
+                ]
+            return candidates
+
+        def _expand(stream):
+            # Runs of static events need to be examined event by event if
+            # there are any match templates that might match an element in
+            # the run
+            for event in stream:
+                if event[0] is STATIC and match_templates and (
+                        _candidates(None) or
+                        [1 for name in event[1].derive((_localnames,),
+                                                       _localnames)
+                         if _candidates(name)]):
+                    for event in event[1].events:
+                        yield event
+                else:
+                    yield event
+        stream = _expand(stream)
+
         def _strip(stream, append):
             depth = 1
             next = stream.next
@@ -333,14 +382,16 @@ class MarkupTemplate(Template):
                 yield event
                 continue
 
+            if event[0] is START:
+                candidates = _candidates(event[1][0].localname)
+            else:
+                candidates = _candidates(None)
             for idx, (test, path, template, hints, namespaces, directives) \
-                    in enumerate(match_templates):
-                if idx < start or end is not None and idx >= end:
-                    continue
-
+                    in candidates:
                 if test(event, namespaces, ctxt) is True:
                     if 'match_once' in hints:
                         del match_templates[idx]
+                        ctxt._match_changes += 1
                         idx -= 1
 
                     # Let the remaining match templates know about the event so
@@ -397,3 +448,9 @@ class MarkupTemplate(Template):
 
             else: # no matches
                 yield event
+
+
+def _localnames(events):
+    """Return the set of local names of the elements in a static run."""
+    return frozenset([data[0].localname for kind, data, pos in events
+                      if kind is START])
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Profiling of template rendering by expression and directive.
+
+A `Profiler` measures the time spent evaluating every expression, executing
+every code block, applying every directive and generating every included
+template while a template is rendered, and aggregates those measurements by
+the location of the code in the template source:
+
+>>> from genshi.template import MarkupTemplate
+>>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+...   <li py:for="item in items">${item.upper()}</li>
+... </ul>''', filename='list.html')
+>>> profiler = Profiler()
+>>> output = tmpl.generate(profiler.context(items=['a', 'b'])).render()
+>>> for (filename, lineno, code), stats in sorted(profiler.stats.items()):
+...     print('%s:%d %s calls=%d events=%d' % (filename, lineno, code,
+...                                            stats[0], stats[1]))
+list.html:2 ${item.upper()} calls=2 events=0
+list.html:2 ${iter(items)} calls=1 events=0
+list.html:2 py:for="iter(items)" calls=1 events=6
+
+Directives are listed separately from the expressions they evaluate, and the
+time recorded for a directive includes the time spent in its body.
+
+Profiling only affects templates rendered with a context returned by the
+`context()` method (or passed to `enable()`); rendering with any other context
+does not involve the profiler at all.
+"""
+
+import marshal
+import sys
+from timeit import default_timer as timer
+
+from genshi.template.base import Context
+from genshi.template.eval import Code, Expression
+
+__all__ = ['Profiler']
+__docformat__ = 'restructuredtext en'
+
+
+class Profiler(object):
+    """Collects timings of the code in templates rendered with its contexts.
+    
+    The collected data is available as the `stats` dictionary, which maps
+    ``(filename, lineno, code)`` tuples to lists of four numbers:
+    
+     * the number of calls, that is how often an expression was evaluated, a
+       code block executed, a directive applied, or a template included
+     * the number of events produced by the directive or included template
+     * the time spent (in seconds), excluding the time spent in other code
+       recorded by the profiler
+     * the time spent, including the time spent in other code (such as the
+       expressions in the body of a ``py:for`` loop)
+    
+    A profiler should only be used for rendering one template at a time.
+    """
+
+    def __init__(self):
+        self._data = {} # the collected data, by expression or directive
+        self._stack = [] # [start time, time spent in nested code] pairs
+
+    @property
+    def stats(self):
+        """The collected data, as a dictionary of lists by ``(filename,
+        lineno, code)`` tuples.
+        """
+        stats = {}
+        for obj, data in self._data.items():
+            key = _key(obj)
+            total = stats.get(key)
+            if total is None:
+                stats[key] = list(data)
+            else:
+                for idx, value in enumerate(data):
+                    total[idx] += value
+        return stats
+
+    def context(self, **data):
+        """Create a template context that records timings in this profiler.
+        
+        :param data: the context data
+        :return: the new `Context`
+        """
+        return self.enable(Context(**data))
+
+    def enable(self, ctxt):
+        """Record timings of the templates rendered with the given context in
+        this profiler.
+        
+        :param ctxt: the `Context`
+        :return: the context
+        """
+        # Forget about any measurements not completed because rendering
+        # with a previous context failed
+        del self._stack[:]
+        ctxt._profiler = self
+        return ctxt
+
+    def clear(self):
+        """Discard the collected data."""
+        self._data.clear()
+        del self._stack[:]
+
+    def sorted_stats(self, sort='tottime'):
+        """Return the collected data sorted by the given column.
+        
+        :param sort: one of "calls", "events", "tottime" or "cumtime"
+        :return: a list of ``((filename, lineno, code), stats)`` tuples, in
+                 descending order of the sort column
+        """
+        index = ['calls', 'events', 'tottime', 'cumtime'].index(sort)
+        return sorted(self.stats.items(), key=lambda item: item[1][index],
+                      reverse=True)
+
+    def print_stats(self, sort='tottime', limit=None, out=None):
+        """Write a report of the collected data.
+        
+        :param sort: the column to sort by; one of "calls", "events",
+                     "tottime" or "cumtime"
+        :param limit: the maximum number of lines to write
+        :param out: the file-like object to write to; defaults to
+                    ``sys.stdout``
+        """
+        if out is None:
+            out = sys.stdout
+        out.write('%9s %9s %9s %9s  %s\n' % ('calls', 'events', 'tottime',
+                                             'cumtime',
+                                             'filename:lineno(code)'))
+        for (filename, lineno, code), stats in \
+                self.sorted_stats(sort)[:limit]:
+            out.write('%9d %9d %9.4f %9.4f  %s:%d(%s)\n' % (
+                tuple(stats) + (filename, lineno, code)
+            ))
+
+    def dump_stats(self, filename):
+        """Write the collected data to a file that can be read by the
+        `pstats` module of the standard library.
+        
+        :param filename: the path of the file to write
+        """
+        stats = {}
+        for key, (calls, events, tottime, cumtime) in self.stats.items():
+            stats[key] = (calls, calls, tottime, cumtime, {})
+        fileobj = open(filename, 'wb')
+        try:
+            marshal.dump(stats, fileobj)
+        finally:
+            fileobj.close()
+
+    def _start(self):
+        """Start measuring the time spent in some code.
+        
+        :return: the marker to pass to `_stop()`
+        """
+        stack = self._stack
+        stack.append([timer(), 0.0])
+        return len(stack)
+
+    def _stop(self, marker, obj, calls=1, events=0):
+        """Stop measuring the time spent in some code, and record it.
+        
+        Any measurements started later but not stopped (because an exception
+        was raised) are discarded.
+        
+        :param marker: the marker returned by `_start()`
+        :param obj: the code measured; an `Expression` or `Suite`, a
+                    directive, or a ``(filename, lineno, code)`` tuple
+        :param calls: the number of calls to record
+        :param events: the number of events to record
+        """
+        end = timer()
+        stack = self._stack
+        start, nested = stack[marker - 1]
+        del stack[marker - 1:]
+        elapsed = end - start
+        if stack:
+            stack[-1][1] += elapsed
+        data = self._data.get(obj)
+        if data is None:
+            data = self._data[obj] = [0, 0, 0.0, 0.0]
+        data[0] += calls
+        data[1] += events
+        data[2] += elapsed - nested
+        data[3] += elapsed
+
+    def _stream(self, marker, obj, stream):
+        """Stop the measurement with the given marker, which produced the
+        given stream, and record the time spent producing its events, too.
+        """
+        self._stop(marker, obj)
+        stream = iter(stream)
+        while 1:
+            marker = self._start()
+            try:
+                event = next(stream)
+            except StopIteration:
+                self._stop(marker, obj, 0)
+                return
+            except:
+                self._stop(marker, obj, 0)
+                raise
+            self._stop(marker, obj, 0, 1)
+            yield event
+
+
+def _key(obj):
+    """Return the ``(filename, lineno, code)`` tuple describing the given
+    code, which is an `Expression` or `Suite`, a directive, or already such a
+    tuple.
+    """
+    if isinstance(obj, tuple):
+        return obj
+    if isinstance(obj, Code):
+        source = obj.source.strip()
+        if isinstance(obj, Expression):
+            label = '${%s}' % source
+        else:
+            lines = source.splitlines() or ['']
+            label = '<?python %s%s ?>' % (lines[0].strip(),
+                                          len(lines) > 1 and ' ...' or '')
+        return obj.code.co_filename, obj.code.co_firstlineno, label
+    tagname = getattr(obj, 'tagname', None)
+    if tagname is None:
+        # Anonymous directive
+        return '<string>', -1, getattr(obj, '__name__', repr(obj))
+    expr = getattr(obj, 'expr', None)
+    if expr is None:
+        return '<string>', -1, 'py:%s' % tagname
+    filename, lineno, _ = _key(expr)
+    return filename, lineno, 'py:%s="%s"' % (tagname, expr.source)
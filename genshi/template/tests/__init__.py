@@ -15,17 +15,22 @@ import doctest
 import unittest
 
 def suite():
-    from genshi.template.tests import base, directives, eval, interpolation, \
-                                      loader, markup, plugin, text
+    from genshi.template.tests import base, codegen, compile, directives, \
+                                      eval, interpolation, loader, markup, \
+                                      plugin, profiler, text, watcher
     suite = unittest.TestSuite()
     suite.addTest(base.suite())
+    suite.addTest(codegen.suite())
+    suite.addTest(compile.suite())
     suite.addTest(directives.suite())
     suite.addTest(eval.suite())
     suite.addTest(interpolation.suite())
     suite.addTest(loader.suite())
     suite.addTest(markup.suite())
     suite.addTest(plugin.suite())
+    suite.addTest(profiler.suite())
     suite.addTest(text.suite())
+    suite.addTest(watcher.suite())
     return suite
 
 if __name__ == '__main__':
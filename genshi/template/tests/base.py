@@ -31,6 +31,62 @@ class ContextTestCase(unittest.TestCase):
         self.assertEqual(orig_ctxt._match_templates, ctxt._match_templates)
         self.assertEqual(orig_ctxt._choice_stack, ctxt._choice_stack)
 
+    def test_copy_independent_scopes(self):
+        orig_ctxt = Context(a=5)
+        orig_ctxt.push({'a': 6})
+        ctxt = orig_ctxt.copy()
+        ctxt.pop()
+        self.assertEqual(5, ctxt['a'])
+        self.assertEqual(6, orig_ctxt['a'])
+
+    def test_shadowing(self):
+        ctxt = Context(a=1, b=2)
+        ctxt.push({'a': 3})
+        ctxt.push({})
+        ctxt['b'] = 4
+        self.assertEqual(3, ctxt['a'])
+        self.assertEqual(4, ctxt['b'])
+        self.assertEqual({'b': 4}, ctxt.pop())
+        self.assertEqual(2, ctxt['b'])
+        self.assertEqual({'a': 3}, ctxt.pop())
+        self.assertEqual(1, ctxt['a'])
+        self.assertEqual(4, len(ctxt)) # including defined() and value_of()
+
+    def test_same_scope_pushed_twice(self):
+        ctxt = Context(a=1)
+        scope = {'a': 2}
+        ctxt.push(scope)
+        ctxt.push({'a': 3})
+        ctxt.push(scope)
+        self.assertEqual(2, ctxt['a'])
+        ctxt.pop()
+        self.assertEqual(3, ctxt['a'])
+        ctxt.pop()
+        self.assertEqual(2, ctxt['a'])
+        ctxt.pop()
+        self.assertEqual(1, ctxt['a'])
+
+    def test_delitem(self):
+        ctxt = Context(a=1)
+        ctxt.push({'a': 2})
+        del ctxt['a']
+        assert 'a' not in ctxt
+        self.assertEqual(None, ctxt.get('a'))
+        ctxt['a'] = 3
+        ctxt.pop()
+        assert 'a' not in ctxt
+
+    def test_set_global(self):
+        ctxt = Context(a=1)
+        ctxt.push({'b': 2})
+        ctxt._set_global('b', 3)
+        ctxt._set_global('c', 4)
+        self.assertEqual(2, ctxt['b'])
+        self.assertEqual(4, ctxt['c'])
+        ctxt.pop()
+        self.assertEqual(3, ctxt['b'])
+        self.assertEqual(4, ctxt['c'])
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from genshi.core import Markup
+from genshi.template import codegen
+from genshi.template.base import Context, TemplateRuntimeError
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+
+class CompiledTemplateTestCase(unittest.TestCase):
+    """Tests that compiled templates produce the same output as interpreted
+    ones."""
+
+    def _render(self, source, cls=MarkupTemplate, **data):
+        tmpl = cls(source)
+        expected = tmpl.generate(**data).render(encoding=None)
+        tmpl = cls(source)
+        tmpl.compiled = True
+        output = tmpl.generate(**data).render(encoding=None)
+        self.assertEqual(expected, output)
+        self.assertTrue(tmpl._code is not None)
+        return output
+
+    def test_static(self):
+        self.assertEqual('<p class="x">Hello <b>world</b></p>', self._render(
+            '<p class="x">Hello <b>world</b></p>'))
+
+    def test_expressions(self):
+        self._render("""<div>
+          ${foo} ${1 + 2} ${markup} ${None} ${items}
+          ${(x for x in 'abc')}
+        </div>""", foo='<bar>', items=[1, 2], markup=Markup('<br/>'))
+
+    def test_interpolated_attrs(self):
+        self.assertEqual('<p class="a1" id="x"/>', self._render(
+            '<p class="a$num" title="$none" id="x"/>', num=1, none=None))
+
+    def test_for_if(self):
+        self.assertEqual("""<ul>
+          <li>1</li><li>3</li>
+        </ul>""", self._render("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items" py:if="item % 2">${item}</li>
+        </ul>""", items=[1, 2, 3]))
+
+    def test_nested_for_tuple_unpacking(self):
+        self._render("""<table xmlns:py="http://genshi.edgewall.org/">
+          <tr py:for="idx, row in enumerate(rows)">
+            <td py:for="col in row" py:content="idx * col"/>
+          </tr>
+        </table>""", rows=[[1, 2], [3, 4]])
+
+    def test_for_generator_context(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items">${item}</li>
+        </ul>""")
+        tmpl.compiled = True
+        ctxt = Context()
+        defined = []
+        def items():
+            for i in range(2):
+                defined.append('item' in ctxt)
+                yield i
+        ctxt['items'] = items()
+        tmpl.generate(ctxt).render(encoding=None)
+        self.assertEqual([False, False], defined)
+
+    def test_choose(self):
+        self._render("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="num in range(4)">
+            <py:choose test="num">
+              <span py:when="0">zero</span>
+              <span py:when="1">one</span>
+              <span py:otherwise="">many</span>
+            </py:choose>
+            <py:choose>
+              <span py:when="num % 2">odd</span>
+              <span py:otherwise="">even</span>
+            </py:choose>
+          </py:for>
+        </div>""")
+
+    def test_when_outside_choose(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <div py:when="1"></div>
+        </div>""")
+        tmpl.compiled = True
+        self.assertRaises(TemplateRuntimeError, str, tmpl.generate())
+
+    def test_with_strip_attrs(self):
+        self._render("""<div xmlns:py="http://genshi.edgewall.org/">
+          <span py:with="x = 1; y = x + 1" py:strip="">$x $y</span>
+          <span py:strip="strip" py:attrs="attrs">text</span>
+          <span py:attrs="attrs" title="$x">text</span>
+          <span py:replace="'replaced'">text</span>
+        </div>""", strip=False, attrs={'class': 'foo'}, x=None)
+
+    def test_def_and_match(self):
+        self._render("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:def="greeting(name)">Hello, ${name}!</p>
+          <span py:match="greet">${greeting(select('@name'))}</span>
+          <greet name="world"/>
+          ${greeting('you')}
+        </div>""")
+
+    def test_exec(self):
+        self._render("""<div xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            x = [i * 2 for i in range(3)]
+          ?>
+          <b py:for="i in x">$i</b>
+        </div>""")
+
+    def test_text_template(self):
+        self._render("""{% for item in items %}\
+* ${item}
+{% if item == 2 %}two{% end %}\
+{% end %}""", cls=NewTextTemplate, items=[1, 2])
+
+    def test_deep_nesting(self):
+        depth = codegen.MAX_BLOCKS + 2
+        source = ['<div xmlns:py="http://genshi.edgewall.org/">']
+        for idx in range(depth):
+            source.append('<py:for each="x%d in range(%d)">' % (idx, idx % 2 + 1))
+        source.append('${x0 + x%d}' % (depth - 1))
+        source.extend(['</py:for>'] * depth)
+        source.append('</div>')
+        self._render(''.join(source))
+
+    def test_pickle(self):
+        tmpl = MarkupTemplate('<p>$foo</p>')
+        tmpl.compiled = True
+        self.assertEqual('<p>bar</p>', str(tmpl.generate(foo='bar')))
+        tmpl = pickle.loads(pickle.dumps(tmpl, 2))
+        self.assertEqual(None, tmpl._code)
+        self.assertEqual('<p>baz</p>', str(tmpl.generate(foo='baz')))
+
+
+class CompiledLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_loader_option(self):
+        file1 = open(os.path.join(self.dirname, 'tmpl1.html'), 'w')
+        try:
+            file1.write("""<div>Included $foo</div>""")
+        finally:
+            file1.close()
+        file2 = open(os.path.join(self.dirname, 'tmpl2.html'), 'w')
+        try:
+            file2.write("""<html xmlns:xi="http://www.w3.org/2001/XInclude">
+              <xi:include href="tmpl1.html" />
+            </html>""")
+        finally:
+            file2.close()
+
+        loader = TemplateLoader([self.dirname], compiled=True)
+        tmpl = loader.load('tmpl2.html')
+        self.assertTrue(tmpl.compiled)
+        self.assertEqual("""<html>
+              <div>Included bar</div>
+            </html>""", tmpl.generate(foo='bar').render(encoding=None))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(codegen))
+    suite.addTest(unittest.makeSuite(CompiledTemplateTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CompiledLoaderTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from genshi.compat import StringIO
+from genshi.template.compile import compile_templates, find_templates, main
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+
+class CompileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='compile_test')
+        self.cache_dir = os.path.join(self.dirname, 'cache')
+        self._write('index.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="layout/footer.html" />
+        </html>""")
+        self._write(os.path.join('layout', 'footer.html'), """<p>Footer</p>""")
+        self._write('mail.txt', """Hello {% if name %}$name{% end %}""")
+        self._write('README', """Not a template""")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, name, content):
+        path = os.path.join(self.dirname, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fileobj = open(path, 'w')
+        try:
+            fileobj.write(content)
+        finally:
+            fileobj.close()
+
+    def test_find_templates(self):
+        os.mkdir(self.cache_dir)
+        self._write(os.path.join('cache', 'stale.html'), """<p/>""")
+        self.assertEqual([
+            ('index.html', MarkupTemplate),
+            ('mail.txt', NewTextTemplate),
+            (os.path.join('layout', 'footer.html'), MarkupTemplate)
+        ], list(find_templates([self.dirname], exclude=[self.cache_dir])))
+
+    def test_compile_templates(self):
+        results = list(compile_templates([self.dirname], self.cache_dir,
+                                         processes=1))
+        self.assertEqual([('index.html', None), ('mail.txt', None),
+                          (os.path.join('layout', 'footer.html'), None)],
+                         results)
+        self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+        instantiated = []
+        class CountingLoader(TemplateLoader):
+            def _instantiate(self, *args, **kwargs):
+                instantiated.append(args)
+                return TemplateLoader._instantiate(self, *args, **kwargs)
+        loader = CountingLoader([self.dirname], cache_dir=self.cache_dir)
+        tmpl = loader.load('index.html')
+        self.assertEqual("""<html>
+          <p>Footer</p>
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertEqual([], instantiated)
+
+    def test_compile_templates_errors(self):
+        self._write('broken.html', """<html>
+          <p>
+        </html>""")
+        self._write('missing.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="missing_include.html" />
+        </html>""")
+        errors = dict([(filename, error) for filename, error
+                       in compile_templates([self.dirname], processes=1)
+                       if error])
+        self.assertEqual(['broken.html', 'missing.html'], sorted(errors))
+        path = os.path.join(self.dirname, 'broken.html')
+        self.assertEqual((path, 3), errors['broken.html'][:2])
+        self.assertEqual(('missing.html', -1,
+                          'Template "missing_include.html" not found'),
+                         errors['missing.html'])
+
+    def test_main(self):
+        self._write('broken.html', """<html>
+          <p>
+        </html>""")
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            status = main(['-j', '1', '-q', '-c', self.cache_dir,
+                           self.dirname])
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(1, status)
+        self.assertEqual('', output)
+        path = os.path.join(self.dirname, 'broken.html')
+        self.assertTrue(errors.startswith('%s:3: ' % path))
+        self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+    def test_main_loader_options(self):
+        self._write('i18n.html', """<html xmlns:py="http://genshi.edgewall.org/"
+            xmlns:i18n="http://genshi.edgewall.org/i18n">
+          <p i18n:msg="name">Hello, ${name}!</p>
+        </html>""")
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = main(['-j', '1', '-c', self.cache_dir, '-l', 'lenient',
+                           '--no-exec', '--callback',
+                           'genshi.template.tests.compile._callback',
+                           self.dirname])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(0, status)
+
+        instantiated = []
+        class CountingLoader(TemplateLoader):
+            def _instantiate(self, *args, **kwargs):
+                instantiated.append(args)
+                return TemplateLoader._instantiate(self, *args, **kwargs)
+        loader = CountingLoader([self.dirname], cache_dir=self.cache_dir,
+                                variable_lookup='lenient', allow_exec=False,
+                                callback=_callback)
+        tmpl = loader.load('i18n.html')
+        self.assertEqual([], instantiated)
+        self.assertEqual("""<html>
+          <p>Hi, Jim!</p>
+        </html>""", tmpl.generate(name='Jim').render(encoding=None))
+
+        loader = CountingLoader([self.dirname], cache_dir=self.cache_dir,
+                                callback=_callback)
+        loader.load('i18n.html')
+        self.assertEqual(1, len(instantiated))
+
+
+def _callback(template):
+    from genshi.filters.i18n import Translator
+    Translator(lambda s: s.replace('Hello', 'Hi')).setup(template)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CompileTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -12,12 +12,18 @@
 # history and logs, available at http://genshi.edgewall.org/log/.
 
 import doctest
+import os
 import re
+import shutil
 import sys
+import tempfile
 import unittest
 
-from genshi.template import directives, MarkupTemplate, TextTemplate, \
-                            TemplateRuntimeError, TemplateSyntaxError
+from genshi.core import Markup, Stream, TEXT
+from genshi.template import directives, Context, MarkupTemplate, \
+                            TextTemplate, TemplateRuntimeError, \
+                            TemplateSyntaxError
+from genshi.template.loader import TemplateLoader
 
 
 class AttrsDirectiveTestCase(unittest.TestCase):
@@ -60,6 +66,201 @@ class AttrsDirectiveTestCase(unittest.TestCase):
         </doc>""", tmpl.generate().render(encoding=None))
 
 
+class CacheDirectiveTestCase(unittest.TestCase):
+    """Tests for the `py:cache` template directive."""
+
+    def setUp(self):
+        self.calls = []
+
+    def _render(self, tmpl, **data):
+        def call(value):
+            self.calls.append(value)
+            return value
+        return tmpl.generate(call=call, **data).render(encoding=None)
+
+    def test_cached_by_key(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="key=user" title="${call(user)}">${call(x)}</elem>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <elem title="joe">1</elem>
+        </doc>""", self._render(tmpl, user='joe', x=1))
+        self.assertEqual("""<doc>
+          <elem title="joe">1</elem>
+        </doc>""", self._render(tmpl, user='joe', x=2))
+        self.assertEqual("""<doc>
+          <elem title="jim">3</elem>
+        </doc>""", self._render(tmpl, user='jim', x=3))
+        self.assertEqual(['joe', 1, 'jim', 3], self.calls)
+
+    def test_without_key(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="">${call(x)}</elem>
+        </doc>""")
+        self._render(tmpl, x=1)
+        self.assertEqual("""<doc>
+          <elem>1</elem>
+        </doc>""", self._render(tmpl, x=2))
+        self.assertEqual([1], self.calls)
+
+    def test_ttl(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="key=1; ttl=ttl">${call(x)}</elem>
+        </doc>""")
+        self._render(tmpl, x=1, ttl=0)
+        self.assertEqual("""<doc>
+          <elem>2</elem>
+        </doc>""", self._render(tmpl, x=2, ttl=60))
+        self.assertEqual("""<doc>
+          <elem>2</elem>
+        </doc>""", self._render(tmpl, x=3, ttl=60))
+        self.assertEqual([1, 2], self.calls)
+
+    def test_as_element(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:cache key="user" ttl="60">${call(user)}</py:cache>
+        </doc>""")
+        self._render(tmpl, user='joe')
+        self.assertEqual("""<doc>
+          joe
+        </doc>""", self._render(tmpl, user='joe'))
+        self.assertEqual(['joe'], self.calls)
+
+    def test_combined_with_loop(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:for="item in items" py:cache="key=item">${call(item)}</elem>
+        </doc>""")
+        self._render(tmpl, items=[1, 2])
+        self.assertEqual("""<doc>
+          <elem>2</elem><elem>3</elem>
+        </doc>""", self._render(tmpl, items=[2, 3]))
+        self.assertEqual([1, 2, 3], self.calls)
+
+    def test_separate_fragments(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <a py:cache="key=1">A</a><b py:cache="key=1">B</b>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <a>A</a><b>B</b>
+        </doc>""", self._render(tmpl))
+        self.assertEqual("""<doc>
+          <a>A</a><b>B</b>
+        </doc>""", self._render(tmpl))
+
+    def test_not_stored_on_error(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="">${call(x)}${1 // x}</elem>
+        </doc>""")
+        self.assertRaises(ZeroDivisionError, self._render, tmpl, x=0)
+        self.assertEqual("""<doc>
+          <elem>11</elem>
+        </doc>""", self._render(tmpl, x=1))
+
+    def test_custom_cache(self):
+        class Cache(object):
+            def __init__(self):
+                self.data = {}
+            def get(self, key):
+                return self.data.get(key)
+            def set(self, key, value, ttl=None):
+                self.data[key] = value
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="key=user">${call(user)}</elem>
+        </doc>""")
+        cache = tmpl.fragment_cache = Cache()
+        self._render(tmpl, user='joe')
+        self.assertEqual(1, len(cache.data))
+        self._render(tmpl, user='joe')
+        self.assertEqual(['joe'], self.calls)
+
+    def test_template_cache(self):
+        source = """<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="">${call(x)}</elem>
+        </doc>"""
+        tmpl = MarkupTemplate(source)
+        self._render(tmpl, x=1)
+        self.assertEqual("""<doc>
+          <elem>1</elem>
+        </doc>""", self._render(tmpl, x=2))
+        self.assertTrue(isinstance(tmpl.fragment_cache,
+                                   directives.FragmentCache))
+        other = MarkupTemplate(source)
+        self.assertTrue('2' in self._render(other, x=2))
+        self.assertTrue(other.fragment_cache is not tmpl.fragment_cache)
+        tmpl.fragment_cache.clear()
+        self.assertEqual("""<doc>
+          <elem>3</elem>
+        </doc>""", self._render(tmpl, x=3))
+        self.assertEqual([1, 2, 3], self.calls)
+
+    def test_template_reloaded(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            path = os.path.join(dirname, 'tmpl.html')
+            def write(text, mtime):
+                fileobj = open(path, 'w')
+                try:
+                    fileobj.write("""<doc xmlns:py="http://genshi.edgewall.org/">
+                      <elem py:cache="">%s</elem>
+                    </doc>""" % text)
+                finally:
+                    fileobj.close()
+                os.utime(path, (mtime, mtime))
+            write('OLD', 1000000000)
+            cache = directives.FragmentCache()
+            loader = TemplateLoader([dirname], auto_reload=True,
+                                    fragment_cache=cache)
+            self.assertTrue('OLD' in self._render(loader.load('tmpl.html')))
+            write('NEW', 1000000010)
+            tmpl = loader.load('tmpl.html')
+            self.assertTrue(tmpl.fragment_cache is cache)
+            self.assertTrue('NEW' in self._render(tmpl))
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_loader_cache(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            for name in ('tmpl1.html', 'tmpl2.html'):
+                fileobj = open(os.path.join(dirname, name), 'w')
+                try:
+                    fileobj.write("""<doc xmlns:py="http://genshi.edgewall.org/">
+                      <elem py:cache="">${call(x)}</elem>
+                    </doc>""")
+                finally:
+                    fileobj.close()
+            loader1 = TemplateLoader([dirname])
+            loader2 = TemplateLoader([dirname])
+            tmpl1 = loader1.load('tmpl1.html')
+            self.assertTrue(loader1.load('tmpl2.html').fragment_cache is
+                            tmpl1.fragment_cache)
+            self.assertTrue('1' in self._render(tmpl1, x=1))
+            self.assertTrue('2' in self._render(loader2.load('tmpl1.html'),
+                                                x=2))
+            self.assertEqual([1, 2], self.calls)
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_text_template(self):
+        tmpl = TextTemplate("""#cache key=user
+Hello ${call(user)}
+#end""")
+        self._render(tmpl, user='joe')
+        self.assertEqual("Hello joe\n", self._render(tmpl, user='joe'))
+        self.assertEqual(['joe'], self.calls)
+
+    def test_invalid_assignment(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:cache="keys=user"/>
+        </doc>""", filename='test.html')
+        try:
+            list(tmpl.generate())
+            self.fail('Expected TemplateSyntaxError')
+        except TemplateSyntaxError, e:
+            self.assertEqual('test.html', e.filename)
+            self.assertEqual(2, e.lineno)
+
+
 class ChooseDirectiveTestCase(unittest.TestCase):
     """Tests for the `py:choose` template directive and the complementary
     directives `py:when` and `py:otherwise`."""
@@ -475,6 +676,124 @@ class ForDirectiveTestCase(unittest.TestCase):
         </doc>""", tmpl.generate(items=enumerate([('a', 1), ('b', 2)]))
                        .render(encoding=None))
 
+    def test_attributes_with_loop_variables(self):
+        """
+        Verify that loop variables in attribute values are substituted, and
+        that attributes evaluating to `None` are dropped.
+        """
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <a py:for="href, title in items" href="$href" title="$title">#$href</a>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <a href="1" title="one">#1</a><a href="two">#two</a>
+        </doc>""", tmpl.generate(items=[(1, 'one'), ('two', None)])
+                       .render(encoding=None))
+
+    def test_body_with_expressions_and_directives(self):
+        """
+        Verify that expressions other than loop variables and nested
+        directives are still processed in the loop body, and that the body
+        produces the same output when the template is rendered again.
+        """
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items" class="${item * 2}">${item + 1}
+            <b py:if="item % 2">$item</b>${markup}</p>
+        </doc>""")
+        expected = """<doc>
+          <p class="2">2
+            <b>1</b><i/></p><p class="4">3
+            <i/></p>
+        </doc>"""
+        for _ in range(2):
+            self.assertEqual(expected, tmpl.generate(
+                items=[1, 2], markup=Markup('<i/>')).render(encoding=None))
+
+    def test_generator(self):
+        """
+        Verify that items of a generator are only requested as the output of
+        the loop is consumed.
+        """
+        consumed = []
+        def items():
+            for i in range(3):
+                consumed.append(i)
+                yield i
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:for="item in items">$item</b>
+        </doc>""")
+        stream = iter(tmpl.generate(items=items()))
+        for event in stream:
+            if event[0] is TEXT and event[1] == '0':
+                break
+        self.assertEqual([0], consumed)
+        self.assertEqual('</b><b>1</b><b>2</b>\n        </doc>',
+                         Stream(stream).render(encoding=None))
+
+    def test_generator_context(self):
+        """
+        Verify that the loop variables are not defined while the next item is
+        requested from the iterable.
+        """
+        ctxt = Context()
+        defined = []
+        def items():
+            for i in range(2):
+                defined.append('item' in ctxt)
+                yield i
+        ctxt['items'] = items()
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:for="item in items">$item</b>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <b>0</b><b>1</b>
+        </doc>""", tmpl.generate(ctxt).render(encoding=None))
+        self.assertEqual([False, False], defined)
+
+    def test_substitution(self):
+        """
+        Verify that references to the loop variables are substituted by a copy
+        of the directive made for the prepared loop body, and that this
+        produces the same output as the regular processing of the body.
+        """
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="a, b in items"><p class="x$a" title="$b">$a ${b}</p>
+          </py:for>
+        </doc>""")
+        items = [(1, u'\xe9'), (None, None), (Markup('<i/>'), [1, 2]),
+                 (2.5, Markup('&amp;'))]
+        expected = u"""<doc>
+          <p class="x1" title="\xe9">1 \xe9</p>
+          <p class="x"> </p>
+          <p class="x&lt;i/&gt;" title="12"><i/> 12</p>
+          <p class="x2.5" title="&amp;amp;">2.5 &amp;</p>
+        </doc>"""
+        self.assertEqual(expected, tmpl.generate(items=items)
+                                       .render(encoding=None))
+
+        directive = tmpl.stream[2][1][0][0]
+        specialized = tmpl._static[2][1][0][0]
+        self.assertEqual(None, directive.body)
+        self.assertTrue(specialized is not directive)
+        self.assertEqual(tmpl._static[2][1][1], specialized.body)
+
+        # Without static runs, the body is processed as usual
+        tmpl.filters.append(lambda stream, ctxt, **vars: stream)
+        self.assertEqual(expected, tmpl.generate(items=items)
+                                       .render(encoding=None))
+
+    def test_substitution_with_code_block(self):
+        """
+        Verify that loop bodies with code blocks, which may change the loop
+        variables, are not specialized.
+        """
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items"><?python item = item * 2 ?>$item</p>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <p>2</p><p>4</p>
+        </doc>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+        self.assertEqual(None, tmpl._static[2][1][0][0].body)
+
     def test_not_iterable(self):
         """
         Verify that assignment to nested tuples works correctly.
@@ -1041,6 +1360,79 @@ class MatchDirectiveTestCase(unittest.TestCase):
     #    </div>""", tmpl.generate().render(encoding=None))
 
 
+class MemoizeDirectiveTestCase(unittest.TestCase):
+    """Tests for the `py:memoize` template directive."""
+
+    def setUp(self):
+        self.calls = []
+
+    def _render(self, tmpl, **data):
+        def call(value):
+            self.calls.append(value)
+            return value
+        return tmpl.generate(call=call, **data).render(encoding=None)
+
+    def test_memoized_by_arguments(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:def="badge(name, cls='info')" py:memoize="" class="$cls">${call(name)}</b>
+          ${badge('a')}${badge('b')}${badge('a')}${badge('a', cls='error')}${badge(name='a', cls='error')}
+        </doc>""")
+        self.assertEqual("""<doc>
+          <b class="info">a</b><b class="info">b</b><b class="info">a</b><b class="error">a</b><b class="error">a</b>
+        </doc>""", self._render(tmpl))
+        self.assertEqual(['a', 'b', 'a', 'a'], self.calls)
+
+    def test_scoped_to_render(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:def="badge(name)" py:memoize="">${call(name)}</b>
+          ${badge('a')}${badge('a')}
+        </doc>""")
+        self._render(tmpl)
+        self._render(tmpl)
+        self.assertEqual(['a', 'a'], self.calls)
+
+    def test_capacity(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:def="badge(name)" py:memoize="size">${call(name)}</b>
+          ${badge('a')}${badge('b')}${badge('a')}${badge('c')}${badge('b')}
+        </doc>""")
+        self.assertEqual("""<doc>
+          <b>a</b><b>b</b><b>a</b><b>c</b><b>b</b>
+        </doc>""", self._render(tmpl, size=2))
+        self.assertEqual(['a', 'b', 'c', 'b'], self.calls)
+
+    def test_unhashable_arguments(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:def="badge(names)" py:memoize="">${call(len(names))}</b>
+          ${badge(['a'])}${badge(['a'])}
+        </doc>""")
+        self.assertEqual("""<doc>
+          <b>1</b><b>1</b>
+        </doc>""", self._render(tmpl))
+        self.assertEqual([1, 1], self.calls)
+
+    def test_combined_with_def_element(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:def function="badge(name)" py:memoize=""><b>${call(name)}</b></py:def>
+          ${badge('a')}${badge('a')}
+        </doc>""")
+        self.assertEqual("""<doc>
+          <b>a</b><b>a</b>
+        </doc>""", self._render(tmpl))
+        self.assertEqual(['a'], self.calls)
+
+    def test_without_def(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <b py:memoize="">foo</b>
+        </doc>""", filename='test.html')
+        try:
+            list(tmpl.generate())
+            self.fail('Expected TemplateRuntimeError')
+        except TemplateRuntimeError, e:
+            self.assertEqual('test.html', e.filename)
+            self.assertEqual(2, e.lineno)
+
+
 class ContentDirectiveTestCase(unittest.TestCase):
     """Tests for the `py:content` template directive."""
 
@@ -1216,11 +1608,13 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite(directives))
     suite.addTest(unittest.makeSuite(AttrsDirectiveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CacheDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ChooseDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(DefDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ForDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(IfDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(MatchDirectiveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(MemoizeDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ContentDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ReplaceDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(StripDirectiveTestCase, 'test'))
@@ -21,7 +21,7 @@ import unittest
 from genshi.core import Markup
 from genshi.template.base import Context
 from genshi.template.eval import Expression, Suite, Undefined, UndefinedError, \
-                                 UNDEFINED
+                                 UNDEFINED, StrictLookup
 from genshi.compat import BytesIO, IS_PYTHON2, wrapped_bytes
 
 
@@ -45,6 +45,47 @@ class ExpressionTestCase(unittest.TestCase):
         unpickled = pickle.load(buf)
         assert unpickled.evaluate({}) is True
 
+    def test_closure(self):
+        expr = Expression('[x * y for y in items if (lambda z: z > x)(y)]')
+        self.assertEqual([6, 8], expr.evaluate({'x': 2, 'items': [1, 2, 3, 4]}))
+        self.assertEqual([3], expr.evaluate({'x': 1, 'items': [1, 3]}))
+
+    def test_shared_globals(self):
+        expr = Expression('foo')
+        self.assertEqual('bar', expr.evaluate({'foo': 'bar'}))
+        self.assertEqual('baz', expr.evaluate({'foo': 'baz'}))
+        assert expr._globals is Expression('bar')._globals
+        assert '__data__' not in expr._globals
+
+    def test_globals_depending_on_data(self):
+        class DataLookup(StrictLookup):
+            @classmethod
+            def globals(cls, data):
+                _globals = super(DataLookup, cls).globals(data)
+                _globals['_lookup_name'] = lambda _, name: data[name] * 2
+                return _globals
+        expr = Expression('foo', lookup=DataLookup)
+        self.assertEqual(2, expr.evaluate({'foo': 1}))
+        self.assertEqual('aa', expr.evaluate({'foo': 'a'}))
+        data = {'foo': 3}
+        Suite('bar = foo', lookup=DataLookup).execute(data)
+        self.assertEqual(6, data['bar'])
+
+    def test_unpickle_old_format(self):
+        expr = Expression('foo + 1', filename='test.html', lineno=3)
+        code = compile('foo + 1', 'test.html', 'eval')
+        params = (code.co_nlocals, code.co_stacksize, code.co_flags,
+                  code.co_code, code.co_consts, code.co_names,
+                  code.co_varnames, code.co_filename, code.co_name, 3,
+                  code.co_lnotab, (), ())
+        if not IS_PYTHON2:
+            params = params[:1] + (code.co_kwonlyargcount,) + params[1:]
+        unpickled = Expression.__new__(Expression)
+        unpickled.__setstate__({'source': expr.source, 'ast': expr.ast,
+                                'lookup': StrictLookup, 'code': params})
+        self.assertEqual(2, unpickled.evaluate({'foo': 1}))
+        self.assertEqual(expr.code, unpickled.code)
+
     def test_name_lookup(self):
         self.assertEqual('bar', Expression('foo').evaluate({'foo': 'bar'}))
         self.assertEqual(id, Expression('id').evaluate({}))
@@ -13,12 +13,15 @@
 
 import doctest
 import os
+import pickle
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
 from genshi.core import TEXT
-from genshi.template.loader import TemplateLoader
+from genshi.template.loader import TemplateLoader, TemplateNotFound
 from genshi.template.markup import MarkupTemplate
 
 
@@ -518,6 +521,381 @@ class TemplateLoaderTestCase(unittest.TestCase):
               <div>bar/tmpl3</div> from sub1
             </html>""", tmpl.generate().render(encoding=None))
 
+    def _write(self, name, content, mtime=None):
+        fileobj = open(os.path.join(self.dirname, name), 'w')
+        try:
+            fileobj.write(content)
+        finally:
+            fileobj.close()
+        if mtime is not None:
+            os.utime(os.path.join(self.dirname, name), (mtime, mtime))
+
+    def _cached_loader(self, **kwargs):
+        instantiated = []
+        class CountingLoader(TemplateLoader):
+            def _instantiate(self, cls, fileobj, filepath, filename,
+                             encoding=None):
+                instantiated.append(filename)
+                return TemplateLoader._instantiate(self, cls, fileobj,
+                                                   filepath, filename,
+                                                   encoding=encoding)
+        cache_dir = os.path.join(self.dirname, 'cache')
+        return CountingLoader([self.dirname], cache_dir=cache_dir,
+                              **kwargs), instantiated
+
+    def test_cache_dir(self):
+        self._write('tmpl.html', """<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx, item in enumerate(items)">$idx: $item</li>
+        </ul>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        output = loader.load('tmpl.html').generate(items='ab').render()
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual(1, len(os.listdir(loader.cache_dir)))
+
+        loader, instantiated = self._cached_loader()
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual([], instantiated)
+        self.assertTrue(tmpl.loader is loader)
+        self.assertEqual(output, tmpl.generate(items='ab').render())
+
+    def test_cache_dir_modified(self):
+        self._write('tmpl.html', """<div>Old</div>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl.html')
+
+        self._write('tmpl.html', """<div>New</div>""", mtime=1000000010)
+        loader, instantiated = self._cached_loader()
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual('<div>New</div>', tmpl.generate().render())
+
+    def test_cache_dir_inlined_include_modified(self):
+        self._write('tmpl1.html', """<div>Old</div>""", mtime=1000000000)
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl2.html')
+        self.assertEqual(['tmpl2.html', 'tmpl1.html'], instantiated)
+
+        self._write('tmpl1.html', """<div>New</div>""", mtime=1000000010)
+        loader, instantiated = self._cached_loader()
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual(['tmpl2.html', 'tmpl1.html'], instantiated)
+        self.assertEqual("""<html>
+          <div>New</div>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def test_cache_dir_corrupt_entry(self):
+        self._write('tmpl.html', """<div>$foo</div>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl.html')
+        path = os.path.join(loader.cache_dir, os.listdir(loader.cache_dir)[0])
+        fileobj = open(path, 'wb')
+        try:
+            fileobj.write('garbage'.encode('ascii'))
+        finally:
+            fileobj.close()
+
+        loader, instantiated = self._cached_loader()
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual('<div>bar</div>', tmpl.generate(foo='bar').render())
+
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl.html')
+        self.assertEqual([], instantiated)
+
+    def test_cache_dir_callback(self):
+        from genshi.filters.i18n import Translator
+        self._write('tmpl.html', """<html xmlns:py="http://genshi.edgewall.org/"
+            xmlns:i18n="http://genshi.edgewall.org/i18n">
+          <p i18n:msg="name">Hello, ${name}!</p>
+        </html>""", mtime=1000000000)
+        def callback(template):
+            Translator(lambda s: s.replace('Hello', 'Hi')).setup(template)
+        loader, instantiated = self._cached_loader(callback=callback)
+        output = loader.load('tmpl.html').generate(name='Jim').render()
+
+        loader, instantiated = self._cached_loader(callback=callback)
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual([], instantiated)
+        self.assertEqual(output, tmpl.generate(name='Jim').render())
+        self.assertTrue('<p>Hi, Jim!</p>' in output)
+
+    def test_cache_dir_include_missing(self):
+        self._write('tmpl.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="missing.html" />
+        </html>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        self.assertRaises(TemplateNotFound, loader.load, 'tmpl.html')
+        self.assertRaises(TemplateNotFound, loader.load, 'tmpl.html')
+        self.assertEqual(['tmpl.html', 'tmpl.html'], instantiated)
+
+    def test_cache_dir_callback_mismatch(self):
+        from genshi.filters.i18n import Translator
+        self._write('tmpl.html', """<html xmlns:py="http://genshi.edgewall.org/"
+            xmlns:i18n="http://genshi.edgewall.org/i18n">
+          <p i18n:msg="name">Hello, ${name}!</p>
+        </html>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl.html')
+
+        def callback(template):
+            Translator(lambda s: s.replace('Hello', 'Hi')).setup(template)
+        loader, instantiated = self._cached_loader(callback=callback)
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertTrue('<p>Hi, Jim!</p>' in tmpl.generate(name='Jim').render())
+
+    def test_cache_dir_search_path_mismatch(self):
+        self._write('tmpl.html', """<div>Hello</div>""", mtime=1000000000)
+        loader, instantiated = self._cached_loader()
+        loader.load('tmpl.html')
+
+        loader = TemplateLoader([self.dirname,
+                                 os.path.join(self.dirname, 'other')],
+                                cache_dir=loader.cache_dir)
+        loader.load('tmpl.html')
+        self.assertEqual(1, loader.stats()['templates']['tmpl.html']['parses'])
+
+    def test_auto_reload_include_inlined(self):
+        self._write('tmpl1.html', """<div>Old</div>""", mtime=1000000000)
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""", mtime=1000000000)
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl2.html')
+        # if not inlined the following would be 5
+        self.assertEqual(7, len(tmpl.stream))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+        self._write('tmpl1.html', """<div>New</div>""", mtime=1000000010)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          <div>New</div>
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+    def test_auto_reload_nested_include_modified(self):
+        self._write('tmpl1.html', """<b>Old</b>""", mtime=1000000000)
+        self._write('tmpl2.html', """<div xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </div>""", mtime=1000000000)
+        self._write('tmpl3.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl2.html" />
+        </html>""", mtime=1000000000)
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl3.html')
+
+        self._write('tmpl1.html', """<b>New</b>""", mtime=1000000010)
+        self.assertEqual("""<div>
+          <b>New</b>
+        </div>""", loader.load('tmpl2.html').generate().render(encoding=None))
+        self.assertEqual("""<html>
+          <div>
+          <b>New</b>
+        </div>
+        </html>""", loader.load('tmpl3.html').generate().render(encoding=None))
+
+    def test_auto_reload_include_added(self):
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html"><xi:fallback>Missing</xi:fallback></xi:include>
+        </html>""", mtime=1000000000)
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          Missing
+        </html>""", tmpl.generate().render(encoding=None))
+
+        self._write('tmpl1.html', """<div>Included</div>""")
+        self.assertEqual("""<html>
+          <div>Included</div>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def test_load_concurrently(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        instantiated = []
+        class SlowLoader(TemplateLoader):
+            def _instantiate(self, cls, fileobj, filepath, filename,
+                             encoding=None):
+                instantiated.append(filename)
+                time.sleep(0.05)
+                return TemplateLoader._instantiate(self, cls, fileobj,
+                                                   filepath, filename,
+                                                   encoding=encoding)
+        loader = SlowLoader([self.dirname], auto_reload=True)
+        loaded = []
+        def load():
+            loaded.append(loader.load('tmpl.html'))
+        threads = [threading.Thread(target=load) for idx in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['tmpl.html'], instantiated)
+        self.assertEqual(5, len(loaded))
+        for tmpl in loaded:
+            self.assertTrue(tmpl is loaded[0])
+        self.assertEqual({}, loader._load_locks)
+
+    def test_load_locks_discarded(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        loader = TemplateLoader([self.dirname])
+        loader.load('tmpl.html')
+        self.assertRaises(TemplateNotFound, loader.load, 'missing.html')
+        self.assertEqual({}, loader._load_locks)
+
+    def test_auto_reload_recursive_include(self):
+        self._write('tmpl.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude"
+              xmlns:py="http://genshi.edgewall.org/">
+          <py:def function="countdown(num)">$num
+            <xi:include href="tmpl.html" py:if="False" />
+          </py:def>${countdown(1)}
+        </html>""")
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        tmpl = loader.load('tmpl.html')
+        self.assertEqual("""<html>
+          1
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertTrue(loader.load('tmpl.html') is tmpl)
+
+    def test_watcher(self):
+        class Watcher(object):
+            def __init__(self):
+                self.watched = {}
+            def watch(self, path, callback):
+                self.watched[path] = callback
+        self._write('tmpl1.html', """<div>Old</div>""", mtime=1000000000)
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""", mtime=1000000000)
+        watcher = Watcher()
+        loader = TemplateLoader([self.dirname], auto_reload=True,
+                                watcher=watcher)
+        tmpl = loader.load('tmpl2.html')
+        path1 = os.path.join(self.dirname, 'tmpl1.html')
+        path2 = os.path.join(self.dirname, 'tmpl2.html')
+        # Files are watched once the template has been prepared, as only then
+        # its inlined templates are known
+        self.assertEqual([], list(watcher.watched))
+        tmpl.generate().render()
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+        self.assertEqual(sorted([path1, path2]), sorted(watcher.watched))
+
+        # Changes are not detected until the watcher reports them
+        self._write('tmpl1.html', """<div>New</div>""", mtime=1000000010)
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+        watcher.watched.pop(path1)(path1)
+        tmpl = loader.load('tmpl2.html')
+        self.assertEqual("""<html>
+          <div>New</div>
+        </html>""", tmpl.generate().render(encoding=None))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+        self.assertEqual(sorted([path1, path2]), sorted(watcher.watched))
+        self.assertTrue(loader.load('tmpl2.html') is tmpl)
+
+    def test_stats(self):
+        self._write('tmpl1.html', """<div>Included</div>""")
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""")
+        events = []
+        def monitor(event, filename, value):
+            events.append((event, filename))
+        loader = TemplateLoader([self.dirname], max_cache_size=1,
+                                monitor=monitor)
+        loader.load('tmpl2.html').generate().render()
+        loader.load('tmpl1.html')
+        self.assertRaises(TemplateNotFound, loader.load, 'tmpl3.html')
+
+        stats = loader.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(0, stats['reloads'])
+        self.assertEqual(1, stats['not_found'])
+        self.assertEqual(['tmpl1.html', 'tmpl2.html'],
+                         sorted(stats['templates']))
+        self.assertEqual(1, stats['templates']['tmpl1.html']['parses'])
+        self.assertEqual(1, stats['templates']['tmpl2.html']['parses'])
+        self.assertTrue(stats['templates']['tmpl2.html']['prepare_time'] > 0)
+        self.assertEqual(stats['parse_time'],
+                         sum([template['parse_time'] for template
+                              in stats['templates'].values()]))
+        self.assertEqual([
+            ('miss', 'tmpl2.html'), ('parse', 'tmpl2.html'),
+            ('miss', 'tmpl1.html'), ('parse', 'tmpl1.html'),
+            ('eviction', None), ('prepare', 'tmpl1.html'),
+            ('prepare', 'tmpl2.html'), ('miss', 'tmpl3.html'),
+            ('not_found', 'tmpl3.html')
+        ], events)
+
+    def test_stats_monitor_hits(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        events = []
+        def monitor(event, filename, value):
+            events.append((event, filename, value))
+        loader = TemplateLoader([self.dirname], monitor=monitor,
+                                monitor_hits=True)
+        loader.load('tmpl.html')
+        loader.load('tmpl.html')
+        loader.load('tmpl.html')
+        self.assertEqual([('hit', 'tmpl.html', 1)] * 2, events[-2:])
+        self.assertEqual(2, loader.stats()['hits'])
+        self.assertEqual(2, loader.stats()['hits'])
+
+    def test_stats_pickle(self):
+        self._write('tmpl.html', """<div>Hello</div>""")
+        loader = pickle.loads(pickle.dumps(TemplateLoader([self.dirname]), 2))
+        loader.load('tmpl.html')
+        loader.load('tmpl.html')
+        self.assertEqual(1, loader.stats()['hits'])
+
+    def test_stats_reload(self):
+        self._write('tmpl.html', """<div>Old</div>""", mtime=1000000000)
+        loader = TemplateLoader([self.dirname], auto_reload=True)
+        loader.load('tmpl.html')
+        self._write('tmpl.html', """<div>New</div>""", mtime=1000000010)
+        loader.load('tmpl.html')
+        stats = loader.stats()
+        self.assertEqual(1, stats['reloads'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(2, stats['templates']['tmpl.html']['parses'])
+
+    def test_render_many(self):
+        self._write('tmpl1.html', """<div>Included $item</div>""")
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""")
+        loader = TemplateLoader([self.dirname])
+        contexts = [{'item': idx} for idx in range(10)]
+        expected = [loader.load('tmpl2.html').generate(**data).render('xhtml',
+                                                                      'utf-8')
+                    for data in contexts]
+        self.assertEqual(expected, list(loader.render_many('tmpl2.html',
+                                                           contexts, 'xhtml',
+                                                           processes=2)))
+
+    def test_render_many_unordered(self):
+        self._write('tmpl.html', """<p>$item</p>""")
+        loader = TemplateLoader([self.dirname])
+        results = loader.render_many('tmpl.html', [{'item': 'a'},
+                                                   {'item': 'b'}],
+                                     encoding=None, processes=2,
+                                     ordered=False, chunksize=2)
+        self.assertEqual([(0, u'<p>a</p>'), (1, u'<p>b</p>')],
+                         sorted(results))
+
+    def test_render_many_error(self):
+        self._write('tmpl.html', """<p>${1 // item}</p>""")
+        loader = TemplateLoader([self.dirname])
+        results = loader.render_many('tmpl.html', [{'item': 1}, {'item': 0}],
+                                     encoding=None, processes=1)
+        self.assertEqual(u'<p>1</p>', results.next())
+        self.assertRaises(ZeroDivisionError, results.next)
+
 
 def suite():
     suite = unittest.TestSuite()
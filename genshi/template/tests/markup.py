@@ -20,8 +20,9 @@ import tempfile
 import unittest
 
 from genshi.compat import BytesIO, StringIO
-from genshi.core import Markup
+from genshi.core import Markup, TEXT
 from genshi.input import XML
+from genshi.output import STATIC, _StaticText
 from genshi.template.base import BadDirectiveError, TemplateSyntaxError
 from genshi.template.loader import TemplateLoader, TemplateNotFound
 from genshi.template.markup import MarkupTemplate
@@ -782,6 +783,108 @@ class MarkupTemplateTestCase(unittest.TestCase):
           </lines>
         </rhyme>""", tmpl.generate().render(encoding=None)) 
 
+    def test_static_runs(self):
+        xml = """<div xmlns:py="http://genshi.edgewall.org/">
+          <p class="note">Static <em>text</em></p>
+          <ul><li py:for="item in items"><b>Item:</b> $item</li></ul>
+        </div>"""
+        expected = """<div>
+          <p class="note">Static <em>text</em></p>
+          <ul><li><b>Item:</b> 1</li><li><b>Item:</b> 2</li></ul>
+        </div>"""
+        tmpl = MarkupTemplate(xml)
+        kinds = [kind for kind, _, _ in tmpl.generate(items=[1, 2]).events]
+        self.assertTrue(STATIC in kinds)
+        kinds = [kind for kind, _, _ in tmpl.generate(items=[1, 2])]
+        self.assertFalse(STATIC in kinds)
+        for method in ('xml', 'xhtml', 'html'):
+            self.assertEqual(
+                (tmpl.generate(items=[1, 2]) | list).render(method,
+                                                            encoding=None),
+                tmpl.generate(items=[1, 2]).render(method, encoding=None))
+        self.assertEqual(expected, tmpl.generate(items=[1, 2]).render(
+            encoding=None))
+
+    def test_static_runs_with_match_template(self):
+        xml = """<div xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="em">[${select('text()')}]</py:match>
+          <p class="note">Static <em>text</em></p>
+        </div>"""
+        tmpl = MarkupTemplate(xml)
+        self.assertEqual("""<div>
+          <p class="note">Static [text]</p>
+        </div>""", tmpl.generate().render(encoding=None))
+
+    def test_static_runs_with_unrelated_match_template(self):
+        xml = """<div xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="em">[${select('text()')}]</py:match>
+          <p class="note">Static <b>text</b></p>
+        </div>"""
+        tmpl = MarkupTemplate(xml)
+        kinds = [kind for kind, _, _ in tmpl.generate().events]
+        self.assertTrue(STATIC in kinds)
+        self.assertEqual("""<div>
+          <p class="note">Static <b>text</b></p>
+        </div>""", tmpl.generate().render(encoding=None))
+
+    def test_match_templates_indexed_by_name(self):
+        xml = """<div xmlns:py="http://genshi.edgewall.org/"
+                      xmlns:x="urn:x">
+          <py:match path="x:b">(${select('text()')})</py:match>
+          <py:match path="b|i">[${select('text()')}]</py:match>
+          <py:match path="li[2]">
+            <li class="second">${select('text()')}</li>
+          </py:match>
+          <py:match path="*[@class]" once="true">
+            <span>${select('@class')}</span>
+          </py:match>
+          <p class="first"><b>bold</b> <i>italic</i> <x:b>x</x:b></p>
+          <ul><li>a</li><li>b</li><li>c</li></ul>
+          <p class="again"><b>bold</b></p>
+        </div>"""
+        tmpl = MarkupTemplate(xml)
+        self.assertEqual("""<div xmlns:x="urn:x">
+            <span>first</span>
+          <ul><li>a</li>
+            <li class="second">b</li>
+          <li>c</li></ul>
+          <p class="again">[bold]</p>
+        </div>""", tmpl.generate().render(encoding=None))
+
+    def test_static_text(self):
+        xml = """<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items">  $item  \n\n\n  </p>
+          <pre py:if="True">  \n\n\n  $item  \n\n\n  </pre>
+          <script py:if="True">\n\n\n  1 &lt; 2  \n\n</script>
+          <p xml:space="preserve" py:if="True">  \n\n\n  </p>
+        </div>"""
+        tmpl = MarkupTemplate(xml)
+        events = tmpl.generate(item=2, items=[1]).events
+        texts = [data for kind, data, _ in events
+                 if kind is TEXT and type(data) is _StaticText]
+        self.assertTrue(texts)
+        # Without static processing, the text of the template is used as is
+        plain = MarkupTemplate(xml)
+        plain.filters.append(lambda stream, ctxt, **vars: stream)
+        for method in ('xml', 'xhtml', 'html'):
+            self.assertEqual(
+                plain.generate(item=2, items=[1]).render(method,
+                                                         encoding=None),
+                tmpl.generate(item=2, items=[1]).render(method,
+                                                        encoding=None))
+
+    def test_static_runs_with_custom_filter(self):
+        xml = """<div><p class="note">Static <em>text</em></p></div>"""
+        tmpl = MarkupTemplate(xml)
+        kinds = []
+        def collect(stream, ctxt, **vars):
+            for event in stream:
+                kinds.append(event[0])
+                yield event
+        tmpl.filters.append(collect)
+        self.assertEqual(xml, tmpl.generate().render(encoding=None))
+        self.assertFalse(STATIC in kinds)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from genshi.compat import StringIO
+from genshi.template import profiler
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.profiler import Profiler
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='profiler_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, name, content):
+        fileobj = open(os.path.join(self.dirname, name), 'w')
+        try:
+            fileobj.write(content)
+        finally:
+            fileobj.close()
+
+    def test_code_block(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            total = sum(items)
+          ?>
+          $total
+        </div>""", filename='test.html')
+        prof = Profiler()
+        tmpl.generate(prof.context(items=[1, 2])).render()
+        self.assertEqual([
+            ('test.html', 2, '<?python total = sum(items) ?>'),
+            ('test.html', 5, '${total}')
+        ], sorted(prof.stats))
+
+    def test_nested_times(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:if="items" py:for="item in items">$item</p>
+        </div>""", filename='test.html')
+        prof = Profiler()
+        tmpl.generate(prof.context(items=[1, 2, 3])).render()
+        stats = prof.stats
+        loop = stats[('test.html', 2, 'py:for="iter(items)"')]
+        cond = stats[('test.html', 2, 'py:if="items"')]
+        item = stats[('test.html', 2, '${item}')]
+        self.assertEqual(1, loop[0])
+        self.assertEqual(3, cond[0])
+        self.assertEqual(3, item[0])
+        self.assertEqual(9, loop[1])
+        # The time spent applying the loop includes its body
+        self.assertTrue(loop[3] >= cond[3] >= item[3])
+        self.assertTrue(loop[2] <= loop[3])
+
+    def test_include(self):
+        self._write('footer.html', """<p>$year</p>""")
+        self._write('page.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="${name}.html" />
+        </html>""")
+        loader = TemplateLoader([self.dirname])
+        tmpl = loader.load('page.html')
+        prof = Profiler()
+        tmpl.generate(prof.context(name='footer', year=2010)).render()
+        path = os.path.join(self.dirname, 'page.html')
+        include = prof.stats[(path, 2, 'xi:include href="footer.html"')]
+        self.assertEqual([1, 3], include[:2])
+
+    def test_compiled(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items">$item</li>
+        </ul>""", filename='test.html')
+        tmpl.compiled = True
+        prof = Profiler()
+        tmpl.generate(prof.context(items=[1, 2])).render()
+        self.assertEqual(2, prof.stats[('test.html', 2, '${item}')][0])
+        self.assertEqual([1, 6],
+                         prof.stats[('test.html', 2,
+                                     'py:for="iter(items)"')][:2])
+
+    def test_not_enabled(self):
+        tmpl = MarkupTemplate("""<p>$item</p>""")
+        prof = Profiler()
+        self.assertEqual('<p>1</p>', tmpl.generate(item=1).render())
+        self.assertEqual({}, prof.stats)
+
+    def test_exception(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items">${1 / item}</p>
+        </div>""", filename='test.html')
+        prof = Profiler()
+        stream = tmpl.generate(prof.context(items=[1, 0]))
+        self.assertRaises(ZeroDivisionError, stream.render)
+        tmpl.generate(prof.context(items=[1])).render()
+        self.assertEqual([], prof._stack)
+        self.assertEqual(2, prof.stats[('test.html', 2, '${1 / item}')][0])
+
+    def test_print_stats(self):
+        tmpl = MarkupTemplate("""<p>$item</p>""", filename='test.html')
+        prof = Profiler()
+        tmpl.generate(prof.context(item=1)).render()
+        out = StringIO()
+        prof.print_stats(out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(['calls', 'events', 'tottime', 'cumtime',
+                          'filename:lineno(code)'], lines[0].split())
+        self.assertEqual(['1', '0'], lines[1].split()[:2])
+        self.assertTrue(lines[1].endswith('test.html:1(${item})'))
+
+    def test_dump_stats(self):
+        tmpl = MarkupTemplate("""<p>$item</p>""", filename='test.html')
+        prof = Profiler()
+        tmpl.generate(prof.context(item=1)).render()
+        path = os.path.join(self.dirname, 'profile.out')
+        prof.dump_stats(path)
+        stats = pstats.Stats(path, stream=StringIO())
+        self.assertEqual([('test.html', 1, '${item}')], list(stats.stats))
+
+    def test_clear(self):
+        tmpl = MarkupTemplate("""<p>$item</p>""")
+        prof = Profiler()
+        tmpl.generate(prof.context(item=1)).render()
+        prof.clear()
+        self.assertEqual({}, prof.stats)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(profiler))
+    suite.addTest(unittest.makeSuite(ProfilerTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
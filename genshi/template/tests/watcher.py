@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from genshi.template.watcher import InotifyWatcher, PollingWatcher, \
+                                    _load_inotify
+
+
+class PollingWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='watcher_test')
+        self.watcher = self._create_watcher()
+        self.changed = []
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.dirname)
+
+    def _create_watcher(self):
+        return PollingWatcher(interval=0.01)
+
+    def _write(self, name, content, mtime=None):
+        path = os.path.join(self.dirname, name)
+        fileobj = open(path, 'w')
+        try:
+            fileobj.write(content)
+        finally:
+            fileobj.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def _callback(self, path):
+        self.changed.append(path)
+        self.event.set()
+
+    def _wait(self):
+        self.event.wait(5)
+        self.event.clear()
+
+    def test_modified(self):
+        path = self._write('tmpl.html', '<div/>', mtime=1000000000)
+        self.watcher.watch(path, self._callback)
+        self._write('tmpl.html', '<p/>', mtime=1000000010)
+        self._wait()
+        self.assertEqual([path], self.changed)
+
+    def test_removed(self):
+        path = self._write('tmpl.html', '<div/>')
+        self.watcher.watch(path, self._callback)
+        os.remove(path)
+        self._wait()
+        self.assertEqual([path], self.changed)
+
+    def test_called_once(self):
+        path1 = self._write('tmpl1.html', '<div/>', mtime=1000000000)
+        path2 = self._write('tmpl2.html', '<div/>', mtime=1000000000)
+        self.watcher.watch(path1, self._callback)
+        self.watcher.watch(path2, self._callback)
+        self._write('tmpl1.html', '<p/>', mtime=1000000010)
+        self._wait()
+        self._write('tmpl1.html', '<div/>', mtime=1000000020)
+        self._write('tmpl2.html', '<p/>', mtime=1000000010)
+        self._wait()
+        self.assertEqual([path1, path2], self.changed)
+
+    def test_closed(self):
+        path = self._write('tmpl.html', '<div/>')
+        self.watcher.close()
+        self.assertRaises(ValueError, self.watcher.watch, path, self._callback)
+
+
+class InotifyWatcherTestCase(PollingWatcherTestCase):
+
+    def _create_watcher(self):
+        return InotifyWatcher()
+
+    def test_replaced(self):
+        path = self._write('tmpl.html', '<div/>')
+        self.watcher.watch(path, self._callback)
+        tmppath = self._write('tmpl.html.tmp', '<p/>')
+        os.rename(tmppath, path)
+        self._wait()
+        self.assertEqual([path], self.changed)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PollingWatcherTestCase, 'test'))
+    if _load_inotify():
+        suite.addTest(unittest.makeSuite(InotifyWatcherTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
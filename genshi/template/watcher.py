@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Detection of changes to template files in a background thread.
+
+A watcher can be passed to a `TemplateLoader` with automatic reloading
+enabled, so that the loader does not need to check the modification time of
+template files whenever a template is loaded. Instead, templates are dropped
+from the cache of the loader as soon as the watcher reports that the file of
+the template (or of a template inlined into it) has changed.
+"""
+
+import os
+import select
+import struct
+import sys
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+__all__ = ['FileWatcher', 'InotifyWatcher', 'PollingWatcher', 'watcher']
+__docformat__ = 'restructuredtext en'
+
+
+class FileWatcher(object):
+    """Abstract base class for objects watching files for changes.
+    
+    Callbacks are registered for a file using the `watch()` method, and are
+    called only once, with the path of the file as only argument, after the
+    file has been changed, replaced or removed. The changes are detected in a
+    daemon thread, which is started when the first file is watched, and
+    stopped by the `close()` method.
+    """
+
+    def __init__(self):
+        self._watched = {} # callbacks by watched path
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = threading.Event()
+
+    def watch(self, path, callback):
+        """Call the given function when the file at the given path changes.
+        
+        :param path: the path to the file
+        :param callback: the function to call with the path of the file as
+                         only argument; it is called from the thread of the
+                         watcher
+        """
+        self._lock.acquire()
+        try:
+            if self._closed.isSet():
+                raise ValueError('watcher has been closed')
+            callbacks = self._watched.get(path)
+            if callbacks is None:
+                self._add(path)
+                callbacks = self._watched[path] = []
+            callbacks.append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name=type(self).__name__)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Stop watching files."""
+        self._lock.acquire()
+        try:
+            self._closed.set()
+            thread = self._thread
+        finally:
+            self._lock.release()
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+
+    def _add(self, path):
+        """Start watching the file at the given path; called with the lock of
+        the watcher acquired.
+        """
+        raise NotImplementedError
+
+    def _run(self):
+        """Detect changes until the watcher is closed; run by the thread of the
+        watcher.
+        """
+        raise NotImplementedError
+
+    def _notify(self, paths):
+        """Invoke and forget the callbacks registered for the given paths."""
+        self._lock.acquire()
+        try:
+            called = []
+            for path in paths:
+                for callback in self._watched.pop(path, ()):
+                    called.append((callback, path))
+        finally:
+            self._lock.release()
+        # Callbacks are invoked without holding the lock, as they may need to
+        # acquire a lock of their own, which is also held when they call
+        # `watch()`
+        for callback, path in called:
+            callback(path)
+
+
+class PollingWatcher(FileWatcher):
+    """File watcher that periodically compares the modification times of the
+    watched files with those recorded when they started being watched.
+    """
+
+    def __init__(self, interval=1.0):
+        """Create the watcher.
+        
+        :param interval: the number of seconds between checks of the watched
+                         files
+        """
+        FileWatcher.__init__(self)
+        self.interval = interval
+        self._mtimes = {}
+
+    def _add(self, path):
+        self._mtimes[path] = _getmtime(path)
+
+    def _run(self):
+        while not self._closed.isSet():
+            self._closed.wait(self.interval)
+            self._lock.acquire()
+            try:
+                mtimes = list(self._mtimes.items())
+            finally:
+                self._lock.release()
+            changed = []
+            for path, mtime in mtimes:
+                if _getmtime(path) != mtime:
+                    changed.append(path)
+            if changed:
+                self._lock.acquire()
+                try:
+                    for path in changed:
+                        del self._mtimes[path]
+                finally:
+                    self._lock.release()
+                self._notify(changed)
+
+
+# Constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_inotify = None
+
+def _load_inotify():
+    global _inotify
+    if _inotify is None:
+        _inotify = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                   use_errno=True)
+                if hasattr(libc, 'inotify_init1'):
+                    libc.inotify_add_watch.argtypes = [ctypes.c_int,
+                                                       ctypes.c_char_p,
+                                                       ctypes.c_uint32]
+                    _inotify = libc
+            except (ImportError, OSError, TypeError):
+                pass
+    return _inotify
+
+
+class InotifyWatcher(FileWatcher):
+    """File watcher using the inotify API of the Linux kernel.
+    
+    The directories containing the watched files are watched rather than the
+    files themselves, so that files replaced by a new file of the same name
+    (which many editors do when saving) are detected, too.
+    """
+
+    # Events of a directory entry that are reported as a change of the file
+    _mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+            IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        """Create the watcher.
+        
+        :raise OSError: if inotify is not available
+        """
+        FileWatcher.__init__(self)
+        self._libc = _load_inotify()
+        if not self._libc:
+            raise OSError('inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(_errno(), 'inotify_init1 failed')
+        self._dirs = {} # watch descriptors by directory
+        self._names = {} # watched paths by watch descriptor and file name
+        self._wakeup = os.pipe() # used to stop the thread waiting for events
+
+    def close(self):
+        if self._closed.isSet():
+            return
+        os.write(self._wakeup[1], '\0'.encode('ascii'))
+        FileWatcher.close(self)
+        if self._thread is None:
+            self._close_fds()
+
+    def _add(self, path):
+        dirname, name = os.path.split(os.path.abspath(path))
+        if isinstance(dirname, unicode):
+            encoding = sys.getfilesystemencoding()
+            dirname, name = dirname.encode(encoding), name.encode(encoding)
+        wd = self._dirs.get(dirname)
+        if wd is None:
+            wd = self._libc.inotify_add_watch(self._fd, dirname, self._mask)
+            if wd < 0:
+                raise OSError(_errno(), 'inotify_add_watch failed', dirname)
+            self._dirs[dirname] = wd
+        self._names.setdefault(wd, {}).setdefault(name, set()).add(path)
+
+    def _close_fds(self):
+        for fd in (self._fd,) + self._wakeup:
+            os.close(fd)
+
+    def _run(self):
+        try:
+            while not self._closed.isSet():
+                if self._fd not in select.select([self._fd, self._wakeup[0]],
+                                                 [], [])[0]:
+                    continue
+                try:
+                    data = os.read(self._fd, 65536)
+                except OSError:
+                    continue
+                self._notify(self._changed_paths(data))
+        finally:
+            self._close_fds()
+
+    def _changed_paths(self, data):
+        changed = set()
+        self._lock.acquire()
+        try:
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, size = struct.unpack_from('iIII', data, pos)
+                name = data[pos + 16:pos + 16 + size]
+                name = name.rstrip('\0'.encode('ascii'))
+                pos += 16 + size
+                if mask & IN_Q_OVERFLOW:
+                    # Events have been lost, so everything may have changed
+                    for names in self._names.values():
+                        for paths in names.values():
+                            changed.update(paths)
+                    self._names.clear()
+                elif mask & IN_IGNORED:
+                    # The directory has been removed
+                    for paths in self._names.pop(wd, {}).values():
+                        changed.update(paths)
+                    for dirname, dirwd in list(self._dirs.items()):
+                        if dirwd == wd:
+                            del self._dirs[dirname]
+                else:
+                    changed.update(self._names.get(wd, {}).pop(name, ()))
+        finally:
+            self._lock.release()
+        return changed
+
+
+def watcher(interval=1.0):
+    """Return a new file watcher suitable for the current platform.
+    
+    On Linux, this is an `InotifyWatcher`, and otherwise (or if inotify can not
+    be used) a `PollingWatcher` that checks the watched files every
+    `interval` seconds.
+    
+    :param interval: the number of seconds between checks of the watched
+                     files if they need to be polled
+    :return: the watcher
+    :rtype: `FileWatcher`
+    """
+    if _load_inotify():
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher(interval)
+
+
+def _getmtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def _errno():
+    import ctypes
+    return ctypes.get_errno()
@@ -15,11 +15,12 @@ import unittest
 
 def suite():
     import genshi
-    from genshi.tests import builder, core, input, output, path, util
+    from genshi.tests import aio, builder, core, input, output, path, util
     from genshi.filters import tests as filters
     from genshi.template import tests as template
 
     suite = unittest.TestSuite()
+    suite.addTest(aio.suite())
     suite.addTest(builder.suite())
     suite.addTest(core.suite())
     suite.addTest(filters.suite())
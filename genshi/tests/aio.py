@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import unittest
+
+from genshi import aio
+from genshi.input import XML
+from genshi.template import MarkupTemplate
+
+
+class AsyncIterable(object):
+    """Asynchronous iterable producing the given items, each one only after
+    the event loop has run for a while."""
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = aio.asyncio.get_event_loop()
+        future = loop.create_future()
+        if self.items:
+            loop.call_soon(future.set_result, self.items.pop(0))
+        else:
+            loop.call_soon(future.set_exception, StopAsyncIteration())
+        return future
+
+
+class RenderAsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = aio.asyncio.new_event_loop()
+        aio.asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        aio.asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _consume(self, iterator):
+        chunks = []
+        while 1:
+            try:
+                chunks.append(self.loop.run_until_complete(
+                    iterator.__anext__()))
+            except StopAsyncIteration:
+                return chunks
+
+    def test_render_chunks(self):
+        stream = XML('<doc><elem>foo</elem><elem>bar</elem></doc>')
+        chunks = self._consume(stream.render_async(chunk_size=16))
+        self.assertEqual([stream.render(encoding='utf-8')], [''.encode('utf-8')
+                         .join(chunks)])
+        self.assertEqual(3, len(chunks))
+
+    def test_awaitable_values(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <elem py:if="flag" title="$title">${name.upper()}</elem>
+        </doc>""")
+        loop = self.loop
+        title = loop.create_future()
+        loop.call_later(0.01, title.set_result, 'Title')
+        stream = tmpl.generate_async(flag=aio.asyncio.sleep(0, True),
+                                     title=title, name='foo')
+        self.assertEqual("""<doc>
+          <elem title="Title">FOO</elem>
+        </doc>""", ''.join(self._consume(stream.render_async(encoding=None))))
+
+    def test_awaitable_expression(self):
+        tmpl = MarkupTemplate("""<doc>${sleep(0, 'foo')}</doc>""")
+        stream = tmpl.generate_async(sleep=aio.asyncio.sleep)
+        self.assertEqual(['<doc>foo</doc>'],
+                         self._consume(stream.render_async(encoding=None)))
+
+    def test_async_iterable_in_loop(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items">$item</li>
+        </ul>""")
+        stream = tmpl.generate_async(items=AsyncIterable([1, 2, 3]))
+        self.assertEqual("""<ul>
+          <li>1</li><li>2</li><li>3</li>
+        </ul>""", ''.join(self._consume(stream.render_async(encoding=None))))
+
+    def test_exception(self):
+        tmpl = MarkupTemplate("""<doc>${value}</doc>""")
+        value = self.loop.create_future()
+        value.set_exception(ValueError('failed'))
+        stream = tmpl.generate_async(value=value)
+        self.assertRaises(ValueError, self._consume,
+                          stream.render_async(encoding=None))
+
+    def test_synchronous_render(self):
+        tmpl = MarkupTemplate("""<doc>${value}</doc>""")
+        stream = tmpl.generate_async(value=self.loop.create_future())
+        self.assertRaises(RuntimeError, stream.render)
+
+
+class NotSupportedTestCase(unittest.TestCase):
+
+    def test_render_async(self):
+        self.assertRaises(NotImplementedError, XML('<doc/>').render_async)
+
+    def test_generate_async(self):
+        tmpl = MarkupTemplate('<doc/>')
+        self.assertRaises(NotImplementedError, tmpl.generate_async)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    if aio.asyncio is not None:
+        suite.addTest(unittest.makeSuite(RenderAsyncTestCase, 'test'))
+    else:
+        suite.addTest(unittest.makeSuite(NotSupportedTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
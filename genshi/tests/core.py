@@ -14,6 +14,7 @@
 import doctest
 import pickle
 import unittest
+import zlib
 
 from genshi import core
 from genshi.core import Markup, Attrs, Namespace, QName, escape, unescape
@@ -48,6 +49,87 @@ class StreamTestCase(unittest.TestCase):
         self.assertEqual(None, xml.render(encoding=None, out=strio))
         self.assertEqual(u'<li>Über uns</li>', strio.getvalue())
 
+    def test_render_output_stream_buffered(self):
+        xml = XML('<ul><li>Über uns</li><li>Kontakt</li></ul>')
+        writes = []
+        class Output(object):
+            def write(self, string):
+                writes.append(string)
+        self.assertEqual(None, xml.render(encoding='utf-8', out=Output(),
+                                          buffer_size=20))
+        self.assertEqual([u'<ul><li>Über uns</li>'.encode('utf-8'),
+                          u'<li>Kontakt</li></ul>'.encode('utf-8')], writes)
+
+    def test_render_output_bytearray(self):
+        xml = XML('<li>Über uns</li>')
+        buf = bytearray('<ul>'.encode('ascii'))
+        self.assertEqual(None, xml.render(encoding='ascii', out=buf))
+        self.assertEqual(u'<ul><li>&#220;ber uns</li>'.encode('ascii'),
+                         bytes(buf))
+
+    def test_render_large(self):
+        xml = XML(u'<ul>%s</ul>' % (u'<li>Über uns</li>' * 2000))
+        self.assertEqual(xml.render(encoding=None).encode('utf-8'),
+                         xml.render(encoding='utf-8'))
+        self.assertEqual(xml.render(encoding=None).encode('ascii',
+                                                          'xmlcharrefreplace'),
+                         xml.render(encoding='ascii', buffer_size=7))
+
+    def test_render_compress(self):
+        xml = XML(u'<ul>%s</ul>' % (u'<li>Über uns</li>' * 2000))
+        data = xml.render(encoding='utf-8')
+        gzipped = xml.render(encoding='utf-8', compress='gzip')
+        self.assertEqual(data, zlib.decompress(gzipped, 16 + zlib.MAX_WBITS))
+        self.assertTrue(len(gzipped) < len(data))
+        deflated = xml.render(encoding='utf-8', compress='deflate',
+                              compresslevel=9)
+        self.assertEqual(data, zlib.decompress(deflated))
+
+    def test_render_compress_output(self):
+        xml = XML(u'<ul>%s</ul>' % (u'<li>Über uns</li>' * 2000))
+        data = xml.render(encoding='utf-8')
+        buf = BytesIO()
+        xml.render(encoding='utf-8', out=buf, compress='gzip')
+        self.assertEqual(data, zlib.decompress(buf.getvalue(),
+                                               16 + zlib.MAX_WBITS))
+        out = bytearray()
+        xml.render(encoding='utf-8', out=out, compress='deflate')
+        self.assertEqual(data, zlib.decompress(bytes(out)))
+
+    def test_render_compress_invalid(self):
+        xml = XML('<p>Foo</p>')
+        self.assertRaises(ValueError, xml.render, encoding=None,
+                          compress='gzip')
+        self.assertRaises(ValueError, xml.render, encoding='utf-8',
+                          compress='bzip2')
+
+    def test_render_iter(self):
+        xml = XML('<ul><li>Über uns</li><li>Kontakt</li></ul>')
+        chunks = list(xml.render_iter(chunk_size=20))
+        self.assertEqual([u'<ul><li>Über uns</li>'.encode('utf-8'),
+                          u'<li>Kontakt</li></ul>'.encode('utf-8')], chunks)
+        self.assertEqual(xml.render(encoding='utf-8'), ''.encode('utf-8').join(
+                         xml.render_iter(chunk_size=1)))
+
+    def test_render_iter_compress(self):
+        xml = XML(u'<ul>%s</ul>' % (u'<li>Über uns</li>' * 2000))
+        chunks = list(xml.render_iter(chunk_size=100, compress='gzip'))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual([], [chunk for chunk in chunks if not chunk])
+        self.assertEqual(xml.render(encoding='utf-8'),
+                         zlib.decompress(''.encode('utf-8').join(chunks),
+                                         16 + zlib.MAX_WBITS))
+
+    def test_render_iter_unicode(self):
+        xml = XML('<li>Über uns</li>')
+        self.assertEqual([u'<li>Über uns</li>'],
+                         list(xml.render_iter(encoding=None)))
+
+    def test_render_iter_ascii(self):
+        xml = XML('<li>Über uns</li>')
+        self.assertEqual([u'<li>&#220;ber uns</li>'.encode('ascii')],
+                         list(xml.render_iter(encoding='ascii')))
+
     def test_pickle(self):
         xml = XML('<li>Foo</li>')
         buf = BytesIO()
@@ -15,10 +15,12 @@ import doctest
 import unittest
 import sys
 
+from genshi import output
 from genshi.core import Attrs, Markup, QName, Stream
 from genshi.input import HTML, XML
 from genshi.output import DocType, XMLSerializer, XHTMLSerializer, \
-                          HTMLSerializer, EmptyTagFilter
+                          HTMLSerializer, EmptyTagFilter, NamespaceFlattener, \
+                          StaticRun, STATIC, TagCache
 
 
 class XMLSerializerTestCase(unittest.TestCase):
@@ -468,12 +470,316 @@ class EmptyTagFilterTestCase(unittest.TestCase):
                          [ev[0] for ev in stream])
 
 
+class NamespaceFlattenerTestCase(unittest.TestCase):
+
+    def test_without_namespaces(self):
+        stream = list(XML('<div class="a"><p>x</p><br/></div>'))
+        output = list(NamespaceFlattener()(stream))
+        self.assertEqual(stream, output)
+        for event, flattened in zip(stream, output):
+            self.assertTrue(event is flattened)
+
+    def test_namespace_after_start(self):
+        stream = XML('<div><p>x</p><x:a xmlns:x="urn:x" x:b="1"/>'
+                     '<y z:c="2" xmlns:z="urn:z"/></div>')
+        self.assertEqual('<div><p>x</p><x:a xmlns:x="urn:x" x:b="1"/>'
+                         '<y xmlns:z="urn:z" z:c="2"/></div>',
+                         stream.render('xml', encoding=None))
+
+    def test_namespaced_static_run(self):
+        run = StaticRun(list(XML('<x:a xmlns:x="urn:x"/>')))
+        stream = list(XML('<div/>'))
+        self.assertEqual('<div><x:a xmlns:x="urn:x"/></div>',
+                         Stream(stream[:1] + [(STATIC, run, (None, -1, -1))] +
+                                stream[1:]).render('xml', encoding=None))
+
+
+class FilterPipelineTestCase(unittest.TestCase):
+    """Checks that the filters of the serializers applied in a single loop
+    produce the same events as the chained filters.
+    """
+
+    def _check(self, stream, **kwargs):
+        stream = list(stream)
+        for method in ('xml', 'xhtml', 'html'):
+            for strip_whitespace in (True, False):
+                serializer = output.get_serializer(
+                    method, strip_whitespace=strip_whitespace, **kwargs
+                )
+                chained = stream
+                for filter_ in serializer.filters:
+                    chained = filter_(chained)
+                filters = output._standard_filters(serializer.filters)
+                self.assertEqual(list(chained),
+                                 list(output._apply_filters(stream, *filters)))
+
+    def test_whitespace(self):
+        self._check(XML('<div>\n  <p>  x  </p>\n\n\n  <pre>\n  y  \n</pre>'
+                        '<p xml:space="preserve">\n  z  \n</p>\n<br/>\n'
+                        '<![CDATA[ 1 < 2 \n\n]]></div>  \n'))
+        self._check(HTML(u'<div> <script>\n  1 < 2  \n</script> <p/>\n'
+                         u'<style></style>1 < 2\n\n</div>'))
+
+    def test_doctype(self):
+        self._check([], doctype='html5')
+        self._check(XML('<?xml version="1.0"?>\n<html/>'), doctype='html5')
+        self._check(XML('<html xmlns="urn:x">\n</html>'), doctype='html5')
+        self._check(HTML(u'text <p/> text'), doctype='html5')
+
+    def test_namespaces(self):
+        self._check(XML('<div>\n  <p>x</p>  <x:a xmlns:x="urn:x">\n'
+                        '  <x:b/></x:a>  <p/></div>'))
+        self._check(XML('<div>  <p>  <a x:b="1" xmlns:x="urn:x"/>'
+                        '</p>  </div>'))
+        self._check(XML('<div>\n  <p>  </p>  <x:a xmlns:x="urn:x"/></div>'))
+        pos = (None, -1, -1)
+        tag = QName('urn:x}a')
+        self._check([(Stream.START, (QName('div'), Attrs()), pos),
+                     (Stream.START, (tag, Attrs()), pos),
+                     (Stream.TEXT, u' x ', pos), (Stream.END, tag, pos),
+                     (Stream.START, (tag, Attrs()), pos),
+                     (Stream.END, tag, pos),
+                     (Stream.END, QName('div'), pos)])
+
+    def test_static(self):
+        runs = [StaticRun(list(XML(text))) for text in (
+            '<p>\n  <b>x</b>  \n</p>', '<x:a xmlns:x="urn:x">\n</x:a>'
+        )]
+        stream = list(XML('<div>  <pre>  </pre>  </div>'))
+        for run in runs:
+            self._check(stream[:3] + [(STATIC, run, (None, -1, -1))] +
+                        stream[3:])
+
+    def test_other_filters(self):
+        serializer = XMLSerializer()
+        self.assertNotEqual(None,
+                            output._standard_filters(serializer.filters))
+        serializer.filters.append(lambda stream: stream)
+        self.assertEqual(None, output._standard_filters(serializer.filters))
+
+
+class StaticRunTestCase(unittest.TestCase):
+
+    def _static(self, text, **kwargs):
+        events = list(XML(text, **kwargs))
+        return (STATIC, StaticRun(events), events[0][2])
+
+    def _check(self, stream, serializer):
+        expanded = []
+        for event in stream:
+            if event[0] is STATIC:
+                expanded.extend(event[1].events)
+            else:
+                expanded.append(event)
+        output = ''.join(serializer()(stream))
+        self.assertEqual(''.join(serializer()(expanded)), output)
+        return output
+
+    def test_serializers(self):
+        run = self._static("""<div>
+          <p class="x"><br/>  Hello  </p>
+
+
+          <input type="checkbox" checked="checked"/>
+          <textarea>  foo  </textarea>
+        </div>""")
+        for serializer in (XMLSerializer, XHTMLSerializer, HTMLSerializer):
+            # also checks that the output cached for one serializer doesn't
+            # get used by another one
+            self._check([run], serializer)
+            self._check([run, (Stream.TEXT, '  x  ', (None, -1, -1)), run],
+                        serializer)
+
+    def test_in_cdata(self):
+        run = self._static('<b>a &amp; b</b>')
+        stream = XML('<div><![CDATA[x]]></div>')
+        for serializer in (XMLSerializer, XHTMLSerializer):
+            self.assertEqual('<div><![CDATA[x<b>a & b</b>]]></div>',
+                             self._check(list(stream)[:3] + [run] +
+                                         list(stream)[3:], serializer))
+
+    def test_in_noescape_elem(self):
+        run = self._static('<b>a &amp; b</b>')
+        stream = list(XML('<script>x</script>'))
+        self.assertEqual('<script>x<b>a & b</b></script>',
+                         self._check(stream[:2] + [run] + stream[2:],
+                                     HTMLSerializer))
+
+    def test_in_preserved_space(self):
+        run = self._static('<b>  a  \n\n\n  b  </b>')
+        stream = list(XML('<pre>  x  </pre>'))
+        self.assertEqual('<pre>  x  <b>  a  \n\n\n  b  </b></pre>',
+                         self._check(stream[:2] + [run] + stream[2:],
+                                     XHTMLSerializer))
+
+    def test_namespaces(self):
+        run = self._static('<x:a xmlns:x="urn:x" x:b="1"/>')
+        run = (STATIC, StaticRun([ev for ev in run[1].events
+                                  if ev[0] in (Stream.START, Stream.END)]),
+               run[2])
+        self.assertEqual(('urn:x',), run[1].namespaces)
+        # the namespace has not been declared
+        self.assertEqual('<a xmlns="urn:x" b="1"/>',
+                         self._check([run], XMLSerializer))
+        # the declaration is still pending
+        ns = (Stream.START_NS, ('y', 'urn:x'), (None, -1, -1))
+        end_ns = (Stream.END_NS, 'y', (None, -1, -1))
+        self.assertEqual('<y:a xmlns:y="urn:x" y:b="1"/>',
+                         self._check([ns, run, end_ns], XMLSerializer))
+        # different prefixes for the same run
+        stream = list(XML('<z:doc xmlns:z="urn:x"></z:doc>'))
+        self.assertEqual('<z:doc xmlns:z="urn:x"><z:a z:b="1"/></z:doc>'
+                         '<y:a xmlns:y="urn:x" y:b="1"/>',
+                         self._check(stream[:2] + [run] + stream[2:] +
+                                     [ns, run, end_ns], XMLSerializer))
+
+
+class TagCacheTestCase(unittest.TestCase):
+
+    def test_shared_across_renders(self):
+        cache = TagCache()
+        for text in ('a', 'b'):
+            stream = XML('<p class="x">%s</p>' % text)
+            self.assertEqual('<p class="x">%s</p>' % text,
+                             stream.render('xml', cache=cache, encoding=None))
+        self.assertEqual(2, len(cache))
+
+        # Tags found in the cache are not serialized again
+        start = (XMLSerializer, Stream.START,
+                 ('p', Attrs([(QName('class'), 'x')])))
+        cache.put(start, Markup('<p class="cached">'))
+        self.assertEqual('<p class="cached">c</p>',
+                         XML('<p class="x">c</p>').render('xml', cache=cache,
+                                                          encoding=None))
+
+    def test_serializers_kept_apart(self):
+        cache = TagCache()
+        stream = XML('<div><br/><input checked="checked"/></div>')
+        self.assertEqual('<div><br/><input checked="checked"/></div>',
+                         stream.render('xml', cache=cache, encoding=None))
+        self.assertEqual('<div><br /><input checked="checked" /></div>',
+                         stream.render('xhtml', cache=cache, encoding=None))
+        self.assertEqual('<div><br><input checked></div>',
+                         stream.render('html', cache=cache, encoding=None))
+        self.assertEqual('<div><br><input checked></div>',
+                         stream.render('html', cache=cache, encoding=None))
+
+    def test_html_script(self):
+        cache = TagCache()
+        stream = HTML(u'<div><script>1 < 2</script><p>1 < 2</p></div>')
+        for idx in range(2):
+            self.assertEqual(u'<div><script>1 < 2</script><p>1 &lt; 2</p>'
+                             u'</div>', stream.render('html', cache=cache,
+                                                      encoding=None))
+
+    def test_capacity(self):
+        cache = TagCache(capacity=2)
+        XML('<a><b/></a>').render('xml', cache=cache)
+        XML('<c/>').render('xml', cache=cache)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get((XMLSerializer, Stream.START,
+                                          ('a', Attrs()))))
+
+    def test_text_not_shared(self):
+        cache = TagCache()
+        XML('<p>text</p>').render('xml', cache=cache)
+        self.assertEqual(None, cache.get((XMLSerializer, Stream.TEXT,
+                                          'text')))
+
+class SpeedupsTestCase(unittest.TestCase):
+    """Checks that the serialization loops of the C extension produce the
+    same output as the Python implementation. Only run if the extension is
+    available.
+    """
+
+    def _check(self, stream, method, **kwargs):
+        stream = list(stream)
+        speedups = Stream(stream).render(method, encoding=None, **kwargs)
+        serialize = output._speedups_serialize
+        output._speedups_serialize = None
+        try:
+            python = Stream(stream).render(method, encoding=None, **kwargs)
+        finally:
+            output._speedups_serialize = serialize
+        self.assertEqual(python, speedups)
+        self.assertEqual(type(python), type(speedups))
+        return python
+
+    def _check_all(self, stream, **kwargs):
+        stream = list(stream)
+        for method in ('xml', 'xhtml', 'html'):
+            for cache in (True, False, TagCache()):
+                self._check(stream, method, cache=cache, **kwargs)
+
+    def test_attributes(self):
+        self._check_all(XML('<div xmlns:x="urn:x" a="&quot;1 &lt; 2&quot;" '
+                            'b="" x:c="3"><img src="x" alt=""/>'
+                            '<input checked="checked" disabled=""/>'
+                            '<p xml:lang="en" xml:space="preserve">x</p>'
+                            '<p lang="de" xml:lang="en">y</p></div>'))
+
+    def test_attribute_values(self):
+        attrs = Attrs([(QName('a'), u''), (QName('b'), u'0'),
+                       (QName('c'), u'\xe9 < "1"'),
+                       (QName('selected'), u'selected'),
+                       (QName('d'), Markup('&'))])
+        self._check_all([(Stream.START, (QName('option'), attrs),
+                          (None, -1, -1)),
+                         (Stream.TEXT, u'\xe9', (None, -1, -1)),
+                         (Stream.END, QName('option'), (None, -1, -1))])
+
+    def test_text(self):
+        self._check_all(XML(u'<p>1 &lt; 2 &amp; "3" &gt; \u2026<b/>'
+                            u'<![CDATA[1 < 2]]></p>'))
+        self._check_all([(Stream.TEXT, Markup('<br/>'), (None, -1, -1)),
+                         (Stream.TEXT, u'', (None, -1, -1))])
+
+    def test_script(self):
+        html = HTML(u'<div><script>if (1 < 2) {}</script><p>1 < 2</p>'
+                    u'<style>a > b {}</style>1 < 2<script/>1 < 2</div>')
+        self._check_all(html)
+        self._check_all(html, strip_whitespace=False)
+
+    def test_declarations(self):
+        self._check_all([(Stream.XML_DECL, ('1.0', 'utf-8', 1),
+                          (None, -1, -1)),
+                         (Stream.XML_DECL, ('1.0', None, -1), (None, -1, -1))]
+                        + list(XML('<!DOCTYPE html><?php echo 1 ?><!-- x -->'
+                                   '<html/><!-- x --><?php echo 1 ?>')),
+                        doctype='xhtml')
+        self._check(XML('<?xml version="1.0"?><html/>'), 'xhtml',
+                    drop_xml_decl=False)
+
+    def test_static(self):
+        run = StaticRun(list(HTML(u'<p title="&">1 < 2</p>')))
+        static = (STATIC, run, (None, -1, -1))
+        script = list(HTML(u'<script></script>'))
+        self._check_all([static] + script[:1] + [static] + script[1:] +
+                        [static])
+
+    def test_subclass(self):
+        class Serializer(XMLSerializer):
+            def _serialize(self, stream, in_cdata=False):
+                for output in XMLSerializer._serialize(self, stream,
+                                                       in_cdata):
+                    yield output.upper()
+        self.assertEqual('<P A="B">X</P>', XML('<p a="b">x</p>').render(
+            Serializer, encoding=None
+        ))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(XHTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(HTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(EmptyTagFilterTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(NamespaceFlattenerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(FilterPipelineTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(StaticRunTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TagCacheTestCase, 'test'))
+    if output._speedups_serialize is not None:
+        suite.addTest(unittest.makeSuite(SpeedupsTestCase, 'test'))
     suite.addTest(doctest.DocTestSuite(XMLSerializer.__module__))
     return suite
 
@@ -83,6 +83,37 @@ class LRUCacheTestCase(unittest.TestCase):
         self.assertEqual(item_a, item_b.prv)
         self.assertEqual(None, item_b.nxt)
 
+    def test_delitem(self):
+        cache = LRUCache(3)
+        cache['A'] = 0
+        cache['B'] = 1
+        cache['C'] = 2
+
+        del cache['B']
+        self.assertEqual(2, len(cache))
+        self.assertEqual(['C', 'A'], list(cache))
+        item_a = cache._dict['A']
+        item_c = cache._dict['C']
+        self.assertEqual(item_c, item_a.prv)
+        self.assertEqual(item_a, item_c.nxt)
+
+        del cache['C']
+        del cache['A']
+        self.assertEqual(0, len(cache))
+        self.assertEqual(None, cache.head)
+        self.assertEqual(None, cache.tail)
+        self.assertRaises(KeyError, cache.__delitem__, 'A')
+
+    def test_peek(self):
+        cache = LRUCache(3)
+        cache['A'] = 0
+        cache['B'] = 1
+        self.assertEqual(0, cache.peek('A'))
+        self.assertEqual(None, cache.peek('C'))
+        self.assertEqual(-1, cache.peek('C', -1))
+        # Peeking does not mark the item as recently used
+        self.assertEqual(['B', 'A'], list(cache))
+
 
 def suite():
     suite = unittest.TestSuite()
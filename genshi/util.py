@@ -44,6 +44,12 @@ class LRUCache(dict):
     >>> 'B' in cache
     False
     
+    The number of items dropped that way is available as the `evictions`
+    attribute:
+    
+    >>> cache.evictions
+    1
+    
     Iterating over the cache returns the keys, starting with the most recently
     used:
     
@@ -70,6 +76,7 @@ class LRUCache(dict):
     def __init__(self, capacity):
         self._dict = dict()
         self.capacity = capacity
+        self.evictions = 0
         self.head = None
         self.tail = None
 
@@ -90,6 +97,29 @@ class LRUCache(dict):
         self._update_item(item)
         return item.value
 
+    def peek(self, key, default=None):
+        """Return the value stored under the given key, or `default` if there
+        is no such item, without marking the item as recently used.
+        
+        As this does not modify the cache, it can be called from one thread
+        while another thread is modifying the cache.
+        """
+        item = self._dict.get(key)
+        if item is None:
+            return default
+        return item.value
+
+    def __delitem__(self, key):
+        item = self._dict.pop(key)
+        if item.prv is not None:
+            item.prv.nxt = item.nxt
+        else:
+            self.head = item.nxt
+        if item.nxt is not None:
+            item.nxt.prv = item.prv
+        else:
+            self.tail = item.prv
+
     def __setitem__(self, key, value):
         item = self._dict.get(key)
         if item is None:
@@ -116,8 +146,8 @@ class LRUCache(dict):
 
     def _manage_size(self):
         while len(self._dict) > self.capacity:
-            olditem = self._dict[self.tail.key]
             del self._dict[self.tail.key]
+            self.evictions += 1
             if self.tail != self.head:
                 self.tail = self.tail.prv
                 self.tail.nxt = None